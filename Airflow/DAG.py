@@ -1,5 +1,7 @@
-CARPETA_ZIP = "/data/data/ftp/mae_evaluation/smart_capex"
+CARPETA_ZIP = "/data/data/ftp/mae_evaluation/smart_capex" # Solo el exporte diario completo
+CARPETA_ZIP_MICROLOTES = "/data/data/ftp/mae_evaluation/smart_capex_horario" # Exportes por hora o parciales del mismo día
 CARPETA_DESCOMPRIMIDA = "/data/apps/repo-airflow/app_evotec/tmp"
+CARPETA_MICROLOTES = "/data/apps/repo-airflow/app_evotec/tmp_microlotes" # Aparte de la carga diaria, pueden correr el mismo día
 
 from airflow import DAG
 from airflow.decorators import dag, task
@@ -12,7 +14,7 @@ default_args = {
 }
 @dag(dag_id='ran_etl_pipeline', default_args=default_args, schedule='0 6 * * *', catchup=False)
 def ran_etl_pipeline():
-    from app_evotec.etl_scripts.Tasks_daily import descomprimir_archivos, borrar_encabezado, editar_archivos_csv, tablas_agregaciones
+    from app_evotec.etl_scripts.Tasks_daily import descomprimir_archivos, borrar_encabezado, editar_archivos_csv, tablas_agregaciones, snapshots_mapa
 
     @task
     def extract_task():
@@ -26,9 +28,28 @@ def ran_etl_pipeline():
     @task
     def load_task():
         tablas_agregaciones(CARPETA_DESCOMPRIMIDA)
+    @task
+    def snapshot_task():
+        snapshots_mapa()
 
     # Definir las dependencias entre las tareas
-    extract_task() >> enhance_task_row() >> enhance_task_column() >> load_task()
+    extract_task() >> enhance_task_row() >> enhance_task_column() >> load_task() >> snapshot_task()
 
 # Instanciar el DAG
-dag = ran_etl_pipeline()
\ No newline at end of file
+dag = ran_etl_pipeline()
+
+
+# Microlotes: revisa la carpeta de exportes por hora del FTP cada 5 minutos y sube solo las horas de los archivos nuevos. Sin reintentos,
+# un archivo que falla se vuelve a intentar en la siguiente revisión porque no queda en el registro de procesados
+@dag(dag_id='ran_etl_microlotes', default_args={'start_date': datetime(2024, 7, 1), 'retries': 0},
+     schedule='*/5 * * * *', catchup=False, max_active_runs=1)
+def ran_etl_microlotes():
+    from app_evotec.etl_scripts.Tasks_daily import microlotes
+
+    @task
+    def microlote_task():
+        microlotes(CARPETA_ZIP_MICROLOTES, CARPETA_MICROLOTES)
+
+    microlote_task()
+
+dag_microlotes = ran_etl_microlotes()
@@ -1,4 +1,8 @@
+import io
 import os
+import sys
+import time
+import zlib
 import zipfile
 import pandas as pd
 import psycopg2
@@ -7,7 +11,16 @@ import numpy as np
 from datetime import datetime, timedelta
 
 import DBcredentials # Credenciales bases de datos
-
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comun"))
+import kpis_ran # Cálculo de KPIs compartido con el dashboard
+import instrumentacion # Tiempos, filas, bytes y memoria de cada etapa
+import lectura_paralela # Lectura del CSV diario en varios procesos
+import empaquetado # Formato con una fila por entidad y día y arreglos de 24 horas
+import historico_local # Copia en Parquet de las tablas horarias para las consultas de recorrido del dashboard
+import archivo_frio # Parquet con los días que equilibrar() borra de PostgreSQL
+import estados_kpi # Suma, máximo e histograma por entidad y día, combinables entre niveles y periodos
+
+@instrumentacion.medir("etl.descomprimir_archivos")
 def descomprimir_archivos(carpeta_zip, carpeta_descomprimida):
     print("Iniciando proceso de descompresión")
     archivos_zip = [os.path.join(carpeta_zip, archivo) for archivo in os.listdir(carpeta_zip) if archivo.endswith('.zip')] # Obtener la lista de archivos zip en la carpeta
@@ -16,21 +29,25 @@ def descomprimir_archivos(carpeta_zip, carpeta_descomprimida):
     # print("Post-order:\n", archivos_zip)
     
     if archivos_zip: # Si se encontraron archivos zip
-        last_file = archivos_zip[0] # Tomar solo el archivo zip más reciente
-        carpeta_temporal = os.path.join(carpeta_descomprimida, "raw_data")
-        os.makedirs(carpeta_temporal, exist_ok=True) # Crear una carpeta donde se almacenará el archivo descomprimido
-        existente = os.listdir(carpeta_temporal)
-        if existente: # Si ya existen archivos
-            print(f"Existente: {existente}")
-            archivo_borrar = os.path.join(carpeta_temporal, existente[0])
-            os.remove(archivo_borrar)  # Eliminar el archivo si ya existe
-            print(f"Se ha borrado el archivo previo: {archivo_borrar}")
+        descomprimir_zip(archivos_zip[0], carpeta_descomprimida) # Tomar solo el archivo zip más reciente (los microlotes llegan a otra carpeta)
+
+def descomprimir_zip(archivo_zip, carpeta_descomprimida):
+    carpeta_temporal = os.path.join(carpeta_descomprimida, "raw_data")
+    os.makedirs(carpeta_temporal, exist_ok=True) # Crear una carpeta donde se almacenará el archivo descomprimido
+    existente = os.listdir(carpeta_temporal)
+    if existente: # Si ya existen archivos
+        print(f"Existente: {existente}")
+        archivo_borrar = os.path.join(carpeta_temporal, existente[0])
+        os.remove(archivo_borrar)  # Eliminar el archivo si ya existe
+        print(f"Se ha borrado el archivo previo: {archivo_borrar}")
 
-        with zipfile.ZipFile(last_file, 'r') as zip_ref: # Descomprimir el archivo zip más reciente
-            zip_ref.extractall(carpeta_temporal)
-        print(f"Archivo descomprimido: {last_file}")
+    with zipfile.ZipFile(archivo_zip, 'r') as zip_ref: # Descomprimir el archivo zip
+        zip_ref.extractall(carpeta_temporal)
+        instrumentacion.anotar(bytes_leidos=os.path.getsize(archivo_zip), bytes_escritos=sum(info.file_size for info in zip_ref.infolist()))
+    print(f"Archivo descomprimido: {archivo_zip}")
 
 
+@instrumentacion.medir("etl.borrar_encabezado")
 def borrar_encabezado(carpeta):
     print("Iniciando función de borrado de encabezados")
     carpeta_raw = os.path.join(carpeta, "raw_data") # Ruta carpeta donde se encuentra archivo descomprimido
@@ -44,9 +61,25 @@ def borrar_encabezado(carpeta):
             lineas = f.readlines()
         with open(ruta_archivo, 'w') as f:
             f.writelines(lineas[6:-1])
+        instrumentacion.anotar(filas=len(lineas[6:-1]), bytes_leidos=sum(map(len, lineas)), bytes_escritos=sum(map(len, lineas[6:-1])))
         print(f"Lineas borradas del archivo: {archivo_csv}")
 
 
+# Columnas del CSV del gestor que usa el ETL y contadores que pueden traer "NIL"
+COLUMNAS_GESTOR = ["Date","Time","eNodeB Name","Cell Name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
+CONTADORES_GESTOR = COLUMNAS_GESTOR[4:]
+
+def arreglar_bloque(df): # Arreglo de columnas de un bloque de filas del CSV del gestor, corre en los procesos de lectura_paralela
+    # Reemplazo los valores "NIL" que puedan existir en las columnas numéricas
+    df[CONTADORES_GESTOR] = df[CONTADORES_GESTOR].replace("NIL", 0)
+    # Nueva columna "Timestamp" a partir de 'fecha' y 'hora', parseando solo los pares distintos (24 por día). Utilizo metodo insert para posicionarla al inicio, como en la base de datos
+    df.insert(0, "Timestamp", kpis_ran.texto_unicos(kpis_ran.fecha_hora(df['Date'], df['Time'])))
+    # Eliminar las columnas 'Date' y 'Time'
+    df = df.drop(columns=["Date", "Time"])
+    # Renombrar columnas para dejarlas tal cual en la BD
+    return df.rename(columns={"eNodeB Name":"Node_name", "Cell Name":"Cell_name"})
+
+@instrumentacion.medir("etl.editar_archivos_csv")
 def editar_archivos_csv(carpeta):
     print("Iniciando función de arreglo de columnas")
     carpeta_raw = os.path.join(carpeta, "raw_data") # Ruta carpeta donde se encuentra archivo descomprimido
@@ -55,28 +88,124 @@ def editar_archivos_csv(carpeta):
     # Modificar los archivos CSV en la carpeta de destino
     for archivo_csv in archivos_csv:
         ruta_archivo = os.path.join(carpeta_raw, archivo_csv)
-        # Leer el archivo CSV y cargarlo en un DataFrame
-        df = pd.read_csv(ruta_archivo,
-                         usecols=["Date","Time","eNodeB Name","Cell Name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-                         )
-        # Columnas númericas que presentan problemas si contienen valors no numericos
-        numeric_cols = ["L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]  # Agrega aquí las columnas que deseas corregir
-        # Reemplazo los valores "NIL" que puedan existir en estas columnas
-        df[numeric_cols] = df[numeric_cols].replace("NIL", 0)
-        # Concatenar las columnas 'fecha' y 'hora' en una nueva columna "Timestamp". Utilizo metodo insert para posicionarla al inicio, como en la base de datos
-        df.insert(0, "Timestamp", df['Date'] + ' ' + df['Time'])
-        # Convertir la columna 'Timestamp' a formato datetime
-        df["Timestamp"] = pd.to_datetime(df["Timestamp"])
-        # Dejar todos los valores de 'Timestamp' con el mismo formato
-        df['Timestamp'] = df['Timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
-        # Eliminar las columnas 'Date' y 'Time'
-        df = df.drop(columns=["Date", "Time"])
-        # Renombrar columnas para dejarlas tal cual en la BD
-        df = df.rename(columns={"eNodeB Name":"Node_name", "Cell Name":"Cell_name"})
-        # Guardar el DataFrame modificado en el archivo CSV
-        df.to_csv(ruta_archivo, index=False)
+        instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
+        # Leer el archivo por rangos de bytes en varios procesos, arreglar cada bloque y reescribirlo en orden
+        filas = lectura_paralela.transformar_csv(ruta_archivo, ruta_archivo, arreglar_bloque, usecols=COLUMNAS_GESTOR)
+        instrumentacion.anotar(filas=filas, bytes_escritos=os.path.getsize(ruta_archivo))
         print(f"Archivo arreglado: {archivo_csv}")
         
+# Tablas horarias con la columna de nombre de cada una y si el dashboard la compara en mayúsculas (UPPER en query_to_df).
+# Son tablas de solo inserción que llegan ordenadas por hora: un BRIN por "Timestamp" resuelve los rangos de fechas
+# (mapa, snapshots, equilibrar) ocupando unos pocos KB, y un índice de cobertura (nombre, "Timestamp") INCLUDE con los
+# contadores de las gráficas resuelve la historia de una selección leyendo solo el índice. Reemplazan al B-tree
+# ("Timestamp", nombre) que se creaba antes, que era casi del tamaño de la tabla y no evitaba leerla
+TABLAS_HORARIAS = {
+    "ran_1h_cell": ("Cell_name", True),
+    "ran_1h_sector": ("sector_name", True),
+    "ran_1h_node": ("node_name", True),
+    "ran_1h_cluster": ("cluster_name", False),
+    "ran_1h_localidad": ("localidad_dane_code", False),
+    "ran_1h_municipio": ("municipio_dane_code", False),
+    "ran_1h_am": ("am_name", False),
+    "ran_1h_departamento": ("dpto_dane_code", False),
+    "ran_1h_regional": ("regional_name", False),
+    "ran_1h_total": (None, False)
+}
+PAGINAS_POR_RANGO_BRIN = 32 # Páginas de 8 KB por resumen del BRIN; una hora de celdas ocupa varios cientos de páginas
+# Tablas horarias sin índice de cobertura: el dashboard lee la historia de las celdas de la tabla empaquetada
+# (ran_1d_cell), así que en ran_1h_cell ese índice solo encarecería el COPY diario de millones de filas. Sus lecturas
+# por rango de fechas (snapshots del mapa, equilibrar) usan el BRIN
+TABLAS_SIN_COBERTURA = ["ran_1h_cell"]
+
+def indice_cobertura(table_name):
+    # Nombre y sentencia del índice de cobertura de una tabla horaria. Para el total solo hay "Timestamp" como llave
+    name_column, mayusculas = TABLAS_HORARIAS[table_name]
+    incluidas = list(kpis_ran.CONTADORES_GRAFICAS)
+    if name_column is None:
+        llave = sql.SQL('"Timestamp"')
+    elif mayusculas:
+        # Índice por expresión para que sirva al filtro UPPER(nombre) = %s; el nombre original va en INCLUDE porque la consulta lo devuelve
+        llave = sql.SQL('UPPER({}), "Timestamp"').format(sql.Identifier(name_column))
+        incluidas = [name_column] + incluidas
+    else:
+        llave = sql.SQL('{}, "Timestamp"').format(sql.Identifier(name_column))
+    index_name = f"idx_{table_name}_cobertura"
+    query = sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({}) INCLUDE ({})").format(
+        sql.Identifier(index_name), sql.Identifier(table_name), llave, sql.SQL(', ').join(map(sql.Identifier, incluidas)))
+    return index_name, query
+
+def indices_tabla_horaria(conn, table_name):
+    # Crea los índices de una tabla horaria y borra el B-tree anterior. IF NOT EXISTS para que también sirva en tablas
+    # ya existentes. En las tablas de TABLAS_SIN_COBERTURA se borra el índice de cobertura si quedó de antes
+    cur = conn.cursor()
+    brin_query = sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING brin (\"Timestamp\") WITH (pages_per_range = {}, autosummarize = on)").format(
+        sql.Identifier(f"idx_{table_name}_brin"), sql.Identifier(table_name), sql.Literal(PAGINAS_POR_RANGO_BRIN))
+    index_name, cobertura_query = indice_cobertura(table_name)
+    with instrumentacion.tiempo_sql():
+        cur.execute(brin_query)
+        if table_name in TABLAS_SIN_COBERTURA:
+            cur.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(index_name)))
+        else:
+            cur.execute(cobertura_query)
+        cur.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(f"idx_{table_name}_time_name")))
+    conn.commit()
+    cur.close()
+
+@instrumentacion.medir("etl.mantener_indices")
+def mantener_indices(conn, tablas=None):
+    # Después de cargar: crea los índices que falten (o que se quitaron para una carga masiva), resume en el BRIN las
+    # páginas nuevas y corre VACUUM ANALYZE. El VACUUM marca las páginas como visibles para todos, sin eso PostgreSQL
+    # igual va a la tabla por cada fila y el índice de cobertura no da lecturas solo del índice
+    tablas = list(TABLAS_HORARIAS) if tablas is None else tablas
+    cur = conn.cursor()
+    for table_name in tablas:
+        cur.execute("SELECT to_regclass(%s)", (table_name,))
+        if cur.fetchone()[0] is None:
+            print(f"La tabla {table_name} NO EXISTE, no se verifican sus indices")
+            continue
+        conn.commit()
+        indices_tabla_horaria(conn, table_name)
+        conn.autocommit = True # VACUUM no puede correr dentro de una transacción
+        try:
+            with instrumentacion.tiempo_sql():
+                cur.execute("SELECT brin_summarize_new_values(%s::regclass)", (f"idx_{table_name}_brin",))
+                cur.execute(sql.SQL("VACUUM ANALYZE {}").format(sql.Identifier(table_name)))
+        finally:
+            conn.autocommit = False
+        print(f"Indices de {table_name} verificados")
+    cur.close()
+
+def vista_por_hora(conn, table_name, column_definitions):
+    # Compatibilidad con las consultas escritas para la tabla por hora: la función {tabla}_por_hora(inicio, fin) devuelve
+    # las filas de ese rango de días desempaquetadas, con las columnas de ran_1h_cell, y la vista {tabla}_por_hora
+    # todas las filas. Las horas con todos los contadores en NULL no existían en el reporte y no se devuelven
+    claves = [nombre for nombre, tipo in column_definitions[1:] if not tipo.endswith("[]")]
+    contadores = [(nombre, tipo[:-2]) for nombre, tipo in column_definitions if tipo.endswith("[]")]
+    funcion = f"{table_name}_por_hora"
+    columnas_salida = [sql.SQL("\"Timestamp\" TIMESTAMP")] + \
+        [sql.SQL("{} VARCHAR").format(sql.Identifier(nombre)) for nombre in claves] + \
+        [sql.SQL("{} {}").format(sql.Identifier(nombre), sql.SQL(tipo)) for nombre, tipo in contadores]
+    create_function_query = sql.SQL("""
+        CREATE OR REPLACE FUNCTION {funcion}(inicio DATE, fin DATE) RETURNS TABLE ({salida}) LANGUAGE sql STABLE AS $$
+            SELECT p."Date" + make_interval(hours => (h.hora - 1)::int), {claves}, {valores}
+            FROM {tabla} p
+            CROSS JOIN LATERAL unnest({arreglos}) WITH ORDINALITY AS h({nombres}, hora)
+            WHERE p."Date" BETWEEN $1 AND $2
+            AND NOT ({nulos})
+        $$""").format(
+            funcion=sql.Identifier(funcion), salida=sql.SQL(", ").join(columnas_salida), tabla=sql.Identifier(table_name),
+            claves=sql.SQL(", ").join(sql.SQL("p.{}").format(sql.Identifier(nombre)) for nombre in claves),
+            valores=sql.SQL(", ").join(sql.SQL("h.{}").format(sql.Identifier(nombre)) for nombre, _ in contadores),
+            arreglos=sql.SQL(", ").join(sql.SQL("p.{}").format(sql.Identifier(nombre)) for nombre, _ in contadores),
+            nombres=sql.SQL(", ").join(sql.Identifier(nombre) for nombre, _ in contadores),
+            nulos=sql.SQL(" AND ").join(sql.SQL("h.{} IS NULL").format(sql.Identifier(nombre)) for nombre, _ in contadores))
+    cur = conn.cursor()
+    cur.execute(create_function_query)
+    cur.execute(sql.SQL("CREATE OR REPLACE VIEW {} AS SELECT * FROM {}('-infinity', 'infinity')").format(sql.Identifier(funcion), sql.Identifier(funcion)))
+    conn.commit()
+    cur.close()
+    print(f"Vista y función {funcion} creadas con exito")
+
 def create_table(table_name, table_type):
     if table_type == "celda":
         column_definitions = [
@@ -268,6 +397,40 @@ def create_table(table_name, table_type):
             ("L.Thrp.bits.DL.LastTTI(bit)", "BIGINT"),
             ("L.Thrp.Time.DL.RmvLastTTI(ms)", "BIGINT")
         ]
+    elif table_type == "celda_dia":
+        # Mismos contadores que la tabla de celdas, empaquetados en arreglos de 24 horas (posición 1 = hora 00)
+        column_definitions = [
+            ("Date", "DATE"),
+            ("Node_name", "VARCHAR"),
+            ("Cell_name", "VARCHAR"),
+            ("L.Traffic.ActiveUser.DL.Avg", "DOUBLE PRECISION[]"),
+            ("L.Traffic.ActiveUser.DL.Max", "SMALLINT[]"),
+            ("L.Traffic.ActiveUser.UL.Avg", "DOUBLE PRECISION[]"),
+            ("L.Traffic.ActiveUser.UL.Max", "SMALLINT[]"),
+            ("L.Traffic.User.Avg", "DOUBLE PRECISION[]"),
+            ("L.Traffic.User.Max", "SMALLINT[]"),
+            ("L.ChMeas.PRB.DL.Avail", "SMALLINT[]"),
+            ("L.ChMeas.PRB.DL.Used.Avg", "DOUBLE PRECISION[]"),
+            ("L.ChMeas.PRB.UL.Avail", "SMALLINT[]"),
+            ("L.ChMeas.PRB.UL.Used.Avg", "DOUBLE PRECISION[]"),
+            ("L.Thrp.bits.DL(bit)", "BIGINT[]"),
+            ("L.Thrp.bits.UL(bit)", "BIGINT[]"),
+            ("L.Thrp.bits.DL.LastTTI(bit)", "BIGINT[]"),
+            ("L.Thrp.Time.DL.RmvLastTTI(ms)", "BIGINT[]")
+        ]
+    elif table_type == "estados":
+        # Estados combinables por nivel, entidad y día (Comun/estados_kpi.py), histogramas con los límites de LIMITES
+        column_definitions = [
+            ("Date", "DATE"),
+            ("nivel", "VARCHAR"),
+            ("nombre", "VARCHAR"),
+            ("prb_suma", "DOUBLE PRECISION"),
+            ("prb_max", "REAL"),
+            ("hist_prb", "INTEGER[]"),
+            ("uexp_suma", "DOUBLE PRECISION"),
+            ("uexp_max", "REAL"),
+            ("hist_uexp", "INTEGER[]")
+        ]
     elif table_type == "kpi":
         column_definitions = [
             ("Date", "DATE"),
@@ -329,28 +492,26 @@ def create_table(table_name, table_type):
         conn.commit() # Confirmar los cambios
         print(f"Tabla {table_name} creada con exito")
 
-        index_name = f"idx_{table_name}_time_name" # Crear el nombre del índice compuesto
-        
-        if table_type == "celda":
-            # Definir la sentencia SQL para crear el índice compuesto de la tabla de celdas
-            create_index_query = sql.SQL("CREATE INDEX {} ON {} (\"Timestamp\", \"Cell_name\");").format(sql.Identifier(index_name), sql.Identifier(table_name))
-
-        elif table_type == "total":
-            # Para el total de la red
-            create_index_query = sql.SQL("CREATE INDEX {} ON {} (\"Timestamp\");").format(sql.Identifier(index_name), sql.Identifier(table_name))
-
-        elif table_type == "kpi":
+        if table_type == "kpi":
             # Para la tabla de kpis diarios
+            index_name = f"idx_{table_name}_time_name" # Crear el nombre del índice compuesto
             create_index_query = sql.SQL("CREATE INDEX {} ON {} (\"Date\", \"cell_name\");").format(sql.Identifier(index_name), sql.Identifier(table_name))
+            # print("Consulta crear indice:", create_index_query.as_string(cur))
+            cur.execute(create_index_query) # Ejecutar la sentencia SQL para crear el índice
+            conn.commit() # Confirmar los cambios
+        elif table_type == "celda_dia":
+            # Una entrada por celda y día para la historia de una celda y BRIN por día para los rangos del mapa
+            cur.execute(sql.SQL("CREATE INDEX {} ON {} (UPPER(\"Cell_name\"), \"Date\");").format(sql.Identifier(f"idx_{table_name}_nombre"), sql.Identifier(table_name)))
+            cur.execute(sql.SQL("CREATE INDEX {} ON {} USING brin (\"Date\") WITH (autosummarize = on);").format(sql.Identifier(f"idx_{table_name}_brin"), sql.Identifier(table_name)))
+            conn.commit()
+            vista_por_hora(conn, table_name, column_definitions)
+        elif table_type == "estados":
+            # El dashboard lee los días de una entidad de un nivel
+            cur.execute(sql.SQL("CREATE INDEX {} ON {} (\"nivel\", \"nombre\", \"Date\");").format(sql.Identifier(f"idx_{table_name}_nombre"), sql.Identifier(table_name)))
+            conn.commit()
         else:
-            # Definir la sentencia SQL para crear el índice compuesto en las columnas de Timestamp y nombre de la celda (Menos tabla de celdas y tabla total)
-            columna2 = column_definitions[1][0]  # Tomo la segunda en la lista y extraigo el nombre
-            create_index_query = sql.SQL("CREATE INDEX {} ON {} (\"Timestamp\", {});").format(sql.Identifier(index_name), sql.Identifier(table_name), sql.Identifier(columna2))
-
-        # print("Consulta crear indice:", create_index_query.as_string(cur))
-
-        cur.execute(create_index_query) # Ejecutar la sentencia SQL para crear el índice
-        conn.commit() # Confirmar los cambios
+            # Tablas horarias: BRIN por hora e índice de cobertura por nombre y hora
+            indices_tabla_horaria(conn, table_name)
         print("Indices de la tabla creados con exito")
         
     else:
@@ -361,6 +522,7 @@ def create_table(table_name, table_type):
     
     return True
 
+@instrumentacion.medir("etl.cargar_datos_postgresql")
 def cargar_datos_postgresql(carpeta, table_name):
     print("Iniciando función de subida a base de datos")
     carpeta_raw = os.path.join(carpeta, "raw_data") # Ruta carpeta donde se encuentra archivo descomprimido
@@ -400,9 +562,10 @@ def cargar_datos_postgresql(carpeta, table_name):
         print("Iniciando consulta COPY")
         for archivo_csv in archivos_csv:
             ruta_archivo = os.path.join(carpeta, archivo_csv)
-            with open(ruta_archivo, 'r') as f:
+            with open(ruta_archivo, 'r') as f, instrumentacion.tiempo_sql():
                 cur.copy_expert(sql=copy_query, file=f)
                 conn.commit()
+            instrumentacion.anotar(filas=max(cur.rowcount, 0), bytes_escritos=os.path.getsize(ruta_archivo))
             print(f"{archivo_csv} terminado")
     else:
         print(f"La tabla {table_name} NO EXISTE")
@@ -410,6 +573,55 @@ def cargar_datos_postgresql(carpeta, table_name):
         conn.commit()
         conn.close()
 
+@instrumentacion.medir("etl.historico_local")
+def guardar_historico_local(archivo, table_name):
+    # Escribe en el histórico local en Parquet (Comun/historico_local.py) el CSV que se acaba de subir a una tabla
+    # horaria. Es opcional, un error aquí no detiene la carga a PostgreSQL
+    try:
+        instrumentacion.anotar(bytes_leidos=os.path.getsize(archivo))
+        df = pd.read_csv(archivo)
+        df["Timestamp"] = kpis_ran.timestamps_unicos(df["Timestamp"])
+        dias = historico_local.escribir(table_name, df, orden=TABLAS_HORARIAS[table_name][0])
+        instrumentacion.anotar(filas=len(df))
+        print(f"Histórico local de {table_name} actualizado: {', '.join(map(str, dias))}")
+    except Exception as e:
+        print(f"Error escribiendo el histórico local de {table_name}: ", e)
+
+def filas_dia_postgresql(cur, table_name, dia):
+    # Filas por hora de un día de una tabla horaria, leídas con COPY. Las celdas se leen de la tabla empaquetada con su función por hora
+    if table_name == "ran_1h_cell":
+        origen = sql.SQL("{}(%s, %s)").format(sql.Identifier(f"{TABLA_CELDAS_DIA}_por_hora"))
+    else:
+        origen = sql.SQL("{} WHERE \"Timestamp\" >= %s AND \"Timestamp\" < %s::date + 1").format(sql.Identifier(table_name))
+    buffer = io.BytesIO()
+    copy_query = sql.SQL("COPY (SELECT * FROM {}) TO STDOUT WITH CSV HEADER").format(origen)
+    with instrumentacion.tiempo_sql():
+        cur.copy_expert(cur.mogrify(copy_query, (dia, dia)).decode(), buffer)
+    buffer.seek(0)
+    df = pd.read_csv(buffer)
+    if not df.empty:
+        df["Timestamp"] = kpis_ran.timestamps_unicos(df["Timestamp"])
+    return df
+
+def historico_local_desde_postgresql(days):
+    # Llena el histórico local con los últimos "days" días que ya están en PostgreSQL. Se corre a mano una vez al
+    # habilitarlo; después el ETL escribe cada día
+    conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+    cur = conn.cursor()
+    hoy = datetime.now().date()
+    for table_name in TABLAS_HORARIAS:
+        for dia in [hoy - timedelta(days=i) for i in range(days, 0, -1)]:
+            if os.path.exists(historico_local.ruta_dia(table_name, dia)):
+                continue
+            df = filas_dia_postgresql(cur, table_name, dia)
+            if df.empty:
+                continue
+            historico_local.escribir(table_name, df, orden=TABLAS_HORARIAS[table_name][0])
+            print(f"Histórico local de {table_name}: {dia} copiado desde PostgreSQL ({len(df)} filas)")
+    cur.close()
+    conn.close()
+
+@instrumentacion.medir("etl.cargar_archivo_postgresql")
 def cargar_archivo_postgresql(conn, archivo, table_name, table_type, columns):
     # Crear un cursor
     cur = conn.cursor()
@@ -426,17 +638,22 @@ def cargar_archivo_postgresql(conn, archivo, table_name, table_type, columns):
         )
 
         # Ejecutar la consulta COPY
-        with open(archivo, 'r') as f:
+        with open(archivo, 'r') as f, instrumentacion.tiempo_sql():
             cur.copy_expert(sql=copy_query, file=f)
             conn.commit()
+        instrumentacion.anotar(filas=max(cur.rowcount, 0), bytes_escritos=os.path.getsize(archivo)) # Filas y bytes enviados a la base de datos
         print(f"Archivo {archivo} subido exitosamente")
 
+        if table_name in TABLAS_HORARIAS and historico_local.escritura_habilitada():
+            guardar_historico_local(archivo, table_name) # Mismos datos en el histórico local
+
         # Cerrar cursor y commit para guardar cambios en la base de datos
         cur.close()
         conn.commit()
     else:
         print(f"Hubo un error relacionado con la creación de la tabla")
 
+@instrumentacion.medir("etl.celdas")
 def celdas(conn, carpeta): # Función que agrega los datos de celda del archivo CSV a la base de datos
     print("Iniciando función que sube info de celdas")
     carpeta_raw = os.path.join(carpeta, "raw_data") # Ruta carpeta donde se encuentra archivo descomprimido
@@ -452,10 +669,74 @@ def celdas(conn, carpeta): # Función que agrega los datos de celda del archivo
     cur.close()
     print("Se terminó de agregar las celdas a la base de datos")
 
-def bit_to_GB(bit):
-    gbyte = bit / (8*10**9)
-    return gbyte
+# Columnas de la tabla de celdas que se guardan en la tabla empaquetada y nombre de esta, que conserva mucha más
+# historia de celdas que ran_1h_cell en el mismo espacio
+COLUMNAS_CELDA_DIA = ["Date", "Cell_name", "Node_name"] + CONTADORES_GESTOR
+TABLA_CELDAS_DIA = "ran_1d_cell"
+
+def subir_empaquetado(conn, df, ruta_temporal):
+    # Empaqueta las filas por hora de celdas (contadores como texto) y las sube a la tabla empaquetada
+    df_dia = empaquetado.empaquetar(df, ["Cell_name", "Node_name"], CONTADORES_GESTOR)
+    df_dia.to_csv(ruta_temporal, index=False)
+    try:
+        cargar_archivo_postgresql(conn, ruta_temporal, TABLA_CELDAS_DIA, "celda_dia", COLUMNAS_CELDA_DIA)
+    finally:
+        os.remove(ruta_temporal)
+    return len(df_dia)
+
+@instrumentacion.medir("etl.celdas_dia")
+def celdas_dia(conn, carpeta): # Función que agrega los datos de celda del archivo CSV a la tabla empaquetada
+    print("Iniciando función que sube celdas empaquetadas por día")
+    carpeta_raw = os.path.join(carpeta, "raw_data") # Ruta carpeta donde se encuentra archivo descomprimido
+    archivos_csv = [archivo for archivo in os.listdir(carpeta_raw) if archivo.endswith('.csv')] # Filtrar los archivos CSV en la carpeta de destino
 
+    for archivo_csv in archivos_csv:
+        ruta_archivo = os.path.join(carpeta_raw, archivo_csv)
+        instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo))
+        # Contadores como texto: se copian tal cual al arreglo, sin parsear ni volver a formatear números
+        df = lectura_paralela.leer_csv(ruta_archivo, dtype={contador: str for contador in CONTADORES_GESTOR})
+        df["Timestamp"] = kpis_ran.timestamps_unicos(df["Timestamp"])
+        filas = subir_empaquetado(conn, df, ruta_archivo[:-4] + ".empaquetado") # Extensión distinta de .csv para que las demás funciones no lo lean
+        print(f"{archivo_csv}: {len(df)} filas por hora empaquetadas en {filas} filas por celda y día")
+
+@instrumentacion.medir("etl.migrar_celdas_dia")
+def migrar_celdas_dia(conn, carpeta, days):
+    # Empaqueta los días de los últimos "days" que están en ran_1h_cell pero no en la tabla empaquetada, para que la
+    # historia anterior a la tabla empaquetada no se pierda cuando equilibrar recorte la tabla por hora. Después de la
+    # primera corrida solo hace una consulta indexada por día
+    print("Iniciando migración de días de celdas a la tabla empaquetada")
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL AND to_regclass(%s) IS NOT NULL", (TABLA_CELDAS_DIA, "ran_1h_cell"))
+    if not cur.fetchone()[0]:
+        print("Las tablas de celdas no existen, no hay días que migrar")
+        cur.close()
+        return
+    columnas = ["Timestamp", "Node_name", "Cell_name"] + CONTADORES_GESTOR
+    hoy = datetime.now().date()
+    for dia in [hoy - timedelta(days=i) for i in range(days, 0, -1)]:
+        with instrumentacion.tiempo_sql():
+            cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE \"Date\" = %s)").format(sql.Identifier(TABLA_CELDAS_DIA)), (dia,))
+            empaquetado_existe = cur.fetchone()[0]
+        if empaquetado_existe:
+            continue
+
+        copy_query = sql.SQL("COPY (SELECT {} FROM \"ran_1h_cell\" WHERE \"Timestamp\" >= %s AND \"Timestamp\" < %s) TO STDOUT WITH CSV HEADER").format(
+            sql.SQL(', ').join(map(sql.Identifier, columnas)))
+        buffer = io.BytesIO()
+        with instrumentacion.tiempo_sql():
+            cur.copy_expert(cur.mogrify(copy_query, (dia, dia + timedelta(days=1))).decode(), buffer)
+        instrumentacion.anotar(bytes_leidos=buffer.tell())
+        buffer.seek(0)
+        df = pd.read_csv(buffer, dtype={contador: str for contador in CONTADORES_GESTOR}, keep_default_na=False, na_values=[""])
+        if df.empty:
+            continue
+
+        df["Timestamp"] = kpis_ran.timestamps_unicos(df["Timestamp"])
+        filas = subir_empaquetado(conn, df, os.path.join(carpeta, "raw_data", f"migracion_{dia}.empaquetado"))
+        print(f"Día {dia} migrado: {len(df)} filas por hora en {filas} filas por celda y día")
+    cur.close()
+
+@instrumentacion.medir("etl.raw_to_kpi")
 def raw_to_kpi(conn, carpeta):
     print("Iniciando función de agregación de KPIs")
     carpeta_raw = os.path.join(carpeta, "raw_data") # Ruta carpeta donde se encuentra archivo descomprimido
@@ -463,36 +744,38 @@ def raw_to_kpi(conn, carpeta):
     
     for archivo_csv in archivos_csv:
         ruta_archivo = os.path.join(carpeta_raw, archivo_csv)
+        instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
         df_raw = pd.read_csv(ruta_archivo, 
                              usecols=["Timestamp","Cell_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                              ) # Leer el archivo CSV y cargarlo en un DataFrame
         df_raw["Cell_name"] = df_raw["Cell_name"].str.upper() # Valores a mayusculas
-        df_raw["Timestamp"] = pd.to_datetime(df_raw["Timestamp"]) # Convertir la columna 'Timestamp' a formato datetime
+        df_raw["Timestamp"] = kpis_ran.timestamps_unicos(df_raw["Timestamp"]) # Convertir la columna 'Timestamp' a datetime, un parseo por hora distinta
 
         # Encontrar hora pico (BH)
-        bh_day = df_raw.groupby(["Cell_name"])["L.Traffic.ActiveUser.DL.Avg"].idxmax() # Agrupo los datos por nombre de celda y luego encuentro las horas donde los usuarios son máximos
-        bh_df = df_raw.loc[bh_day].reset_index(drop=True) # Creo un nuevo df con las horas pico por día
+        celdas_codigo = kpis_ran.codigos_grupo(df_raw["Cell_name"]) # El archivo es de un solo día, se agrupa solo por celda
+        bh_day = kpis_ran.hora_pico(celdas_codigo, df_raw["L.Traffic.ActiveUser.DL.Avg"]) # Encuentro las horas donde los usuarios son máximos por celda
+        bh_df = df_raw.iloc[bh_day].reset_index(drop=True) # Creo un nuevo df con las horas pico por día
         bh_df.insert(0, "Date", bh_df['Timestamp'].dt.date) # Crear columna con días
         bh_df.insert(1, "BH", bh_df['Timestamp'].dt.time) # Crear columna con días
         bh_df = bh_df.rename(columns={"L.Traffic.ActiveUser.DL.Avg":"avg_users_BH"})
         bh_df = bh_df.drop(columns=["Timestamp","L.Traffic.ActiveUser.DL.Max"])
 
         # Ocupación PRBs
-        bh_df["PRBusage_BH_DL"] = (bh_df["L.ChMeas.PRB.DL.Used.Avg"] / bh_df["L.ChMeas.PRB.DL.Avail"]) * 100 # Cálculo de % ocupación en downlink y guardado en nueva columna
-        bh_df["PRBusage_BH_UL"] = (bh_df["L.ChMeas.PRB.UL.Used.Avg"] / bh_df["L.ChMeas.PRB.UL.Avail"]) * 100 # Cálculo de % ocupación en uplink y guardado en nueva columna
+        bh_df["PRBusage_BH_DL"] = kpis_ran.uso_prb(bh_df["L.ChMeas.PRB.DL.Used.Avg"], bh_df["L.ChMeas.PRB.DL.Avail"]) # Cálculo de % ocupación en downlink y guardado en nueva columna
+        bh_df["PRBusage_BH_UL"] = kpis_ran.uso_prb(bh_df["L.ChMeas.PRB.UL.Used.Avg"], bh_df["L.ChMeas.PRB.UL.Avail"]) # Cálculo de % ocupación en uplink y guardado en nueva columna
         bh_df = bh_df.drop(columns=["L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.ChMeas.PRB.UL.Avail"])
 
         # Traffic bh
-        bh_df["traffic_bh(GB)"] = bh_df["L.Thrp.bits.DL(bit)"].apply(bit_to_GB) # Conversión de bit a GB
+        bh_df["traffic_bh(GB)"] = kpis_ran.bits_a_gb(bh_df["L.Thrp.bits.DL(bit)"]) # Conversión de bit a GB
 
         # User experience
-        bh_df["uexp_BH(Mbps)"] = ((bh_df["L.Thrp.bits.DL(bit)"]-bh_df["L.Thrp.bits.DL.LastTTI(bit)"]) / (bh_df["L.Thrp.Time.DL.RmvLastTTI(ms)"])) / 1024 # Calculo user experience
+        bh_df["uexp_BH(Mbps)"] = kpis_ran.experiencia_usuario(bh_df["L.Thrp.bits.DL(bit)"], bh_df["L.Thrp.bits.DL.LastTTI(bit)"], bh_df["L.Thrp.Time.DL.RmvLastTTI(ms)"]) # Calculo user experience
         bh_df = bh_df.drop(columns=["L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"])
 
         # BH users_max
         df_raw_max = df_raw[["Timestamp","Cell_name","L.Traffic.ActiveUser.DL.Max"]].copy()
-        max_bh = df_raw_max.groupby(["Cell_name"])["L.Traffic.ActiveUser.DL.Max"].idxmax() # Agrupo los datos por nombre de celda y luego encuentro las horas donde los usuarios son máximos
-        max_df = df_raw_max.loc[max_bh].reset_index(drop=True) # Creo un nuevo df con las horas pico por día
+        max_bh = kpis_ran.hora_pico(celdas_codigo, df_raw_max["L.Traffic.ActiveUser.DL.Max"]) # Encuentro las horas donde los usuarios máximos son máximos por celda
+        max_df = df_raw_max.iloc[max_bh].reset_index(drop=True) # Creo un nuevo df con las horas pico por día
         max_df.insert(1, "max_users_hour", max_df['Timestamp'].dt.time) # Crear columna con días
         max_df = max_df.drop(columns=["Timestamp"]) # Eliminar columna que ya no necesito
         max_df = max_df.rename(columns={"L.Traffic.ActiveUser.DL.Max":"daily_max_users"}) # Renombrar columna
@@ -501,14 +784,14 @@ def raw_to_kpi(conn, carpeta):
 
         # traffic avg
         trff_avg_df = df_raw.groupby(["Cell_name"])["L.Thrp.bits.DL(bit)"].mean().reset_index() # Promedio del tráfico de cada hora del día
-        trff_avg_df["traffic_avg(GB)"] = trff_avg_df["L.Thrp.bits.DL(bit)"].apply(bit_to_GB) # Conversion de bit a GB
+        trff_avg_df["traffic_avg(GB)"] = kpis_ran.bits_a_gb(trff_avg_df["L.Thrp.bits.DL(bit)"]) # Conversion de bit a GB
         trff_avg_df = trff_avg_df.drop(columns=["L.Thrp.bits.DL(bit)"]) # Eliminar columna que ya no necesito
         # print("trff_avg\n",trff_avg_df)
         bh_df = bh_df.merge(trff_avg_df,how="left",on="Cell_name")
 
         # traffic sum
         trff_sum_df = df_raw.groupby(["Cell_name"])["L.Thrp.bits.DL(bit)"].sum().reset_index() # Suma del tráfico de cada hora del día
-        trff_sum_df["traffic_total(GB)"] = trff_sum_df["L.Thrp.bits.DL(bit)"].apply(bit_to_GB) # Conversion de bit a GB
+        trff_sum_df["traffic_total(GB)"] = kpis_ran.bits_a_gb(trff_sum_df["L.Thrp.bits.DL(bit)"]) # Conversion de bit a GB
         trff_sum_df = trff_sum_df.drop(columns=["L.Thrp.bits.DL(bit)"]) # Eliminar columna que ya no necesito
         # print("trff_total\n",trff_sum_df)
         bh_df = bh_df.merge(trff_sum_df,how="left",on="Cell_name")
@@ -525,6 +808,7 @@ def raw_to_kpi(conn, carpeta):
         
     print("Se terminó de agregar los KPIs diarios con exito")
 
+@instrumentacion.medir("etl.sectores")
 def sectores(conn, carpeta, df_geo): # Función que agrega sectores desde el archivo de celdas
     print("Iniciando función agregación sectores")
     df_geo = df_geo[["dwh_cell_name_wom","sector_name"]].copy() # Hago copia del df solo con las columnas que necesito
@@ -533,6 +817,7 @@ def sectores(conn, carpeta, df_geo): # Función que agrega sectores desde el arc
     
     for archivo_csv in archivos_csv:
         ruta_archivo = os.path.join(carpeta_raw, archivo_csv)
+        instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
         df_day = pd.read_csv(ruta_archivo, 
                              usecols=["Timestamp","Cell_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                              ) # Leer el archivo CSV y cargarlo en un DataFrame
@@ -550,6 +835,7 @@ def sectores(conn, carpeta, df_geo): # Función que agrega sectores desde el arc
     
     print("Se terminó de agregar los sectores con exito")
 
+@instrumentacion.medir("etl.nodos")
 def nodos(conn, carpeta): # Función que agrega nodos desde archivo de celdas
     print("Iniciando función agregación nodos")
     carpeta_raw = os.path.join(carpeta, "raw_data") # Ruta carpeta donde se encuentra archivo descomprimido
@@ -557,6 +843,7 @@ def nodos(conn, carpeta): # Función que agrega nodos desde archivo de celdas
 
     for archivo_csv in archivos_csv:
         ruta_archivo = os.path.join(carpeta_raw, archivo_csv)
+        instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
         df_day = pd.read_csv(ruta_archivo, 
                              usecols=["Timestamp","Node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                              ) # Leer el archivo CSV y cargarlo en un DataFrame
@@ -572,12 +859,14 @@ def nodos(conn, carpeta): # Función que agrega nodos desde archivo de celdas
 
     print("Se terminó de agregar los nodos con exito")
 
+@instrumentacion.medir("etl.cluster")
 def cluster(conn, carpeta, df_geo): # Función que agrega cluster desde archivo de nodos
     print("Iniciando función agregación clusters")
     df_geo = df_geo[["node_name", "cluster_key"]].copy() # Hago copia del df solo con las columnas que necesito
     df_geo = df_geo.drop_duplicates(subset="node_name")
 
     ruta_archivo = os.path.join(carpeta, "node_temp.csv")
+    instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
     df_day = pd.read_csv(ruta_archivo, 
                             usecols=["Timestamp","node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                             ) # Leer el archivo CSV y cargarlo en un DataFrame
@@ -606,6 +895,7 @@ def comprobacion_localidad(row): # Función para verificar si el código de loca
     else:
         return False
 
+@instrumentacion.medir("etl.localidad")
 def localidad(conn, carpeta, df_geo): # Función que agrega localidades desde archivo de nodos
     print("Iniciando función agregación localidades")
     df_geo = df_geo[["node_name","dwh_dane_cod_localidad","dane_code"]].copy() # Hago copia del df solo con las columnas que necesito
@@ -617,6 +907,7 @@ def localidad(conn, carpeta, df_geo): # Función que agrega localidades desde ar
     df_geo = df_geo.drop(columns=["dane_code"]) # Eliminar columna que ya no es necesaria
 
     ruta_archivo = os.path.join(carpeta, "node_temp.csv")
+    instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
     df_day = pd.read_csv(ruta_archivo, 
                             usecols=["Timestamp","node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                             ) # Leer el archivo CSV y cargarlo en un DataFrame
@@ -634,6 +925,7 @@ def localidad(conn, carpeta, df_geo): # Función que agrega localidades desde ar
 
     print("Se terminó de agregar las localidades con exito")
 
+@instrumentacion.medir("etl.municipio")
 def municipio(conn, carpeta, df_geo):
     print("Iniciando función agregación municipios")
     df_geo = df_geo[["node_name", "dane_code"]].copy() # Hago copia del df solo con las columnas que necesito
@@ -641,6 +933,7 @@ def municipio(conn, carpeta, df_geo):
     df_geo = df_geo.drop_duplicates(subset="node_name")
 
     ruta_archivo = os.path.join(carpeta, "node_temp.csv")
+    instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
     df_day = pd.read_csv(ruta_archivo, 
                             usecols=["Timestamp","node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                             ) # Leer el archivo CSV y cargarlo en un DataFrame
@@ -658,6 +951,7 @@ def municipio(conn, carpeta, df_geo):
 
     print("Se terminó de agregar los municipios con exito")
 
+@instrumentacion.medir("etl.am")
 def am(conn, carpeta, df_geo):
     print("Iniciando función agregación areas metropolitanas")
     df_geo = df_geo[["node_name", "AM"]].copy() # Hago copia del df solo con las columnas que necesito
@@ -666,6 +960,7 @@ def am(conn, carpeta, df_geo):
 
 
     ruta_archivo = os.path.join(carpeta, "node_temp.csv")
+    instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
     df_day = pd.read_csv(ruta_archivo, 
                             usecols=["Timestamp","node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                             ) # Leer el archivo CSV y cargarlo en un DataFrame
@@ -682,6 +977,7 @@ def am(conn, carpeta, df_geo):
 
     print("Se terminó de agregar las areas_metros con exito")
 
+@instrumentacion.medir("etl.departamento")
 def departamento(conn, carpeta, df_geo):
     print("Iniciando función agregación departamentos")
     df_geo = df_geo[["node_name", "dane_code_dpto"]].copy() # Hago copia del df solo con las columnas que necesito
@@ -689,6 +985,7 @@ def departamento(conn, carpeta, df_geo):
     df_geo = df_geo.drop_duplicates(subset="node_name")
 
     ruta_archivo = os.path.join(carpeta, "node_temp.csv")
+    instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
     df_day = pd.read_csv(ruta_archivo, 
                             usecols=["Timestamp","node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                             ) # Leer el archivo CSV y cargarlo en un DataFrame
@@ -706,12 +1003,14 @@ def departamento(conn, carpeta, df_geo):
 
     print("Se terminó de agregar los departamentos con exito")
 
+@instrumentacion.medir("etl.regional")
 def regional(conn, carpeta, df_geo):
     print("Iniciando función agregación regional")
     df_geo = df_geo[["node_name", "wom_regional"]].copy() # Hago copia del df solo con las columnas que necesito
     df_geo = df_geo.drop_duplicates(subset="node_name")
 
     ruta_archivo = os.path.join(carpeta, "node_temp.csv")
+    instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
     df_day = pd.read_csv(ruta_archivo, 
                             usecols=["Timestamp","node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                             ) # Leer el archivo CSV y cargarlo en un DataFrame
@@ -728,10 +1027,12 @@ def regional(conn, carpeta, df_geo):
 
     print("Se terminó de agregar las regiones con exito")
 
+@instrumentacion.medir("etl.total")
 def total(conn, carpeta):
     print("Iniciando función agregación total de la red")
 
     ruta_archivo = os.path.join(carpeta, "node_temp.csv")
+    instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
     df_day = pd.read_csv(ruta_archivo, 
                             usecols=["Timestamp","node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.Traffic.ActiveUser.UL.Avg","L.Traffic.ActiveUser.UL.Max","L.Traffic.User.Avg","L.Traffic.User.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.UL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
                             ) # Leer el archivo CSV y cargarlo en un DataFrame
@@ -747,6 +1048,78 @@ def total(conn, carpeta):
 
     print("Se terminó de agregar la totalida de la red con exito")
 
+# Estados combinables por entidad y día (Comun/estados_kpi.py). Nivel del dashboard -> (columna de df_geo con la clave
+# de cada nodo, si la clave es un código DANE entero)
+TABLA_ESTADOS = estados_kpi.TABLA
+NIVELES_NODO = {
+    "cluster": ("cluster_key", False),
+    "localidad": ("dwh_dane_cod_localidad", True),
+    "municipio": ("dane_code", True),
+    "AM": ("AM", False),
+    "departamento": ("dane_code_dpto", True),
+    "regional": ("wom_regional", False)
+}
+
+def nodos_nivel(df_geo, nivel):
+    # Nodo -> clave del nivel, con los mismos filtros que cluster() a regional()
+    columna, codigo = NIVELES_NODO[nivel]
+    if nivel == "localidad":
+        df_geo = df_geo[df_geo[columna] != -1]
+        df_geo = df_geo[df_geo.apply(comprobacion_localidad, axis=1)]
+    elif codigo:
+        df_geo = df_geo[df_geo[columna] != -1]
+    elif nivel == "AM":
+        df_geo = df_geo[df_geo[columna] != "Sin AM"]
+    return df_geo[["node_name", columna]].drop_duplicates(subset="node_name")
+
+@instrumentacion.medir("etl.estados")
+def estados_agregados(conn, carpeta, df_geo):
+    # Estados de ocupación de PRBs y experiencia de usuario de las celdas-hora por entidad y día de cada nivel. Sector y
+    # nodo se calculan desde las celdas del CSV; los niveles superiores y el total combinan los estados de sus nodos,
+    # sin volver a recorrer las celdas
+    print("Iniciando función de estados por día")
+    df_sectores = df_geo[["dwh_cell_name_wom", "sector_name"]].drop_duplicates(subset="dwh_cell_name_wom")
+    carpeta_raw = os.path.join(carpeta, "raw_data") # Ruta carpeta donde se encuentra archivo descomprimido
+    archivos_csv = [archivo for archivo in os.listdir(carpeta_raw) if archivo.endswith('.csv')] # Filtrar los archivos CSV en la carpeta de destino
+
+    partes_sector = []
+    partes_nodo = []
+    for archivo_csv in archivos_csv:
+        ruta_archivo = os.path.join(carpeta_raw, archivo_csv)
+        instrumentacion.anotar(bytes_leidos=os.path.getsize(ruta_archivo)) # Tamaño del CSV que se va a leer
+        df_day = pd.read_csv(ruta_archivo,
+                             usecols=["Timestamp","Node_name","Cell_name","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
+                             ) # Leer el archivo CSV y cargarlo en un DataFrame
+        df_day["Date"] = kpis_ran.timestamps_unicos(df_day["Timestamp"]).astype("datetime64[D]").astype("datetime64[ns]")
+        df_day["Cell_name"] = df_day["Cell_name"].str.upper() # Valores a mayusculas
+        df_day["Node_name"] = df_day["Node_name"].str.upper()
+        df_day = df_day.merge(df_sectores, left_on="Cell_name", right_on="dwh_cell_name_wom", how="left")
+        partes_sector.append(estados_kpi.estados(df_day, ["Date", "sector_name"]))
+        partes_nodo.append(estados_kpi.estados(df_day, ["Date", "Node_name"]))
+
+    if not partes_nodo:
+        print("No hay celdas para calcular estados")
+        return
+
+    # Un mismo día puede venir en varios CSV, sus estados se combinan
+    df_sector = estados_kpi.combinar(pd.concat(partes_sector, ignore_index=True), ["Date", "sector_name"])
+    df_nodos = estados_kpi.combinar(pd.concat(partes_nodo, ignore_index=True), ["Date", "Node_name"])
+    df_nodos.rename(columns={"Node_name": "node_name"}, inplace=True)
+    niveles = [estados_kpi.a_tabla(df_sector, "sector", "sector_name"), estados_kpi.a_tabla(df_nodos, "EB", "node_name")]
+    for nivel, (columna, codigo) in NIVELES_NODO.items():
+        df_nivel = df_nodos.merge(nodos_nivel(df_geo, nivel), on="node_name", how="inner")
+        df_nivel = estados_kpi.combinar(df_nivel, ["Date", columna])
+        if codigo:
+            df_nivel[columna] = df_nivel[columna].astype(int)
+        niveles.append(estados_kpi.a_tabla(df_nivel, nivel, columna))
+    niveles.append(estados_kpi.a_tabla(estados_kpi.combinar(df_nodos, ["Date"]), "total", None))
+
+    nueva_ruta = os.path.join(carpeta, "estados_temp.csv")
+    pd.concat(niveles, ignore_index=True).to_csv(nueva_ruta, index=False)
+    cargar_archivo_postgresql(conn, nueva_ruta, TABLA_ESTADOS, "estados", estados_kpi.COLUMNAS_TABLA) # Llamado a función que sube el archivo a la base de datos
+
+    print("Se terminó de agregar los estados por día con exito")
+
 def area_metro(cell_name):
     # Diccionario de áreas metropolitanas
     areas_metropolitanas = {
@@ -784,6 +1157,7 @@ def area_metro(cell_name):
     identificador_ciudad = cell_name.split()[0]  # Asume que el identificador de ciudad es la primera palabra
     return areas_metropolitanas.get(identificador_ciudad, 'Sin AM')
 
+@instrumentacion.medir("etl.query_geodata")
 def query_geodata(): # Función para hacer query desde la base de datos de Sergio
     # Conectar a la base de datos PostgreSQL
     conn = psycopg2.connect(**DBcredentials.BD_GEO_PARAMS)
@@ -794,8 +1168,10 @@ def query_geodata(): # Función para hacer query desde la base de datos de Sergi
             FROM bodega_analitica.roaming_cell_dim 
             WHERE dwh_operador_rat = 'WOM 4G' LIMIT 100000"""
 
-    cur.execute(query) # Ejecutar la consulta
-    datos = cur.fetchall() # Almacenar todas las filas de la consulta en esta variable
+    with instrumentacion.tiempo_sql():
+        cur.execute(query) # Ejecutar la consulta
+        datos = cur.fetchall() # Almacenar todas las filas de la consulta en esta variable
+    instrumentacion.anotar(filas=len(datos))
     columnas = [desc[0] for desc in cur.description]  # Obtener los nombres de las columnas
 
     cur.close()
@@ -819,63 +1195,554 @@ def query_geodata(): # Función para hacer query desde la base de datos de Sergi
 
     return df_geo
 
+def tabla_archivo(table_name):
+    # Tabla horaria del archivo frío donde se guardan las filas que equilibrar borra de table_name, o None si no se archiva.
+    # Las celdas se archivan cuando salen de la tabla empaquetada, la horaria de 7 días solo repite sus últimos días,
+    # y ran_kpi_cell guarda 19 años, más que cualquier consulta del dashboard
+    if table_name == TABLA_CELDAS_DIA:
+        return "ran_1h_cell"
+    if table_name in TABLAS_HORARIAS and table_name != "ran_1h_cell":
+        return table_name
+    return None
+
+@instrumentacion.medir("etl.archivar")
+def archivar(conn, table_name, cutoff_date):
+    # Exporta al archivo frío, un día a la vez, las filas anteriores al corte que equilibrar va a borrar. Los días ya
+    # archivados se saltan, así un equilibrio que falló después de archivar no repite el trabajo. Devuelve False si algo
+    # falló, en ese caso no se borra nada
+    tabla = tabla_archivo(table_name)
+    columna = columna_fecha(table_name)
+    cur = conn.cursor()
+    try:
+        dias_query = sql.SQL("SELECT DISTINCT {}::date FROM {} WHERE {} < %s ORDER BY 1").format(
+            sql.Identifier(columna), sql.Identifier(table_name), sql.Identifier(columna))
+        with instrumentacion.tiempo_sql():
+            cur.execute(dias_query, (cutoff_date,))
+        for (dia,) in cur.fetchall():
+            if archivo_frio.archivado(tabla, dia):
+                continue
+            df = filas_dia_postgresql(cur, tabla, dia)
+            if not df.empty:
+                archivo_frio.archivar(tabla, df, orden=TABLAS_HORARIAS[tabla][0])
+                instrumentacion.anotar(filas=len(df))
+            print(f"Archivo frío de {tabla}: {dia} archivado ({len(df)} filas)")
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error archivando {table_name}, no se borran sus filas: ", e)
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+
+@instrumentacion.medir("etl.equilibrar")
 def equilibrar(conn, days, table_name):
     print(f"Iniciando equilibrio de filas para la tabla {table_name}")
-    cur = conn.cursor()
     # Definir dia de corte
     cutoff_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
     print(f"Día de corte {cutoff_date}")
-    if table_name == "ran_kpi_cell":
-        # Borrar datos anteriores a este dia para la tabla de KPIs
-        delete_query = sql.SQL("DELETE FROM {} WHERE \"Date\" < %s").format(sql.Identifier(table_name))
-    else:
-        # Borrar datos anteriores a este dia para el resto de tablas
-        delete_query = sql.SQL("DELETE FROM {} WHERE \"Timestamp\" < %s").format(sql.Identifier(table_name))
+    if tabla_archivo(table_name) is not None and archivo_frio.escritura_habilitada():
+        if not archivar(conn, table_name, cutoff_date):
+            return
+    cur = conn.cursor()
+    # Borrar datos anteriores a este dia
+    delete_query = sql.SQL("DELETE FROM {} WHERE {} < %s").format(sql.Identifier(table_name), sql.Identifier(columna_fecha(table_name)))
 
-    cur.execute(delete_query, (cutoff_date,))
+    with instrumentacion.tiempo_sql():
+        cur.execute(delete_query, (cutoff_date,))
+        instrumentacion.anotar(filas=max(cur.rowcount, 0))
     conn.commit()
     print(f"Filas equilibradas en {table_name}, se conservaron los ultimos {days} días")
 
+@instrumentacion.medir("etl.indices_ranking")
+def indices_ranking(conn):
+    # Índice para el ranking de celdas del dashboard: filtra por fecha e incluye las columnas de KPI en BH, así el
+    # ranking se resuelve leyendo solo el índice. Se crea con CONCURRENTLY para no bloquear las escrituras de
+    # ran_kpi_cell mientras se construye, lo que exige correr fuera de una transacción. Si una creación anterior se
+    # interrumpió queda un índice inválido que IF NOT EXISTS no reemplaza, por eso primero se borra
+    index_name = "idx_ran_kpi_cell_ranking"
+    cur = conn.cursor()
+    create_index_query = sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} (\"Date\") INCLUDE ({})").format(
+        sql.Identifier(index_name), sql.Identifier("ran_kpi_cell"),
+        sql.SQL(', ').join(map(sql.Identifier, ["cell_name", "avg_users_BH", "PRBusage_BH_DL", "traffic_bh(GB)", "uexp_BH(Mbps)"])))
+    conn.commit()
+    conn.autocommit = True # CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción
+    try:
+        with instrumentacion.tiempo_sql():
+            cur.execute("SELECT NOT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass(%s)", (index_name,))
+            fila = cur.fetchone()
+            if fila is not None and fila[0]:
+                print(f"Indice {index_name} invalido, se vuelve a crear")
+                cur.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(index_name)))
+            cur.execute(create_index_query)
+    finally:
+        conn.autocommit = False
+    cur.close()
+    print("Indice de ranking de la tabla de KPIs verificado")
+
+def columna_fecha(table_name):
+    # Las tablas con una fila por día se filtran por "Date", el resto por "Timestamp"
+    return "Date" if table_name in ("ran_kpi_cell", TABLA_CELDAS_DIA, TABLA_ESTADOS) else "Timestamp"
+
+# Puntos de control de la carga diaria: cada etapa de tablas_agregaciones que termina queda en etl_etapas con la suma
+# del archivo que cargó y las filas y suma de lo que dejó en su tabla. Si Airflow reintenta load_task, las etapas que
+# ya terminaron con el mismo archivo y cuya salida sigue igual se omiten, y el reintento empieza en la que falló
+TAM_BLOQUE_SUMA = 1024 * 1024 # Bytes leídos por vez al calcular la suma del archivo
+
+def lote_carga(carpeta):
+    # Días que trae el archivo del gestor y suma CRC32 de su contenido ya arreglado. El primer día es la fecha de la
+    # corrida en etl_etapas y la suma distingue un reintento de la entrega corregida del mismo día
+    carpeta_raw = os.path.join(carpeta, "raw_data") # Ruta carpeta donde se encuentra archivo descomprimido
+    archivos_csv = sorted(archivo for archivo in os.listdir(carpeta_raw) if archivo.endswith('.csv')) # Filtrar los archivos CSV en la carpeta de destino
+    dias = set()
+    suma = 0
+    for archivo_csv in archivos_csv:
+        ruta_archivo = os.path.join(carpeta_raw, archivo_csv)
+        with open(ruta_archivo, 'rb') as f:
+            for bloque in iter(lambda: f.read(TAM_BLOQUE_SUMA), b""):
+                suma = zlib.crc32(bloque, suma)
+        df = pd.read_csv(ruta_archivo, usecols=["Timestamp"])
+        dias.update(pd.to_datetime(df["Timestamp"].unique()).date) # Se parsean solo las horas distintas
+    dias = sorted(dias)
+    return (dias[0] if dias else None), dias, suma
+
+def crear_tabla_etapas(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS "etl_etapas" (
+            "fecha" DATE, "etapa" VARCHAR, "suma_entrada" BIGINT, "filas" BIGINT, "suma_salida" BIGINT, "terminada" TIMESTAMP,
+            PRIMARY KEY ("fecha", "etapa")
+        )""")
+    conn.commit()
+    cur.close()
+
+def borrar_dias(conn, table_name, dias):
+    # Borra los días de la tabla sin confirmar: se confirma junto con el COPY de la etapa. Quita lo que dejó un intento
+    # anterior que falló a mitad de la etapa o lo que ya subieron los microlotes de esos días
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass(%s)", (table_name,))
+    if cur.fetchone()[0] is not None:
+        columna = sql.Identifier(columna_fecha(table_name))
+        delete_query = sql.SQL("DELETE FROM {} WHERE {} >= %s AND {} < %s::date + 1").format(sql.Identifier(table_name), columna, columna)
+        for dia in dias:
+            with instrumentacion.tiempo_sql():
+                cur.execute(delete_query, (dia, dia))
+    cur.close()
+
+def salida_etapa(conn, table_name, dias):
+    # Filas y suma de verificación de lo que hay en la tabla para los días del lote. La suma de hashtext de cada fila
+    # completa no depende del orden, cambia si se pierde, duplica o modifica una fila
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass(%s)", (table_name,))
+    if cur.fetchone()[0] is None:
+        cur.close()
+        return 0, 0
+    columna = sql.Identifier(columna_fecha(table_name))
+    query = sql.SQL("SELECT COUNT(*), COALESCE(SUM(hashtext(t::text)), 0) FROM {} t WHERE {} >= %s AND {} < %s::date + 1").format(
+        sql.Identifier(table_name), columna, columna)
+    with instrumentacion.tiempo_sql():
+        cur.execute(query, (dias[0], dias[-1]))
+        filas, suma = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return filas, int(suma)
+
+def correr_etapa(conn, lote, etapa, table_name, funcion, *args, archivo=None):
+    # Corre una etapa de la carga diaria que escribe en table_name, salvo que ya haya terminado con el mismo archivo y
+    # su salida siga igual. archivo es un archivo intermedio que usan etapas siguientes (node_temp.csv): si ya no
+    # existe, la etapa se repite para volver a generarlo
+    fecha, dias, suma_entrada = lote
+    cur = conn.cursor()
+    cur.execute('SELECT "suma_entrada", "filas", "suma_salida" FROM "etl_etapas" WHERE "fecha" = %s AND "etapa" = %s', (fecha, etapa))
+    previa = cur.fetchone()
+    conn.commit()
+    if previa is not None and previa[0] == suma_entrada and (archivo is None or os.path.exists(archivo)):
+        if salida_etapa(conn, table_name, dias) == tuple(previa[1:]):
+            print(f"Etapa {etapa} del {fecha} ya completada, se omite")
+            return
+        print(f"La salida de la etapa {etapa} cambió desde que terminó, se repite")
+
+    borrar_dias(conn, table_name, dias)
+    funcion(conn, *args)
+    filas, suma_salida = salida_etapa(conn, table_name, dias)
+    cur.execute("""
+        INSERT INTO "etl_etapas" ("fecha", "etapa", "suma_entrada", "filas", "suma_salida", "terminada") VALUES (%s, %s, %s, %s, %s, NOW())
+        ON CONFLICT ("fecha", "etapa") DO UPDATE SET "suma_entrada" = EXCLUDED."suma_entrada", "filas" = EXCLUDED."filas",
+            "suma_salida" = EXCLUDED."suma_salida", "terminada" = EXCLUDED."terminada"
+        """, (fecha, etapa, suma_entrada, filas, suma_salida))
+    conn.commit()
+    cur.close()
+    print(f"Etapa {etapa} del {fecha} completada: {filas} filas en {table_name}")
+
+@instrumentacion.medir("etl.tablas_agregaciones")
 def tablas_agregaciones(carpeta):
     # Conectar a la base de datos PostgreSQL
     conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s)", (BLOQUEO_CARGA,)) # Espera a que termine un microlote en curso, se libera al cerrar la conexión
+    cur.close()
+
+    crear_tabla_etapas(conn)
+    lote = lote_carga(carpeta)
+    if lote[0] is None:
+        print("No hay datos para cargar")
+        conn.close()
+        return
+    print(f"Carga de los días {', '.join(map(str, lote[1]))}, suma del archivo {lote[2]}")
 
-    celdas(conn, carpeta) # Función que agrega data de celdas a la BD
-    equilibrar(conn, 100, "ran_1h_cell") # Función que asegura que siempre haya 100 días de histórico, poco más de 20 GB
+    correr_etapa(conn, lote, "celdas", "ran_1h_cell", celdas, carpeta) # Función que agrega data de celdas a la BD
+    correr_etapa(conn, lote, "celdas_dia", TABLA_CELDAS_DIA, celdas_dia, carpeta) # Mismas celdas en la tabla empaquetada, que es la que lee el dashboard
+    migrar_celdas_dia(conn, carpeta, 100) # Días de la tabla por hora que aún no están empaquetados
+    equilibrar(conn, 7, "ran_1h_cell") # Por hora solo se necesitan los días de los snapshots del mapa
+    equilibrar(conn, 200, TABLA_CELDAS_DIA) # Empaquetada ocupa menos de la mitad por celda y día: 200 días en lo que antes eran 100
 
-    raw_to_kpi(conn, carpeta) # Función que calcula KPIs y sube datos a la tabla de KPIs
+    correr_etapa(conn, lote, "raw_to_kpi", "ran_kpi_cell", raw_to_kpi, carpeta) # Función que calcula KPIs y sube datos a la tabla de KPIs
     equilibrar(conn, 6840, "ran_kpi_cell") # 6840 dias son 19 años y menos de 20 GB
+    indices_ranking(conn)
 
     df_geo = query_geodata() # Dataframe a partir del baseline de la BD
 
-    sectores(conn, carpeta, df_geo)
+    correr_etapa(conn, lote, "sectores", "ran_1h_sector", sectores, carpeta, df_geo)
     equilibrar(conn, 210, "ran_1h_sector") # 210 dias serian poco más de 20 GB
 
-    nodos(conn,carpeta)
+    correr_etapa(conn, lote, "nodos", "ran_1h_node", nodos, carpeta, archivo=os.path.join(carpeta, "node_temp.csv")) # Las demás agregaciones leen node_temp.csv
     equilibrar(conn, 617, "ran_1h_node") # 617 dias serian poco más de 20 GB
 
-    cluster(conn, carpeta, df_geo)
+    correr_etapa(conn, lote, "cluster", "ran_1h_cluster", cluster, carpeta, df_geo)
     equilibrar(conn, 5163, "ran_1h_cluster") # 5163 dias serian poco más de 20 GB
 
-    localidad(conn, carpeta, df_geo)
+    correr_etapa(conn, lote, "localidad", "ran_1h_localidad", localidad, carpeta, df_geo)
     equilibrar(conn, 6840, "ran_1h_localidad") # 6840 dias son 19 años y menos de 20 GB
 
-    municipio(conn, carpeta, df_geo)
+    correr_etapa(conn, lote, "municipio", "ran_1h_municipio", municipio, carpeta, df_geo)
     equilibrar(conn, 6840, "ran_1h_municipio") # 6840 dias son 19 años y menos de 20 GB
 
-    am(conn, carpeta, df_geo)
+    correr_etapa(conn, lote, "am", "ran_1h_am", am, carpeta, df_geo)
     equilibrar(conn, 6840, "ran_1h_am") # 6840 dias son 19 años y menos de 20 GB
 
-    departamento(conn, carpeta, df_geo)
+    correr_etapa(conn, lote, "departamento", "ran_1h_departamento", departamento, carpeta, df_geo)
     equilibrar(conn, 6840, "ran_1h_departamento") # 6840 dias son 19 años y menos de 20 GB
 
-    regional(conn, carpeta, df_geo)
+    correr_etapa(conn, lote, "regional", "ran_1h_regional", regional, carpeta, df_geo)
     equilibrar(conn, 6840, "ran_1h_regional") # 6840 dias son 19 años y menos de 20 GB
 
-    total(conn, carpeta)
+    correr_etapa(conn, lote, "total", "ran_1h_total", total, carpeta)
     equilibrar(conn, 6840, "ran_1h_total") # 6840 dias son 19 años y menos de 20 GB
 
+    correr_etapa(conn, lote, "estados", TABLA_ESTADOS, estados_agregados, carpeta, df_geo) # Estados combinables por día de todos los niveles
+    equilibrar(conn, 730, TABLA_ESTADOS) # Dos años; la fila con los dos histogramas ocupa cerca de 1 KB y los sectores son la mayoría
+
+    mantener_indices(conn) # BRIN con las páginas del día y mapa de visibilidad al día para las lecturas solo del índice
+
+    if historico_local.escritura_habilitada():
+        for table_name in TABLAS_HORARIAS:
+            historico_local.recortar(table_name, historico_local.RETENCION_DIAS)
+
+    conn.close()
+
+
+# Microlotes: exportaciones por hora o parciales que llegan durante el día a su propia carpeta del FTP, aparte de la
+# del exporte diario que toma descomprimir_archivos(). El DAG ran_etl_microlotes revisa esa carpeta cada pocos minutos
+# y sube solo las horas nuevas, sin esperar la carga diaria
+BLOQUEO_CARGA = 72150481 # Llave del advisory lock de PostgreSQL que comparten la carga diaria y los microlotes
+SEGUNDOS_ARCHIVO_ESTABLE = 120 # Un ZIP modificado hace menos de esto puede estar subiéndose todavía por FTP
+DIAS_MICROLOTES = 2 # Solo se toman ZIPs recientes, los anteriores ya los cargó la carga diaria
+REGISTRO_MICROLOTES = "microlotes_procesados.txt" # ZIPs ya cargados como microlote (nombre|modificación|tamaño)
+COLUMNAS_CELDA = ["Timestamp", "Node_name", "Cell_name"] + CONTADORES_GESTOR
+HORAS_DIA_COMPLETO = 24 # Un archivo con todas las horas de un día es un exporte diario, no un microlote
+
+def firma_zip(archivo_zip):
+    # Cambia si el mismo nombre se vuelve a subir con otro contenido
+    estado = os.stat(archivo_zip)
+    return f"{os.path.basename(archivo_zip)}|{int(estado.st_mtime)}|{estado.st_size}"
+
+def zips_pendientes(carpeta_zip, carpeta):
+    # ZIPs recientes y completos que no están en el registro, del más antiguo al más nuevo
+    ruta_registro = os.path.join(carpeta, REGISTRO_MICROLOTES)
+    procesados = set()
+    if os.path.exists(ruta_registro):
+        with open(ruta_registro, 'r') as f:
+            procesados = set(f.read().splitlines())
+
+    ahora = time.time()
+    recientes = []
+    for archivo in os.listdir(carpeta_zip):
+        ruta = os.path.join(carpeta_zip, archivo)
+        if archivo.endswith('.zip') and SEGUNDOS_ARCHIVO_ESTABLE < ahora - os.path.getmtime(ruta) < DIAS_MICROLOTES * 86400:
+            recientes.append(ruta)
+    recientes.sort(key=os.path.getmtime)
+    firmas = {ruta: firma_zip(ruta) for ruta in recientes}
+
+    # El registro se reescribe solo con los ZIPs recientes, así no crece con el tiempo
+    with open(ruta_registro, 'w') as f:
+        f.writelines(f"{firma}\n" for firma in procesados if firma in firmas.values())
+    return [ruta for ruta in recientes if firmas[ruta] not in procesados]
+
+def dia_completo(carpeta):
+    # True si el CSV descomprimido trae las 24 horas de algún día. Un exporte diario que llegue por error a la carpeta de
+    # microlotes no se carga como microlote: reemplazaría el día completo fuera de la carga diaria y sin ran_kpi_cell
+    carpeta_raw = os.path.join(carpeta, "raw_data")
+    horas = set()
+    for archivo_csv in os.listdir(carpeta_raw):
+        if archivo_csv.endswith('.csv'):
+            df = pd.read_csv(os.path.join(carpeta_raw, archivo_csv), usecols=["Timestamp"])
+            horas.update(pd.to_datetime(df["Timestamp"].unique())) # Se parsean solo las horas distintas
+    dias = pd.Series(sorted(horas), dtype="datetime64[ns]").dt.normalize().value_counts()
+    return bool((dias >= HORAS_DIA_COMPLETO).any())
+
+def vaciar_carpeta(carpeta):
+    os.makedirs(carpeta, exist_ok=True)
+    for archivo in os.listdir(carpeta):
+        ruta = os.path.join(carpeta, archivo)
+        if os.path.isfile(ruta):
+            os.remove(ruta)
+
+@instrumentacion.medir("etl.microlote_celdas")
+def reemplazar_celdas(conn, carpeta):
+    # Sube las filas de celdas del microlote reemplazando las (hora, celda) que ya estaban: pasan por la tabla temporal
+    # microlote_celdas, se borran de ran_1h_cell las filas con la misma llave y se insertan, en una transacción.
+    # La tabla temporal queda en la sesión para los pasos siguientes. Devuelve las horas del microlote
+    carpeta_raw = os.path.join(carpeta, "raw_data")
+    archivos_csv = [archivo for archivo in os.listdir(carpeta_raw) if archivo.endswith('.csv')]
+    create_table("ran_1h_cell", "celda")
+
+    cur = conn.cursor()
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS "microlote_celdas" (LIKE "ran_1h_cell")')
+    cur.execute('TRUNCATE "microlote_celdas"')
+    copy_query = sql.SQL("COPY \"microlote_celdas\" ({}) FROM STDIN WITH CSV HEADER").format(sql.SQL(', ').join(map(sql.Identifier, COLUMNAS_CELDA)))
+    for archivo_csv in archivos_csv:
+        ruta_archivo = os.path.join(carpeta_raw, archivo_csv)
+        with open(ruta_archivo, 'r') as f, instrumentacion.tiempo_sql():
+            cur.copy_expert(sql=copy_query, file=f)
+        instrumentacion.anotar(filas=max(cur.rowcount, 0), bytes_escritos=os.path.getsize(ruta_archivo))
+
+    with instrumentacion.tiempo_sql():
+        cur.execute('ANALYZE "microlote_celdas"')
+        cur.execute('SELECT DISTINCT "Timestamp" FROM "microlote_celdas" ORDER BY 1')
+        horas = [fila[0] for fila in cur.fetchall()]
+        if horas:
+            # El rango deja que el BRIN descarte el resto de la tabla antes de cruzar con el microlote
+            cur.execute("""DELETE FROM "ran_1h_cell" c USING "microlote_celdas" m
+                           WHERE c."Timestamp" >= %s AND c."Timestamp" <= %s
+                           AND c."Timestamp" = m."Timestamp" AND c."Cell_name" = m."Cell_name"
+                        """, (horas[0], horas[-1]))
+            print(f"{cur.rowcount} filas de celdas reemplazadas")
+            cur.execute('INSERT INTO "ran_1h_cell" SELECT * FROM "microlote_celdas"')
+    conn.commit()
+    cur.close()
+
+    if horas and historico_local.escritura_habilitada():
+        for archivo_csv in archivos_csv:
+            guardar_historico_local(os.path.join(carpeta_raw, archivo_csv), "ran_1h_cell")
+    return horas
+
+@instrumentacion.medir("etl.microlote_celdas_dia")
+def reempaquetar_celdas(conn, carpeta, dias):
+    # Vuelve a empaquetar, con todas sus horas en ran_1h_cell, los días de las celdas que trajo el microlote. El DELETE
+    # queda en la misma transacción que el COPY de subir_empaquetado, el dashboard nunca ve el día sin esas celdas
+    cur = conn.cursor()
+    for dia in dias:
+        celdas_microlote = sql.SQL("\"Cell_name\" IN (SELECT DISTINCT \"Cell_name\" FROM \"microlote_celdas\" WHERE \"Timestamp\" >= %s AND \"Timestamp\" < %s)")
+        copy_query = sql.SQL("COPY (SELECT {} FROM \"ran_1h_cell\" WHERE \"Timestamp\" >= %s AND \"Timestamp\" < %s AND {}) TO STDOUT WITH CSV HEADER").format(
+            sql.SQL(', ').join(map(sql.Identifier, COLUMNAS_CELDA)), celdas_microlote)
+        params = (dia, dia + timedelta(days=1))
+        buffer = io.BytesIO()
+        with instrumentacion.tiempo_sql():
+            cur.copy_expert(cur.mogrify(copy_query, params + params).decode(), buffer)
+        buffer.seek(0)
+        df = pd.read_csv(buffer, dtype={contador: str for contador in CONTADORES_GESTOR}, keep_default_na=False, na_values=[""])
+        if df.empty:
+            continue
+        df["Timestamp"] = kpis_ran.timestamps_unicos(df["Timestamp"])
+
+        create_table(TABLA_CELDAS_DIA, "celda_dia") # Antes del DELETE, create_table usa su propia conexión
+        delete_query = sql.SQL("DELETE FROM {} WHERE \"Date\" = %s AND {}").format(sql.Identifier(TABLA_CELDAS_DIA), celdas_microlote)
+        with instrumentacion.tiempo_sql():
+            cur.execute(delete_query, (dia,) + params)
+        filas = subir_empaquetado(conn, df, os.path.join(carpeta, f"microlote_{dia}.empaquetado"))
+        print(f"Día {dia}: {filas} celdas empaquetadas de nuevo")
+    cur.close()
+
+@instrumentacion.medir("etl.microlote_agregaciones")
+def agregar_horas(conn, carpeta, horas, df_geo):
+    # Recalcula las agregaciones solo de las horas del microlote. Se arma en carpeta/raw_data un CSV con todas las
+    # celdas de esas horas (el microlote puede traer solo una parte de la red) y se usa el mismo camino que la carga
+    # diaria, sectores() a total(), después de borrar esas horas de cada tabla agregada
+    vaciar_carpeta(carpeta)
+    vaciar_carpeta(os.path.join(carpeta, "raw_data"))
+    cur = conn.cursor()
+    copy_query = sql.SQL("COPY (SELECT {} FROM \"ran_1h_cell\" WHERE \"Timestamp\" >= %s AND \"Timestamp\" <= %s AND \"Timestamp\" = ANY(%s)) TO STDOUT WITH CSV HEADER").format(
+        sql.SQL(', ').join(map(sql.Identifier, COLUMNAS_CELDA)))
+    with open(os.path.join(carpeta, "raw_data", "celdas_microlote.csv"), 'wb') as f, instrumentacion.tiempo_sql():
+        cur.copy_expert(cur.mogrify(copy_query, (horas[0], horas[-1], horas)).decode(), f)
+
+    for table_name in TABLAS_HORARIAS:
+        if table_name == "ran_1h_cell":
+            continue
+        cur.execute("SELECT to_regclass(%s)", (table_name,))
+        if cur.fetchone()[0] is None:
+            continue
+        delete_query = sql.SQL("DELETE FROM {} WHERE \"Timestamp\" >= %s AND \"Timestamp\" <= %s AND \"Timestamp\" = ANY(%s)").format(sql.Identifier(table_name))
+        with instrumentacion.tiempo_sql():
+            cur.execute(delete_query, (horas[0], horas[-1], horas))
+    cur.close() # Los DELETE se confirman con el primer COPY de las agregaciones
+
+    sectores(conn, carpeta, df_geo)
+    nodos(conn, carpeta)
+    cluster(conn, carpeta, df_geo)
+    localidad(conn, carpeta, df_geo)
+    municipio(conn, carpeta, df_geo)
+    am(conn, carpeta, df_geo)
+    departamento(conn, carpeta, df_geo)
+    regional(conn, carpeta, df_geo)
+    total(conn, carpeta)
+
+@instrumentacion.medir("etl.microlote_estados")
+def estados_dias(conn, carpeta, dias, df_geo):
+    # Recalcula los estados de los días del microlote con todas las celdas de esos días en ran_1h_cell. El histograma
+    # de un día no se puede corregir quitando las horas que se reemplazaron, así que se arma de nuevo el día completo
+    vaciar_carpeta(carpeta)
+    vaciar_carpeta(os.path.join(carpeta, "raw_data"))
+    cur = conn.cursor()
+    copy_query = sql.SQL("COPY (SELECT {} FROM \"ran_1h_cell\" WHERE \"Timestamp\" >= %s AND \"Timestamp\" < %s::date + 1) TO STDOUT WITH CSV HEADER").format(
+        sql.SQL(', ').join(map(sql.Identifier, COLUMNAS_CELDA)))
+    for dia in dias:
+        with open(os.path.join(carpeta, "raw_data", f"celdas_{dia}.csv"), 'wb') as f, instrumentacion.tiempo_sql():
+            cur.copy_expert(cur.mogrify(copy_query, (dia, dia)).decode(), f)
+    cur.close()
+
+    borrar_dias(conn, TABLA_ESTADOS, dias) # Se confirma con el COPY de los estados
+    estados_agregados(conn, carpeta, df_geo)
+
+@instrumentacion.medir("etl.microlotes")
+def microlotes(carpeta_zip, carpeta):
+    # Carga casi en tiempo real de los ZIPs nuevos de la carpeta de microlotes del FTP: cada uno pasa por la misma lectura y arreglo
+    # del CSV que la carga diaria y solo se reemplazan las horas que trae, en celdas, tabla empaquetada y agregaciones.
+    # Los KPIs diarios (ran_kpi_cell), equilibrar y los snapshots del mapa siguen en la carga diaria, que además
+    # reemplaza con el archivo completo los días que subieron los microlotes
+    os.makedirs(carpeta, exist_ok=True)
+    pendientes = zips_pendientes(carpeta_zip, carpeta)
+    if not pendientes:
+        print("No hay archivos nuevos en la carpeta del FTP")
+        return
+
+    conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (BLOQUEO_CARGA,))
+    if not cur.fetchone()[0]:
+        print("La carga diaria está corriendo, los archivos se cargan en la siguiente revisión")
+        conn.close()
+        return
+    cur.close()
+
+    try:
+        df_geo = None
+        for archivo_zip in pendientes:
+            firma = firma_zip(archivo_zip)
+            print(f"Iniciando microlote {archivo_zip}")
+            vaciar_carpeta(os.path.join(carpeta, "raw_data"))
+            descomprimir_zip(archivo_zip, carpeta)
+            borrar_encabezado(carpeta)
+            editar_archivos_csv(carpeta)
+
+            if dia_completo(carpeta):
+                print(f"{archivo_zip} trae un día completo, se deja para la carga diaria")
+                with open(os.path.join(carpeta, REGISTRO_MICROLOTES), 'a') as f:
+                    f.write(f"{firma}\n")
+                continue
+
+            horas = reemplazar_celdas(conn, carpeta)
+            if horas:
+                reempaquetar_celdas(conn, carpeta, sorted({hora.date() for hora in horas}))
+                if df_geo is None:
+                    df_geo = query_geodata() # Una vez por ejecución
+                agregar_horas(conn, os.path.join(carpeta, "agregaciones"), horas, df_geo)
+                estados_dias(conn, os.path.join(carpeta, "estados"), sorted({hora.date() for hora in horas}), df_geo)
+            print(f"Microlote {archivo_zip}: {len(horas)} horas actualizadas")
+
+            with open(os.path.join(carpeta, REGISTRO_MICROLOTES), 'a') as f:
+                f.write(f"{firma}\n")
+    finally:
+        conn.close() # También libera el advisory lock
+
+
+# Ventanas (en días) que el mapa del dashboard muestra por defecto para cada agregación: el rango inicial de 31 días
+# recortado según la agregación, y la ventana máxima de recorte para AM, departamento y regional
+VENTANAS_SNAPSHOT = {
+    "ran_1h_cell": ("celda", "Cell_name", [3]),
+    "ran_1h_sector": ("sector", "sector_name", [3]),
+    "ran_1h_node": ("EB", "node_name", [7]),
+    "ran_1h_cluster": ("cluster", "cluster_name", [21]),
+    "ran_1h_localidad": ("localidad", "localidad_dane_code", [21]),
+    "ran_1h_municipio": ("municipio", "municipio_dane_code", [21]),
+    "ran_1h_am": ("AM", "am_name", [31, 120]),
+    "ran_1h_departamento": ("departamento", "dpto_dane_code", [31, 120]),
+    "ran_1h_regional": ("regional", "regional_name", [31, 120])
+}
+
+def ultimo_dia(cur, table_name, dias_recientes=7):
+    # Último día cargado en una tabla horaria. El BRIN no resuelve MAX(), así que primero se busca en los días recientes,
+    # que el BRIN filtra leyendo pocas páginas; el MAX sin filtro recorre la tabla y solo se usa si lleva días sin cargas
+    max_query = sql.SQL("SELECT MAX(\"Timestamp\")::date FROM {}").format(sql.Identifier(table_name))
+    cur.execute(max_query + sql.SQL(" WHERE \"Timestamp\" >= %s"), (datetime.now().date() - timedelta(days=dias_recientes),))
+    fin = cur.fetchone()[0]
+    if fin is None:
+        cur.execute(max_query)
+        fin = cur.fetchone()[0]
+    return fin
+
+@instrumentacion.medir("etl.snapshots_mapa")
+def snapshots_mapa():
+    # Precalcula el valor de cada KPI del mapa en hora pico, promediado por marcador o polígono, para las ventanas
+    # por defecto que terminan en el último día cargado. Así la primera carga del mapa en el dashboard es una sola
+    # consulta indexada en lugar de leer todos los datos por hora
+    print("Iniciando cálculo de snapshots del mapa")
+    conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+    cur = conn.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS "ran_map_snapshot" (
+            "agregacion" VARCHAR, "kpi" VARCHAR, "inicio" DATE, "fin" DATE, "nombre" VARCHAR, "valor" DOUBLE PRECISION
+        )""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS "idx_ran_map_snapshot" ON "ran_map_snapshot" ("agregacion", "kpi", "inicio", "fin")""")
+    conn.commit()
+
+    for table_name, (agregacion, name_column, ventanas) in VENTANAS_SNAPSHOT.items():
+        fin = ultimo_dia(cur, table_name)
+        if fin is None:
+            print(f"La tabla {table_name} no tiene datos, no se genera snapshot")
+            continue
+
+        # Se reemplaza el snapshot de la agregación en una sola transacción, el dashboard nunca lo ve vacío
+        cur.execute("DELETE FROM \"ran_map_snapshot\" WHERE \"agregacion\" = %s", (agregacion,))
+        for ventana in ventanas:
+            inicio = fin - timedelta(days=ventana-1)
+            # BH de cada marcador o polígono por día con DISTINCT ON y los cuatro KPIs del mapa en una sola lectura
+            # El nombre se guarda como texto en todas las agregaciones; el dashboard lo lleva al tipo de la llave de su
+            # base con kpis_ran.nombres_como_llave (los códigos DANE son enteros)
+            insert_query = sql.SQL("""
+                INSERT INTO "ran_map_snapshot" ("agregacion", "kpi", "inicio", "fin", "nombre", "valor")
+                SELECT %s, k.kpi, %s, %s, bh.nombre::varchar, AVG(k.valor)
+                FROM (
+                    SELECT DISTINCT ON (r.{nombre}, DATE(r."Timestamp")) r.{nombre} AS nombre,
+                        {usuarios} AS usuarios, {prb} AS prb, {trafico} AS trafico, {u_exp} AS u_exp
+                    FROM {tabla} r
+                    WHERE r."Timestamp" >= %s AND r."Timestamp" < %s
+                    ORDER BY r.{nombre}, DATE(r."Timestamp"), r."L.Traffic.ActiveUser.DL.Avg" DESC NULLS LAST
+                ) bh
+                CROSS JOIN LATERAL (VALUES ('BH', bh.usuarios), ('PRB', bh.prb), ('Traffic', bh.trafico), ('u_exp', bh.u_exp)) AS k(kpi, valor)
+                GROUP BY k.kpi, bh.nombre""").format(nombre=sql.Identifier(name_column), tabla=sql.Identifier(table_name),
+                                                      usuarios=sql.SQL(kpis_ran.SQL_KPIS["BH"]), prb=sql.SQL(kpis_ran.SQL_KPIS["PRB"]),
+                                                      trafico=sql.SQL(kpis_ran.SQL_KPIS["Traffic"]), u_exp=sql.SQL(kpis_ran.SQL_KPIS["u_exp"]))
+            with instrumentacion.tiempo_sql():
+                cur.execute(insert_query, (agregacion, inicio, fin, inicio, fin + timedelta(days=1)))
+                instrumentacion.anotar(filas=max(cur.rowcount, 0))
+            print(f"Snapshot {agregacion} de {ventana} días ({inicio} - {fin}): {cur.rowcount} filas")
+        conn.commit()
+
+    cur.close()
     conn.close()
+    print("Snapshots del mapa actualizados con exito")
 
 
 def main():
@@ -894,5 +1761,8 @@ def main():
     # Cargar datos a PostgreSQL de manera secuencial
     tablas_agregaciones(carpeta_descomprimida)
 
+    # Precalcular las vistas por defecto del mapa
+    snapshots_mapa()
+
 if __name__ == "__main__":
     main()
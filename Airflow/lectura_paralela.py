@@ -0,0 +1,95 @@
+# Lectura en paralelo del CSV diario del gestor. El archivo (ya sin preámbulo, con el encabezado en la primera
+# línea) se divide en rangos de bytes que empiezan y terminan en un salto de línea; cada proceso del pool lee su
+# rango con el parser en C de pandas y le aplica la transformación indicada. Los bloques se devuelven en el orden
+# del archivo, ya sea unidos en un DataFrame o escritos uno tras otro en un CSV de salida.
+# El corte por bytes supone que ningún campo trae saltos de línea entre comillas, como ocurre con el exporte del gestor
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+#----------- Constantes -----------#
+PROCESOS = int(os.environ.get("DASHWOM_PROCESOS_CSV", os.cpu_count() or 1)) # Procesos del pool, por defecto todos los núcleos
+BLOQUES_POR_PROCESO = 4 # Más bloques que procesos para repartir mejor la carga
+TAM_MINIMO_PARALELO = 32 * 2**20 # Archivos más pequeños se leen en el proceso actual, el pool no alcanza a pagarse
+
+
+
+#---------- Funciones ----------#
+def encabezado(ruta):
+    # Nombres de columnas y posición en bytes donde empiezan los datos
+    with open(ruta, "rb") as f:
+        linea = f.readline()
+    return pd.read_csv(io.BytesIO(linea), nrows=0).columns.tolist(), len(linea)
+
+def rangos(ruta, partes, inicio=0):
+    # Cortes [inicio, fin) del archivo alineados al comienzo de una línea
+    tam = os.path.getsize(ruta)
+    cortes = [inicio]
+    with open(ruta, "rb") as f:
+        for i in range(1, partes):
+            posicion = inicio + (tam - inicio) * i // partes
+            if posicion <= cortes[-1]:
+                continue
+            f.seek(posicion - 1)
+            f.readline() # Si posicion - 1 es un salto de línea no avanza más, el corte queda en posicion
+            corte = f.tell()
+            if cortes[-1] < corte < tam:
+                cortes.append(corte)
+    cortes.append(tam)
+    return list(zip(cortes[:-1], cortes[1:]))
+
+def _leer_rango(ruta, inicio, fin, columnas, usecols, dtype, transformar):
+    with open(ruta, "rb") as f:
+        f.seek(inicio)
+        datos = f.read(fin - inicio)
+    if datos.strip():
+        df = pd.read_csv(io.BytesIO(datos), header=None, names=columnas, usecols=usecols, dtype=dtype)
+    else: # Archivo solo con encabezado: read_csv falla con un bloque vacío
+        df = pd.DataFrame(columns=[c for c in columnas if usecols is None or c in usecols])
+    return transformar(df) if transformar is not None else df
+
+def _bloque_df(tarea):
+    return _leer_rango(*tarea)
+
+def _bloque_csv(tarea):
+    # El bloque se convierte a texto CSV en el mismo proceso que lo leyó, así la escritura también es paralela
+    df = _leer_rango(*tarea)
+    return df.columns.tolist(), df.to_csv(index=False, header=False).encode()
+
+def _tareas(ruta, usecols, dtype, transformar, procesos):
+    columnas, inicio = encabezado(ruta)
+    if procesos <= 1 or os.path.getsize(ruta) < TAM_MINIMO_PARALELO:
+        partes = 1
+    else:
+        partes = procesos * BLOQUES_POR_PROCESO
+    return [(ruta, a, b, columnas, usecols, dtype, transformar) for a, b in rangos(ruta, partes, inicio)]
+
+def _mapear(funcion, tareas, procesos):
+    # Resultados en el orden de los rangos; con un solo rango no se crea el pool
+    if len(tareas) <= 1:
+        yield from map(funcion, tareas)
+        return
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        yield from pool.map(funcion, tareas)
+
+def leer_csv(ruta, usecols=None, dtype=None, transformar=None, procesos=PROCESOS):
+    # Equivalente a pd.read_csv(ruta, usecols=..., dtype=...) con transformar aplicado por bloque, leído en paralelo
+    tareas = _tareas(ruta, usecols, dtype, transformar, procesos)
+    return pd.concat(_mapear(_bloque_df, tareas, procesos), ignore_index=True)
+
+def transformar_csv(ruta, destino, transformar, usecols=None, dtype=None, procesos=PROCESOS):
+    # Lee ruta en paralelo, aplica transformar a cada bloque y escribe los bloques en orden en destino a medida que
+    # llegan, sin juntar el archivo completo en memoria. destino puede ser la misma ruta. Devuelve las filas escritas
+    tareas = _tareas(ruta, usecols, dtype, transformar, procesos)
+    temporal = destino + ".parcial"
+    filas = 0
+    with open(temporal, "wb") as salida:
+        for i, (columnas, texto) in enumerate(_mapear(_bloque_csv, tareas, procesos)):
+            if i == 0:
+                salida.write(pd.DataFrame(columns=columnas).to_csv(index=False).encode())
+            salida.write(texto)
+            filas += texto.count(b"\n")
+    os.replace(temporal, destino) # El archivo original solo se reemplaza cuando la salida está completa
+    return filas
@@ -1,6 +1,7 @@
 import dash
-from dash import Dash, dcc, html, Input, Output, State, callback, Patch, no_update, ctx
+from dash import Dash, dcc, html, dash_table, Input, Output, State, callback, Patch, no_update, ctx, ClientsideFunction
 from dash.exceptions import PreventUpdate
+from flask import Response, request # Para rutas HTTP propias sobre el servidor de Dash
 
 # Librerías adicionales de Dash
 # import dash_leaflet as dl # Para hacer mapas con Leaflet
@@ -12,16 +13,28 @@ import pandas as pd
 import geopandas as gpd
 import plotly.express as px
 import plotly.graph_objects as go
+from plotly.colors import make_colorscale
 import psycopg2 # Para consulta a base de datos PostgreSQL
 from psycopg2 import sql
 # from unidecode import unidecode # Libreria para eliminar acentos y poder hace condicionales tranquilo
 from datetime import datetime, timedelta, date
 import datetime as dt
 import numpy as np
-# import json
+import json
+import os
+import sys
 
 # Scripts adicionales
 import DBcredentials
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comun"))
+from kpis_ran import uso_prb, bits_a_gb, experiencia_usuario, codigos_grupo, hora_pico, suma_y_promedio, nombres_como_llave # Cálculo de KPIs compartido con el ETL
+from consultas import consulta_compartida, estados_query, query_to_df, query_multi_df, map_query, map_snapshot, report_export, ranking_query, ranking_export, COLUMNAS_NOMBRE, RANKING_KPIS, MAX_RANKING # Capa de acceso a datos (consultas columnares)
+from teselas import IndiceTeselas, ZOOM_INDICE # Índice espacial para el mapa por teselas
+from trabajos import background_callback_manager, deduplicar, cache # Ejecución en segundo plano de callbacks largos
+from instrumentacion import medir, configurar_almacen, exportar_prometheus # Tiempos, filas, bytes y memoria de cada callback
+import estados_kpi # Percentiles de las celdas-hora a partir de estados combinables
+
+configurar_almacen(cache) # Métricas compartidas con los procesos de trabajos en segundo plano
 
 #----------- Constantes -----------#
 # Colores hexadecimal
@@ -32,6 +45,10 @@ GRIS = "#8d8d8d"
 MAGENTA = "#bb1677"
 MAGENTA_OPACO = "#ac4b78"
 
+PUNTOS_POR_TRAZO = 1500 # Puntos máximos por trazo en la vista por hora (un mínimo y un máximo por pixel aprox.)
+MAX_COMPARACION = 20 # Selecciones máximas que se pueden superponer en el modo comparación
+EXPIRACION_TESELAS = 3600 # Segundos que se conserva una tesela del mapa en el caché del servidor y del navegador
+
 
 
 #---------- Funciones Globales ----------#
@@ -158,7 +175,8 @@ def query_geodata():
 
 #---------- Iniciar App ----------#
 dbc_css = "https://cdn.jsdelivr.net/gh/AnnMarieW/dash-bootstrap-templates/dbc.min.css" # Hoja de estilo para los Dash Core Components
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.PULSE, dbc_css]) # Importo tema desde bootstrap
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.PULSE, dbc_css], # Importo tema desde bootstrap
+                background_callback_manager=background_callback_manager) # Callbacks largos corren fuera del worker web
 load_figure_template("pulse") # Función para que todos los gráficos tengan esta plantilla
 
 
@@ -185,6 +203,14 @@ departamentos = gpd.read_file("co_2018_MGN_DPTO_POLITICO.geojson")
 # Leer el archivo GeoJSON de regionales con Geopandas
 regionales = gpd.read_file("Regional_test.geojson")
 
+# Índices espaciales de celdas y sectores para el modo por teselas del mapa
+INDICES_TESELAS = {}
+if not df_geo.empty:
+    celdas_geo = df_geo.drop_duplicates(subset=["dwh_cell_name_wom"])
+    INDICES_TESELAS["celda"] = IndiceTeselas(celdas_geo["dwh_cell_name_wom"], pd.to_numeric(celdas_geo["dwh_latitud"], errors="coerce"), pd.to_numeric(celdas_geo["dwh_longitud"], errors="coerce"))
+    sectores_geo = df_geo.drop_duplicates(subset=["sector_name"])
+    INDICES_TESELAS["sector"] = IndiceTeselas(sectores_geo["sector_name"], pd.to_numeric(sectores_geo["dwh_latitud"], errors="coerce"), pd.to_numeric(sectores_geo["dwh_longitud"], errors="coerce"))
+
 
 
 
@@ -251,14 +277,12 @@ app.layout = dbc.Container([ # El layout sigue un estilo html
                 ], style={"height": "45%"}, align="center"),
                 dbc.Row([
                     dbc.Col([
-                        dbc.Button(children="Reporte de celdas", id="reporte", n_clicks=0),
+                        # El botón es un enlace a la ruta de exportación, el navegador descarga el archivo mientras se genera
+                        dbc.Button(children="Reporte de celdas", id="reporte", n_clicks=0, external_link=True),
                     ], width=3),
-                    dbc.Col([
-                        dcc.Loading(children=dcc.Download(id="download_report"), color=MORADO_WOM),
-                    ], width=1),
                     dbc.Col([
                         dbc.Button(children="Buscar", id="solicitar", n_clicks=0)
-                    ], width={"size":2,"offset":6}), # Offset de 6 casillas para que quede bien a la derecha
+                    ], width={"size":2,"offset":7}), # Offset de 7 casillas para que quede bien a la derecha
                 ], style={"height": "10%"}, align="center") # justify=end para que quede al final de la columna
                 
             ], body=True, style={"height": "100%"})
@@ -348,18 +372,70 @@ app.layout = dbc.Container([ # El layout sigue un estilo html
             dbc.Button(id="fullscreen", n_clicks=0, children="Full Screen", style={"margin-left": "5%"}),
             dbc.Button(id="download", n_clicks=0, children="Download", style={"margin-left": "5%"}),
             dcc.Download(id="download_file"),
+            # En celda y sector el mapa solo recibe los marcadores de las teselas visibles
+            dbc.Switch(id="modo_teselas", label="Mapa por teselas", value=False, style={"display": "inline-block", "margin-left": "5%"}),
+            dcc.Store(id="mapa_teselas"), # Agregación, KPI y ventana del mapa por teselas, None si está apagado
+            dcc.Store(id="mapa_base"), # Agregación de la figura que tiene el mapa, para actualizar solo los valores
         ], width=6, align="center"),
     ]),
 
     dbc.Row([
         dbc.Col([
             html.Div(id="map_text", children="No se ha seleccionado KPI en el mapa", style={"height": "100%"}),
-        ], width=6, align="center")
+        ], width=6, align="center"),
+        dbc.Col([
+            dcc.Dropdown(id="comparar", multi=True, placeholder="Comparar varias selecciones"), # Modo comparación
+        ], width=4, align="center"),
+        dbc.Col([
+            dbc.Button(id="comparar_boton", n_clicks=0, children="Comparar"),
+        ], width=2, align="center"),
+    ]),
+
+    dbc.Row([
+        dbc.Col([
+            dbc.Label("Ranking por agregación geográfica"),
+            dcc.Dropdown(id="ranking_kpi",
+                        options=[
+                            {"label": "Active Users", "value": "BH"},
+                            {"label": "PRB Occupation", "value": "PRB"},
+                            {"label": "Traffic", "value": "Traffic"},
+                            {"label": "User Experience", "value": "u_exp"}],
+                        value="PRB",
+                        clearable=False,
+                        ),
+        ], width=3, align="center"),
+        dbc.Col([
+            dbc.Label("Orden"),
+            dcc.Dropdown(id="ranking_orden",
+                        options=[
+                            {"label": "Mayores valores", "value": "desc"},
+                            {"label": "Menores valores", "value": "asc"}],
+                        value="desc",
+                        clearable=False,
+                        ),
+        ], width=3, align="center"),
+        dbc.Col([
+            dbc.Label("Cantidad"),
+            dbc.Input(id="ranking_n", type="number", value=20, min=1, max=MAX_RANKING, step=1),
+        ], width=2, align="center"),
+        dbc.Col([
+            dbc.Button(id="ranking_boton", n_clicks=0, children="Ranking"),
+            dbc.Button(id="ranking_descarga", n_clicks=0, children="Descargar ranking", external_link=True, style={"margin-left": "5%"}),
+        ], width=4, align="end"),
+    ]),
+
+    dbc.Row([
+        dbc.Col([
+            html.Div(id="ranking_texto"),
+            dash_table.DataTable(id="ranking_tabla", page_size=20, sort_action="native",
+                                 style_table={"overflowX": "auto"}),
+        ], width=12)
     ]),
 
     dbc.Row([
         dbc.Col([
             dcc.Graph(id="graph_test", style={"height": "100%"}),
+            dcc.Store(id="consulta_horaria"), # Parámetros de la consulta por hora, para volver a consultar al hacer zoom
         ], style={"height": "100%"})
     ], style={"height": "100%"}),
 
@@ -378,6 +454,7 @@ app.layout = dbc.Container([ # El layout sigue un estilo html
     Output('time', 'end_date'),
     Input('time', 'id')  # Usamos un Input ficticio para que el callback se llame al cargar la app
 )
+@medir("callback.update_date_range")
 def update_date_range(_):
     today = datetime.today()
     end_date = today - timedelta(days=1)
@@ -394,15 +471,17 @@ def update_date_range(_):
         Output(component_id='user_exp', component_property='figure', allow_duplicate=True),
         Output(component_id='bh', component_property='figure', allow_duplicate=True),
         Output(component_id='PRB', component_property='figure', allow_duplicate=True),
+        Output(component_id='comparar', component_property='value'),
 
         Input(component_id="aggregation", component_property='value'),
         prevent_initial_call=True # Para que no me genere la alerta de salida duplicada
 )
+@medir("callback.funct")
 def funct(input):
     container = f"Selecciona un punto o polígono"
     void_fig = go.Figure(data=[go.Scatter(x=[], y=[])]) # Figura vacia
 
-    return container, None, void_fig, void_fig, void_fig, void_fig # Se actualiza mapa, salido de texto y se retornan gráficos vacios
+    return container, None, void_fig, void_fig, void_fig, void_fig, None # Se actualiza mapa, salido de texto, se retornan gráficos vacios y se limpia la comparación
 
 
 
@@ -410,8 +489,10 @@ def funct(input):
 # Callback para generar las opciones de marcador o poligono según la agregación
 @callback(
     Output(component_id='select', component_property='options'),
+    Output(component_id='comparar', component_property='options'),
     Input(component_id="aggregation", component_property='value')
 )
+@medir("callback.update_dropdown")
 def update_dropdown(input):
     if input == "celda":
         options_df = df_geo["dwh_cell_name_wom"].copy() # Genero copia del df únicamente de la columna que contiene el nombre de las celdas
@@ -476,7 +557,7 @@ def update_dropdown(input):
     elif input == "total":
         options = [{'label': 'Total de la red', 'value': "Total de la red"}]
     
-    return options
+    return options, options # Las mismas opciones para la selección y para el modo comparación
 
 
 
@@ -485,6 +566,7 @@ def update_dropdown(input):
         Output(component_id='select', component_property='value'),
         Input(component_id='map', component_property='clickData')
 )
+@medir("callback.make_selection")
 def make_selection(input):
     if input is None:
         raise PreventUpdate
@@ -499,11 +581,14 @@ def make_selection(input):
 # Callback para realizar zoom en el mapa según la selección
 @callback(
         Output(component_id='map', component_property='figure', allow_duplicate=True), # Voy a usar está misma salida en otro callback
+        Output(component_id='mapa_teselas', component_property='data', allow_duplicate=True),
         Input(component_id='select', component_property='value'),
         State(component_id="aggregation", component_property='value'),
+        State(component_id="mapa_teselas", component_property='data'),
         prevent_initial_call=True # Para que no me genere la alerta de salida duplicada
 )
-def make_zoom(input, agg):
+@medir("callback.make_zoom")
+def make_zoom(input, agg, teselas):
     print("Input en función makezooom: ", input)
     if input is None:
         raise PreventUpdate # No modifica ninguna salida
@@ -579,52 +664,138 @@ def make_zoom(input, agg):
     patched_figure['layout']['mapbox']['center']['lat'] = lat_mean # Ruta para modificar atributo de latitud
     patched_figure['layout']['mapbox']['center']['lon'] = lon_mean # Ruta para modificar atributo de longitud
 
+    # El zoom programático no genera relayoutData, así que se avisa al mapa por teselas de la nueva vista
+    patched_teselas = no_update
+    if teselas:
+        patched_teselas = Patch()
+        patched_teselas["vista"] = {"center": {"lat": lat_mean, "lon": lon_mean}, "zoom": zoom}
+
+    return patched_figure, patched_teselas
+
+
+# Callback para apuntar el botón de reporte a la ruta de exportación con el rango de fechas seleccionado
+@callback(
+        Output(component_id='reporte', component_property='href'),
+
+        Input(component_id="time", component_property='start_date'),
+        Input(component_id="time", component_property='end_date'),
+)
+@medir("callback.download_report")
+def download_report(start_date, end_date):
+    if (start_date is None) or (end_date is None):
+        raise PreventUpdate
+
+    return app.get_relative_path(f"/reporte_kpi?inicio={start_date}&fin={end_date}")
+
 
-    return patched_figure
+# Ruta que exporta el reporte de KPIs de cada celda dentro del rango de fechas. El CSV se genera con COPY y se envía
+# comprimido en gzip por bloques, así la memoria del worker no crece con el tamaño del reporte
+@app.server.route("/reporte_kpi")
+@medir("ruta.reporte_kpi")
+def reporte_kpi():
+    start_date = request.args.get("inicio")
+    end_date = request.args.get("fin")
+    try:
+        datetime.strptime(start_date, "%Y-%m-%d") # Validar formato de las fechas antes de consultar
+        datetime.strptime(end_date, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return Response("Rango de fechas no valido", status=400)
+
+    try:
+        contenido = report_export(start_date, end_date)
+    except Exception as e:
+        print("No se pudo iniciar la exportación del reporte: ", e)
+        return Response("No se pudo consultar la base de datos", status=503)
+
+    file_name = f"KPI_Report_{start_date}-{end_date}.csv.gz"
+    return Response(contenido,
+                    mimetype="application/gzip",
+                    headers={"Content-Disposition": f"attachment; filename={file_name}"})
 
 
-# Callback para descargar reporte de KPIs de cada celda dentro del rango de fechas
+# Callback del ranking: las N selecciones con mayor o menor KPI en BH para la agregación geográfica elegida.
+# El ranking se calcula en la base de datos y solo llegan N filas, no hace falta cargar el mapa
 @callback(
-        Output(component_id='download_report', component_property='data'),
+        Output(component_id='ranking_tabla', component_property='data'),
+        Output(component_id='ranking_tabla', component_property='columns'),
+        Output(component_id='ranking_texto', component_property='children'),
 
-        Input(component_id='reporte', component_property='n_clicks'),
+        Input(component_id='ranking_boton', component_property='n_clicks'),
 
+        State(component_id="aggregation", component_property='value'),
+        State(component_id="ranking_kpi", component_property='value'),
+        State(component_id="ranking_orden", component_property='value'),
+        State(component_id="ranking_n", component_property='value'),
         State(component_id="time", component_property='start_date'),
         State(component_id="time", component_property='end_date'),
-        prevent_initial_call=True # Evitar el primer llamado automatico que hace dash
+        prevent_initial_call=True
 )
-def download_report(boton, start_date, end_date):
-    if boton is None:  # Se debe presionar el boton para que se actualice el callback
+@medir("callback.ranking_table")
+def ranking_table(n_clicks, geo_agg, kpi, orden, n, start_date, end_date):
+    if geo_agg == "total":
+        return [], [], "El ranking necesita una agregación geográfica distinta a Total"
+    if (start_date is None) or (end_date is None) or (n is None):
         raise PreventUpdate
+
+    df = ranking_query(geo_agg, kpi, start_date, end_date, int(n), orden == "desc")
+    if df.empty:
+        return [], [], f"No hay datos para el ranking en el rango de fechas {start_date} - {end_date}"
+
+    df.insert(0, "posicion", range(1, len(df) + 1))
+    df["valor"] = df["valor"].round(2)
+    columns = [{"name": "#", "id": "posicion"}, {"name": geo_agg, "id": "nombre"},
+               {"name": f"{kpi} promedio en BH", "id": "valor"}, {"name": "Días", "id": "dias"}]
+    texto = f"Ranking de {kpi} por {geo_agg} en el rango de fechas {start_date} -> {end_date}"
+    return df.to_dict("records"), columns, texto
+
+
+# Callback para apuntar el botón de descarga del ranking a su ruta de exportación con los parámetros actuales
+@callback(
+        Output(component_id='ranking_descarga', component_property='href'),
+
+        Input(component_id="aggregation", component_property='value'),
+        Input(component_id="ranking_kpi", component_property='value'),
+        Input(component_id="ranking_orden", component_property='value'),
+        Input(component_id="ranking_n", component_property='value'),
+        Input(component_id="time", component_property='start_date'),
+        Input(component_id="time", component_property='end_date'),
+)
+@medir("callback.ranking_link")
+def ranking_link(geo_agg, kpi, orden, n, start_date, end_date):
+    if (start_date is None) or (end_date is None) or (n is None) or geo_agg == "total":
+        return None
+
+    return app.get_relative_path(f"/ranking_kpi?agregacion={geo_agg}&kpi={kpi}&orden={orden}&n={int(n)}&inicio={start_date}&fin={end_date}")
+
+
+# Ruta que exporta el ranking como CSV comprimido en gzip
+@app.server.route("/ranking_kpi")
+@medir("ruta.ranking_kpi")
+def ranking_kpi():
+    geo_agg = request.args.get("agregacion")
+    kpi = request.args.get("kpi")
+    orden = request.args.get("orden", "desc")
+    start_date = request.args.get("inicio")
+    end_date = request.args.get("fin")
     try:
-        # Conectarse a la base de datos
-        conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
-        
-        # Crear un cursor
-        cur = conn.cursor()
+        datetime.strptime(start_date, "%Y-%m-%d") # Validar los parámetros antes de consultar
+        datetime.strptime(end_date, "%Y-%m-%d")
+        n = int(request.args.get("n", 20))
+    except (TypeError, ValueError):
+        return Response("Parámetros no validos", status=400)
+    if geo_agg not in COLUMNAS_NOMBRE or geo_agg == "total" or kpi not in RANKING_KPIS or orden not in ("asc", "desc"):
+        return Response("Parámetros no validos", status=400)
 
-        # Realizar consulta a la base de datos PostgreSQL dentro del rango de fechas seleccionado
-        cur = conn.cursor()
-        cur.execute("""SELECT "Date","BH","cell_name","avg_users_BH","daily_max_users","max_users_hour","PRBusage_BH_DL","PRBusage_BH_UL","traffic_bh(GB)","traffic_avg(GB)","traffic_total(GB)","uexp_BH(Mbps)"
-                    FROM "ran_kpi_cell" 
-                    WHERE "Date" BETWEEN %s AND %s""", (start_date, end_date,))
-        rows = cur.fetchall()
-        columnas = ["Date","BH","cell_name","avg_users_BH","daily_max_users","max_users_hour","PRBusage_BH_DL","PRBusage_BH_UL","traffic_bh(GB)","traffic_avg(GB)","traffic_total(GB)","uexp_BH(Mbps)"]
-        df = pd.DataFrame(rows, columns=columnas)
-
-        if df.empty: # Si el dataframe está vacio se levanta una excepción
-            raise Exception("No se han retornado datos. Dataframe vacio")
-        
-        file_name = f"KPI_Report_{start_date}-{end_date}.csv"
-        return dcc.send_data_frame(df.to_csv, file_name, index=False)
-        
+    try:
+        contenido = ranking_export(geo_agg, kpi, start_date, end_date, n, orden == "desc")
     except Exception as e:
-        print("Error al momento de descargar reporte de KPIs: ", e)
-        raise PreventUpdate
-    
-    finally:
-        cur.close()
-        conn.close()
+        print("No se pudo iniciar la exportación del ranking: ", e)
+        return Response("No se pudo consultar la base de datos", status=503)
+
+    file_name = f"Ranking_{kpi}_{geo_agg}_{start_date}-{end_date}.csv.gz"
+    return Response(contenido,
+                    mimetype="application/gzip",
+                    headers={"Content-Disposition": f"attachment; filename={file_name}"})
 
 
 
@@ -636,12 +807,11 @@ def download_report(boton, start_date, end_date):
 #------------------------------------------ FUNCIONES CALLBACK GENERACIÓN DE GRÁFICOS ----------------------------------------------------------#
     
 
-def bh(data, column): # Calculo BH(hora pico) por día
-    data = data.copy()
-    bh_day = data.groupby(data['Timestamp'].dt.date)[column].idxmax() # Agrupo los datos por fecha y luego encuentro los indices que contienen los valores de tráfico maximos (BH)
-    bh_df = data.loc[bh_day, ['Timestamp', column]] # Creo un nuevo df con las horas pico por día y unicamente con las columnas de tiempo y tráfico
+def bh(data, column, codigo_dia): # Calculo BH(hora pico) por día
+    bh_day = hora_pico(codigo_dia, data[column]) # Posiciones de las filas con el valor máximo de cada día (BH), una por día en orden
+    bh_df = data[['Timestamp', column]].iloc[bh_day] # Creo un nuevo df con las horas pico por día y unicamente con las columnas de tiempo y tráfico
 
-    return bh_df
+    return bh_df, bh_day
 
 def graph_BH(bh_df_avg, bh_df_max):
     fig = go.Figure() # Crea una figura vacía
@@ -656,40 +826,32 @@ def graph_BH(bh_df_avg, bh_df_max):
     fig.add_trace(go.Bar(x=bh_df_max["Date"], y=bh_df_max["L.Traffic.ActiveUser.DL.Max"], name="Max", text=bh_df_max["Time"], marker=dict(color=MORADO_CLARO)))
     return fig
 
-def PRB_usg(data, bh_df):
-    data = data[data["Timestamp"].isin(bh_df["Timestamp"])].copy() # Genero copia del df de datos unicamente de las casillas dentro del BH
-    prb_df = data[["Timestamp", "L.ChMeas.PRB.DL.Avail", "L.ChMeas.PRB.DL.Used.Avg", "L.ChMeas.PRB.UL.Avail", "L.ChMeas.PRB.UL.Used.Avg"]] # Solo columnas necesarias
+def PRB_usg(data, bh_pos):
+    prb_df = data[["Timestamp", "L.ChMeas.PRB.DL.Avail", "L.ChMeas.PRB.DL.Used.Avg", "L.ChMeas.PRB.UL.Avail", "L.ChMeas.PRB.UL.Used.Avg"]].iloc[bh_pos] # Solo columnas necesarias y filas en BH
     prb_df = prb_df.reset_index(drop=True)
 
-    prb_df["DL_PRB_usage"] = (prb_df["L.ChMeas.PRB.DL.Used.Avg"] / prb_df["L.ChMeas.PRB.DL.Avail"]) * 100 # Cálculo de % ocupación en downlink y guardado en nueva columna
-    prb_df["UL_PRB_usage"] = (prb_df["L.ChMeas.PRB.UL.Used.Avg"] / prb_df["L.ChMeas.PRB.UL.Avail"]) * 100 # # Cálculo de % ocupación en uplink y guardado en nueva columna
+    prb_df["DL_PRB_usage"] = uso_prb(prb_df["L.ChMeas.PRB.DL.Used.Avg"], prb_df["L.ChMeas.PRB.DL.Avail"]) # Cálculo de % ocupación en downlink y guardado en nueva columna
+    prb_df["UL_PRB_usage"] = uso_prb(prb_df["L.ChMeas.PRB.UL.Used.Avg"], prb_df["L.ChMeas.PRB.UL.Avail"]) # # Cálculo de % ocupación en uplink y guardado en nueva columna
 
     return prb_df
 
-def bit_to_GB(bit):
-    gbyte = bit / (8*10**9)
-    return gbyte
-
 def graph_prb(prb_df):
     fig_prb = go.Figure() # Crea una figura vacía
     fig_prb.add_trace(go.Scatter(x=prb_df["Timestamp"], y=prb_df["DL_PRB_usage"], mode='lines', name='Downlink', line=dict(color=MORADO_WOM)))
     fig_prb.add_trace(go.Scatter(x=prb_df["Timestamp"], y=prb_df["UL_PRB_usage"], mode='lines', name='Uplink', line=dict(color=MAGENTA)))
     return fig_prb
 
-def traffic(data, bh_df):
-    trff_df = data.copy()
+def traffic(data, bh_pos, codigo_dia):
+    # Promedio y suma diarios en una sola pasada con bincount sobre el código de día (los NaN no cuentan, como en groupby)
+    dias = data["Timestamp"].dt.normalize().to_numpy()[bh_pos] # Un día por código, en el mismo orden
+    suma, promedio = suma_y_promedio(codigo_dia, data["L.Thrp.bits.DL(bit)"], len(dias))
 
-    trff_avg_df = trff_df.groupby(trff_df["Timestamp"].dt.date)["L.Thrp.bits.DL(bit)"].mean().reset_index() # Promedio del tráfico de cada hora del día
-    trff_avg_df["L.Thrp.bits.DL(bit)"] = trff_avg_df["L.Thrp.bits.DL(bit)"].apply(bit_to_GB) # Conversion de bit a GB
-
-    trff_sum_df = trff_df.groupby(trff_df["Timestamp"].dt.date)["L.Thrp.bits.DL(bit)"].sum().reset_index() # Suma del tráfico de cada hora del día
-    trff_sum_df["L.Thrp.bits.DL(bit)"] = trff_sum_df["L.Thrp.bits.DL(bit)"].apply(bit_to_GB) # Conversion de bit a GB
+    trff_avg_df = pd.DataFrame({"Timestamp": dias, "L.Thrp.bits.DL(bit)": bits_a_gb(promedio)}) # Promedio del tráfico de cada hora del día en GB
+    trff_sum_df = pd.DataFrame({"Timestamp": dias, "L.Thrp.bits.DL(bit)": bits_a_gb(suma)}) # Suma del tráfico de cada hora del día en GB
 
     # Calculo de tráfico en BH
-    trff_bh = data[data["Timestamp"].isin(bh_df["Timestamp"])].copy() # Genero copia del df de datos unicamente de las casillas dentro del BH
-    trff_bh = trff_bh[["Timestamp", "L.Thrp.bits.DL(bit)"]] # Solo columnas necesarias
-    trff_bh["L.Thrp.bits.DL(bit)_BH"] = trff_bh["L.Thrp.bits.DL(bit)"].apply(bit_to_GB) # Conversión de bit a GB
-    trff_bh = trff_bh.reset_index(drop=True) # Reiniciar indices sin insertar indices antiguos en columna nueva
+    trff_bh = data[["Timestamp", "L.Thrp.bits.DL(bit)"]].iloc[bh_pos].reset_index(drop=True) # Solo columnas necesarias y filas en BH
+    trff_bh["L.Thrp.bits.DL(bit)_BH"] = bits_a_gb(trff_bh["L.Thrp.bits.DL(bit)"]) # Conversión de bit a GB
 
     return trff_avg_df, trff_sum_df, trff_bh
 
@@ -700,15 +862,80 @@ def graph_trff(trff_avg_df, trff_sum_df, trff_bh):
     fig_trff.add_trace(go.Scatter(x=trff_bh["Timestamp"], y=trff_bh["L.Thrp.bits.DL(bit)_BH"], mode='lines', name='Traffic_BH', line=dict(color=MORADO_WOM))) # Agrega la segunda línea a la misma figura
     return fig_trff
 
-def user_exp(data, bh_df):
-    data = data[data["Timestamp"].isin(bh_df["Timestamp"])].copy()
-    user_exp_df = data[["Timestamp","L.Thrp.bits.DL(bit)", "L.Thrp.bits.DL.LastTTI(bit)", "L.Thrp.Time.DL.RmvLastTTI(ms)"]] # Solo columnas necesarias
+def user_exp(data, bh_pos):
+    user_exp_df = data[["Timestamp","L.Thrp.bits.DL(bit)", "L.Thrp.bits.DL.LastTTI(bit)", "L.Thrp.Time.DL.RmvLastTTI(ms)"]].iloc[bh_pos] # Solo columnas necesarias y filas en BH
 
     user_exp_df = user_exp_df.reset_index(drop=True)
-    user_exp_df["User_Exp"] = ((user_exp_df["L.Thrp.bits.DL(bit)"]-user_exp_df["L.Thrp.bits.DL.LastTTI(bit)"]) / (user_exp_df["L.Thrp.Time.DL.RmvLastTTI(ms)"])) / 1024 # Calculo user experience
+    user_exp_df["User_Exp"] = experiencia_usuario(user_exp_df["L.Thrp.bits.DL(bit)"], user_exp_df["L.Thrp.bits.DL.LastTTI(bit)"], user_exp_df["L.Thrp.Time.DL.RmvLastTTI(ms)"]) # Calculo user experience
     
     return user_exp_df
     
+def estados_seleccion(data, selected_cell, geo_agg, start_date, end_date):
+    # Estados combinables por día de la selección. Una celda no tiene estados guardados porque es una sola serie por
+    # hora: se arman desde las filas ya consultadas
+    if geo_agg == "celda":
+        data = data.assign(Date=data["Timestamp"].dt.normalize())
+        return estados_kpi.estados(data, ["Date"]).rename(columns={"Date": "Timestamp"})
+    return estados_query(selected_cell, geo_agg, start_date, end_date)
+
+def percentiles(estados_df, frecuencia=None):
+    # Percentil de ocupación de PRBs y experiencia de usuario de las celdas-hora por día, o por semana/mes combinando
+    # los estados de los días (no es un promedio de percentiles diarios)
+    if estados_df.empty:
+        return estados_df
+    if frecuencia is not None:
+        estados_df = estados_kpi.combinar(estados_df, [pd.Grouper(key="Timestamp", freq=frecuencia)])
+    return pd.DataFrame({"Timestamp": estados_df["Timestamp"],
+                         "PRB_p95": estados_kpi.percentil(estados_df, "prb"),
+                         "User_Exp_p95": estados_kpi.percentil(estados_df, "uexp")})
+
+def graph_percentiles(fig_prb, fig_uexp, percentiles_df):
+    if percentiles_df.empty:
+        return
+    fig_prb.add_trace(go.Scatter(x=percentiles_df["Timestamp"], y=percentiles_df["PRB_p95"], mode='lines', name='Downlink P95 celdas', line=dict(color=MORADO_WOM, dash="dot")))
+    fig_uexp.add_trace(go.Scatter(x=percentiles_df["Timestamp"], y=percentiles_df["User_Exp_p95"], mode='lines', name='U_exp P95 celdas', line=dict(dash="dot")))
+
+def reducir_min_max(x, y, intervalos=PUNTOS_POR_TRAZO // 2):
+    # Reduce una serie a un mínimo y un máximo por intervalo, conservando los picos (M4/min-max por pixel).
+    # Si la serie ya es pequeña se devuelve igual
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    if len(y) <= 2 * intervalos:
+        return x, y
+
+    validos = np.flatnonzero(np.isfinite(y)) # Los valores nulos no participan en la búsqueda de picos
+    if len(validos) == 0:
+        return x[:0], y[:0]
+    intervalo = (validos * intervalos) // len(y) # Intervalo al que pertenece cada punto
+    orden = validos[np.lexsort((y[validos], intervalo))] # Orden por intervalo y dentro de él por valor
+    intervalo_ordenado = (orden * intervalos) // len(y)
+    inicios = np.flatnonzero(np.r_[True, intervalo_ordenado[1:] != intervalo_ordenado[:-1]]) # Mínimo de cada intervalo
+    finales = np.r_[inicios[1:] - 1, len(orden) - 1] # Máximo de cada intervalo
+    posiciones = np.unique(np.concatenate([orden[inicios], orden[finales]])) # Ordenadas en el tiempo
+
+    return x[posiciones], y[posiciones]
+
+def series_horarias(data):
+    # Series de cada gráfica en la vista por hora: id de la gráfica -> lista de (nombre, valores, color)
+    dl_prb = uso_prb(data["L.ChMeas.PRB.DL.Used.Avg"], data["L.ChMeas.PRB.DL.Avail"]) # % ocupación en downlink
+    ul_prb = uso_prb(data["L.ChMeas.PRB.UL.Used.Avg"], data["L.ChMeas.PRB.UL.Avail"]) # % ocupación en uplink
+    user_exp = experiencia_usuario(data["L.Thrp.bits.DL(bit)"], data["L.Thrp.bits.DL.LastTTI(bit)"], data["L.Thrp.Time.DL.RmvLastTTI(ms)"]) # Calculo user experience
+
+    return {
+        "bh": [("Avg", data["L.Traffic.ActiveUser.DL.Avg"], None), ("Max", data["L.Traffic.ActiveUser.DL.Max"], None)],
+        "PRB": [("Downlink", dl_prb, MORADO_WOM), ("Uplink", ul_prb, MAGENTA)],
+        "traffic": [("Traffic", bits_a_gb(data["L.Thrp.bits.DL(bit)"]), None)],
+        "user_exp": [("U_exp", user_exp, None)],
+    }
+
+def figura_horaria(timestamps, series):
+    # Figura con un trazo Scattergl (WebGL) por serie, reducido a PUNTOS_POR_TRAZO puntos como máximo
+    fig = go.Figure()
+    for nombre, valores, color in series:
+        x, y = reducir_min_max(timestamps, valores)
+        fig.add_trace(go.Scattergl(x=x, y=y, mode="lines", name=nombre, line=dict(color=color) if color else None))
+    return fig
+
 def convert_timestamp(timestamp_str):
     try:
         # Intentar convertir el Timestamp a datetime directamente
@@ -717,96 +944,6 @@ def convert_timestamp(timestamp_str):
         # Si falla, asumir que la hora es 00:00:00 y agregar ese componente
         return datetime.strptime(timestamp_str + " 00:00:00", "%Y-%m-%d %H:%M:%S")
     
-def query_to_df(seleccion, geo_agregacion, start_date, end_date):
-    try:
-        conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
-
-        # Realizar consulta a la base de datos PostgreSQL dentro del rango de fechas seleccionado
-        cur = conn.cursor()
-
-        if geo_agregacion == "celda":
-            cur.execute("""SELECT "Timestamp","Cell_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_cell" 
-                    WHERE UPPER("Cell_name") = %s
-                    AND DATE("Timestamp") BETWEEN %s AND %s""", (seleccion, start_date, end_date))
-            columnas = ["Timestamp","Cell_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-        
-        elif geo_agregacion == "sector":
-            cur.execute("""SELECT "Timestamp","sector_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_sector" 
-                    WHERE UPPER("sector_name") = %s
-                    AND DATE("Timestamp") BETWEEN %s AND %s""", (seleccion, start_date, end_date))
-            columnas = ["Timestamp","sector_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-        
-        elif geo_agregacion == "EB":
-            cur.execute("""SELECT "Timestamp","node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_node" 
-                    WHERE UPPER("node_name") = %s
-                    AND DATE("Timestamp") BETWEEN %s AND %s""", (seleccion, start_date, end_date))
-            columnas = ["Timestamp","node_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-        
-        elif geo_agregacion == "cluster":
-            cur.execute("""SELECT "Timestamp","cluster_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_cluster" 
-                    WHERE "cluster_name" = %s
-                    AND DATE("Timestamp") BETWEEN %s AND %s""", (seleccion, start_date, end_date))
-            columnas = ["Timestamp","cluster_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-        
-        elif geo_agregacion == "localidad":
-            cur.execute("""SELECT "Timestamp","localidad_dane_code","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_localidad" 
-                    WHERE "localidad_dane_code" = %s
-                    AND DATE("Timestamp") BETWEEN %s AND %s""", (seleccion, start_date, end_date))
-            columnas = ["Timestamp","localidad_dane_code","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-        
-        elif geo_agregacion == "municipio":
-            cur.execute("""SELECT "Timestamp","municipio_dane_code","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_municipio" 
-                    WHERE "municipio_dane_code" = %s
-                    AND DATE("Timestamp") BETWEEN %s AND %s""", (seleccion, start_date, end_date))
-            columnas = ["Timestamp","municipio_dane_code","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-
-        elif geo_agregacion == "AM":
-            cur.execute("""SELECT "Timestamp","am_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_am" 
-                    WHERE "am_name" = %s
-                    AND DATE("Timestamp") BETWEEN %s AND %s""", (seleccion, start_date, end_date))
-            columnas = ["Timestamp","am_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-
-        elif geo_agregacion == "departamento":
-            cur.execute("""SELECT "Timestamp","dpto_dane_code","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_departamento" 
-                    WHERE "dpto_dane_code" = %s
-                    AND DATE("Timestamp") BETWEEN %s AND %s""", (seleccion, start_date, end_date))
-            columnas = ["Timestamp","dpto_dane_code","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-
-        elif geo_agregacion == "regional":
-            cur.execute("""SELECT "Timestamp","regional_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_regional" 
-                    WHERE "regional_name" = %s
-                    AND DATE("Timestamp") BETWEEN %s AND %s""", (seleccion, start_date, end_date))
-            columnas = ["Timestamp","regional_name","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-
-        elif geo_agregacion == "total":
-            cur.execute("""SELECT "Timestamp","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)" 
-                    FROM "ran_1h_total" 
-                    WHERE DATE("Timestamp") BETWEEN %s AND %s""", (start_date, end_date))
-            columnas = ["Timestamp","L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
-
-        rows = cur.fetchall()
-        df = pd.DataFrame(rows, columns=columnas)
-        df = df.sort_values(by="Timestamp")
-        cur.close()
-
-        return df
-    
-    except Exception as e:
-        print("Error al obtener información de la selección: ", e)
-        return pd.DataFrame()
-    
-    finally:
-        conn.close() # Siempre se va a cerrar la conexión sin importar si hubo excepción o no. Buena práctica por si hay un error
-
 # Callback para gráficar la selección del usuario a partir de la agregación
 @callback(
         Output(component_id='test', component_property='children'),
@@ -816,6 +953,7 @@ def query_to_df(seleccion, geo_agregacion, start_date, end_date):
         Output(component_id='bh', component_property='figure'),
         Output(component_id='PRB', component_property='figure'),
         Output(component_id='graph_test', component_property='figure'),
+        Output(component_id='consulta_horaria', component_property='data'),
 
         Input(component_id='solicitar', component_property='n_clicks'),
 
@@ -825,8 +963,13 @@ def query_to_df(seleccion, geo_agregacion, start_date, end_date):
         State(component_id="time", component_property='start_date'),
         State(component_id="time", component_property='end_date'),
 
-        running=[(Output(component_id='solicitar', component_property='disabled'), True, False)] # Mientras el callback esté corriendo desactiva el botón
+        background=True, # Se ejecuta como trabajo en segundo plano para no ocupar un worker web
+        running=[(Output(component_id='solicitar', component_property='disabled'), True, False)], # Mientras el callback esté corriendo desactiva el botón
+        cancel=[Input(component_id="aggregation", component_property='value'), # Si el usuario cambia su selección se cancela el trabajo
+                Input(component_id='select', component_property='value')],
 )
+@medir("callback.update_graphs")
+@deduplicar(ignorar=(0,)) # Solicitudes idénticas en curso comparten el cálculo (n_clicks no hace parte de la llave)
 def update_graphs(boton, geo_agg, selected_cell, time_agg, start_date, end_date):
     if boton is None:  # Se debe presionar el boton para que se actualice el callback
         raise PreventUpdate
@@ -840,7 +983,7 @@ def update_graphs(boton, geo_agg, selected_cell, time_agg, start_date, end_date)
     
     if selected_cell is None:
         container = "Por favor haz una selección"
-        return container, no_update, no_update, no_update, no_update, no_update, no_update # Solo se actualiza la salida de texto, el resto se queda igual
+        return container, no_update, no_update, no_update, no_update, no_update, no_update, no_update # Solo se actualiza la salida de texto, el resto se queda igual
 
     container = f"Su selección es: {selected_cell} en el rango de fechas {start_date} -> {end_date}"
 
@@ -848,58 +991,47 @@ def update_graphs(boton, geo_agg, selected_cell, time_agg, start_date, end_date)
     if data.empty:
         container = f"No hay datos para su selección {selected_cell} en el rango de fechas {start_date} - {end_date}"
         fig = go.Figure(data=[go.Scatter(x=[], y=[])]) # Figura vacia
-        return container, None, fig, fig, fig, fig, fig # Se actualiza salido de texto y se retornan gráficos vacios
+        return container, None, fig, fig, fig, fig, fig, None # Se actualiza salido de texto y se retornan gráficos vacios
+
+    consulta_horaria = None # Solo se guarda la consulta en la vista por hora, que es la que se vuelve a consultar con zoom
 
     if time_agg == "hora":
-        # Graficar por hora
-        bh_df = data[["Timestamp", "L.Traffic.ActiveUser.DL.Avg", "L.Traffic.ActiveUser.DL.Max"]].copy()
-        bh_df['Date'] = bh_df['Timestamp'].dt.date # Vuelvo a crear columna Date y Time que se habían perdido con el fin de gráficar respecto a la fecha y mostrar la hora
-        bh_df['Time'] = bh_df['Timestamp'].dt.strftime('%H:%M') # Formato para que solo sea Hora y Minuto
-        fig_bh = go.Figure() # Crea una figura vacía
-        fig_bh.add_trace(go.Scatter(x=bh_df["Timestamp"], y=bh_df["L.Traffic.ActiveUser.DL.Avg"], mode="lines", name="Avg"))
-        fig_bh.add_trace(go.Scatter(x=bh_df["Timestamp"], y=bh_df["L.Traffic.ActiveUser.DL.Max"], mode="lines", name="Max"))
-
-        # Ocupación PRB por hora
-        prb_df = data[["Timestamp", "L.ChMeas.PRB.DL.Avail", "L.ChMeas.PRB.DL.Used.Avg", "L.ChMeas.PRB.UL.Avail", "L.ChMeas.PRB.UL.Used.Avg"]].copy()# Solo columnas necesarias
-        prb_df = prb_df.reset_index(drop=True)
-        prb_df["DL_PRB_usage"] = (prb_df["L.ChMeas.PRB.DL.Used.Avg"] / prb_df["L.ChMeas.PRB.DL.Avail"]) * 100 # Cálculo de % ocupación en downlink y guardado en nueva columna
-        prb_df["UL_PRB_usage"] = (prb_df["L.ChMeas.PRB.UL.Used.Avg"] / prb_df["L.ChMeas.PRB.UL.Avail"]) * 100 # # Cálculo de % ocupación en uplink y guardado en nueva columna
-        fig_prb = graph_prb(prb_df)
-        gauge_value = prb_df["DL_PRB_usage"].mean() # Se saca el promedio de ocupación de PRBs de todos los días calculados
+        # Graficar por hora. Las series se dibujan con WebGL y se reducen conservando picos (mínimo y máximo por
+        # intervalo), así el tamaño de la figura no depende de la cantidad de días seleccionados
+        series = series_horarias(data)
+        fig_bh = figura_horaria(data["Timestamp"], series["bh"])
+        fig_prb = figura_horaria(data["Timestamp"], series["PRB"])
+        fig_trff = figura_horaria(data["Timestamp"], series["traffic"])
+        fig_uexp = figura_horaria(data["Timestamp"], series["user_exp"])
+
+        gauge_value = series["PRB"][0][1].mean() # Se saca el promedio de ocupación de PRBs de todas las horas
         print("gauge value: ", gauge_value)
 
-        # Gráfica de tráfico
-        trff_df = data[["Timestamp","L.Thrp.bits.DL(bit)"]].copy() # Solo columnas necesarias
-        trff_df["L.Thrp.bits.DL(bit)"] = trff_df["L.Thrp.bits.DL(bit)"].apply(bit_to_GB) # De bits a GB
-        fig_trff = go.Figure(data=go.Scatter(x=trff_df["Timestamp"], y=trff_df["L.Thrp.bits.DL(bit)"], mode="lines", name="Traffic"))
-
-        # Gráfica de user experience
-        user_exp_df = data[["Timestamp","L.Thrp.bits.DL(bit)", "L.Thrp.bits.DL.LastTTI(bit)", "L.Thrp.Time.DL.RmvLastTTI(ms)"]].copy() # Solo columnas necesarias
-        user_exp_df = user_exp_df.reset_index(drop=True)
-        user_exp_df["User_Exp"] = ((user_exp_df["L.Thrp.bits.DL(bit)"]-user_exp_df["L.Thrp.bits.DL.LastTTI(bit)"]) / (user_exp_df["L.Thrp.Time.DL.RmvLastTTI(ms)"])) / 1024 # Calculo user experience
-        fig_uexp = go.Figure(data=go.Scatter(x=user_exp_df["Timestamp"], y=user_exp_df["User_Exp"], mode="lines", name="U_exp"))
+        consulta_horaria = {"seleccion": selected_cell, "agregacion": geo_agg, "inicio": start_date, "fin": end_date}
     
     else: # Si es una agregación temporal diferente de hora
 
-        # Calculo BH(hora pico) por día
-        bh_df = bh(data, "L.Traffic.ActiveUser.DL.Avg")
-        bh_df_max = bh(data, "L.Traffic.ActiveUser.DL.Max")
+        # Calculo BH(hora pico) por día. El código de día se calcula una vez y el resto de KPIs en BH se toman por
+        # posición de las filas de BH, sin volver a recorrer los datos
+        codigo_dia = codigos_grupo(data["Timestamp"].dt.normalize())
+        bh_df, bh_pos = bh(data, "L.Traffic.ActiveUser.DL.Avg", codigo_dia)
+        bh_df_max, _ = bh(data, "L.Traffic.ActiveUser.DL.Max", codigo_dia)
 
         # Calculo ocupación PRBs
-        prb_df = PRB_usg(data, bh_df)
+        prb_df = PRB_usg(data, bh_pos)
         gauge_value = prb_df["DL_PRB_usage"].mean() # Se saca el promedio de ocupación de PRBs de todos los días calculados
 
         # Calculo y grafica de tráfico
-        trff_avg_df, trff_sum_df, trff_bh = traffic(data, bh_df)
+        trff_avg_df, trff_sum_df, trff_bh = traffic(data, bh_pos, codigo_dia)
 
         # Calculo y gráfica de experiencia de usuario
-        user_exp_df = user_exp(data, bh_df)
+        user_exp_df = user_exp(data, bh_pos)
 
         if time_agg == "semana":
             # BH(Hora pico)
             # Agrupar los datos por semana y calcular los promedios
             agg_bh_df = bh_df.resample('W-Mon', on='Timestamp').mean().reset_index() # W-Mon significa que la semana empieza el lunes
-            agg_bh_df_max = bh_df_max.resample('W-Mon', on='Timestamp').mean().reset_index()
+            agg_bh_df_max = bh_df_max.resample('W-Mon', on='Timestamp').max().reset_index() # El máximo de la semana es el mayor de sus días
 
             fig_bh = go.Figure() # Crea una figura vacía
             fig_bh.add_trace(go.Bar(x=agg_bh_df["Timestamp"], y=agg_bh_df["L.Traffic.ActiveUser.DL.Avg"], name="Avg", marker=dict(color=MORADO_WOM)))
@@ -912,8 +1044,6 @@ def update_graphs(boton, geo_agg, selected_cell, time_agg, start_date, end_date)
             print("Ocupacion PRB semana agregado")
 
             # Trafico
-            trff_avg_df["Timestamp"] = pd.to_datetime(trff_avg_df['Timestamp']) # Convierto a timestamp de nuevo porque me estaba generando un error
-            trff_sum_df["Timestamp"] = pd.to_datetime(trff_sum_df['Timestamp'])
             agg_trff_df = trff_avg_df.resample('W-Mon', on='Timestamp').mean().reset_index()
             agg_trff_sum_df = trff_sum_df.resample('W-Mon', on='Timestamp').sum().reset_index()
             agg_trff_df_bh = trff_bh.resample('W-Mon', on='Timestamp').mean().reset_index()
@@ -929,7 +1059,7 @@ def update_graphs(boton, geo_agg, selected_cell, time_agg, start_date, end_date)
             # BH(Hora pico)
             # Agrupar los datos por semana y calcular los promedios
             agg_bh_df = bh_df.resample('MS', on='Timestamp').mean().reset_index() # MS significa inicio de mes (calendar month begin)
-            agg_bh_df_max = bh_df_max.resample('MS', on='Timestamp').mean().reset_index()
+            agg_bh_df_max = bh_df_max.resample('MS', on='Timestamp').max().reset_index() # El máximo del mes es el mayor de sus días
 
             fig_bh = go.Figure() # Crea una figura vacía
             fig_bh.add_trace(go.Bar(x=agg_bh_df["Timestamp"], y=agg_bh_df["L.Traffic.ActiveUser.DL.Avg"], name="Avg", marker=dict(color=MORADO_WOM)))
@@ -943,8 +1073,6 @@ def update_graphs(boton, geo_agg, selected_cell, time_agg, start_date, end_date)
             print("Ocupacion PRB mes agregado")
             
             # Trafico
-            trff_avg_df["Timestamp"] = pd.to_datetime(trff_avg_df['Timestamp']) # Convierto a timestamp de nuevo porque me estaba generando un error
-            trff_sum_df["Timestamp"] = pd.to_datetime(trff_sum_df['Timestamp'])
             agg_trff_df = trff_avg_df.resample('MS', on='Timestamp').mean().reset_index()
             agg_trff_sum_df = trff_sum_df.resample('MS', on='Timestamp').sum().reset_index()
             agg_trff_df_bh = trff_bh.resample('MS', on='Timestamp').mean().reset_index()
@@ -965,6 +1093,10 @@ def update_graphs(boton, geo_agg, selected_cell, time_agg, start_date, end_date)
             fig_trff = graph_trff(trff_avg_df, trff_sum_df, trff_bh) # Graficar tráfico
             fig_uexp = go.Figure(data=go.Scatter(x=user_exp_df["Timestamp"], y=user_exp_df["User_Exp"], mode="lines", name="U_exp")) # Graficar user experience
 
+        # P95 de las celdas-hora, con los estados por día combinados en el periodo de la vista
+        estados_df = estados_seleccion(data, selected_cell, geo_agg, start_date, end_date)
+        graph_percentiles(fig_prb, fig_uexp, percentiles(estados_df, {"semana": 'W-Mon', "mes": 'MS'}.get(time_agg)))
+
     # Arreglar estilos de gráficos
     fig_trff.update_layout( {
         "margin": {"l": 0, "r": 10, "b": 0, "t": 40}, 
@@ -1023,7 +1155,158 @@ def update_graphs(boton, geo_agg, selected_cell, time_agg, start_date, end_date)
     
     fig_fullscreen = go.Figure(data=[go.Scatter(x=[], y=[])]) # Figura fullscreen queda vacia cada vez que se haga una selección
 
-    return container, gauge_value, fig_trff, fig_uexp, fig_bh, fig_prb, fig_fullscreen
+    return container, gauge_value, fig_trff, fig_uexp, fig_bh, fig_prb, fig_fullscreen, consulta_horaria
+
+
+# Callback para volver a consultar con resolución completa el rango visible cuando se hace zoom en la vista por hora
+@callback(
+        Output(component_id='bh', component_property='figure', allow_duplicate=True),
+        Output(component_id='PRB', component_property='figure', allow_duplicate=True),
+        Output(component_id='traffic', component_property='figure', allow_duplicate=True),
+        Output(component_id='user_exp', component_property='figure', allow_duplicate=True),
+
+        Input(component_id='bh', component_property='relayoutData'),
+        Input(component_id='PRB', component_property='relayoutData'),
+        Input(component_id='traffic', component_property='relayoutData'),
+        Input(component_id='user_exp', component_property='relayoutData'),
+
+        State(component_id='consulta_horaria', component_property='data'),
+        prevent_initial_call=True
+)
+@medir("callback.zoom_horario")
+def zoom_horario(relayout_bh, relayout_prb, relayout_trff, relayout_uexp, consulta):
+    if consulta is None: # Solo aplica para la vista por hora
+        raise PreventUpdate
+
+    grafica = ctx.triggered_id
+    relayout = ctx.triggered[0]["value"] or {}
+
+    if "xaxis.range[0]" in relayout: # Zoom o desplazamiento sobre el eje x
+        inicio = pd.Timestamp(relayout["xaxis.range[0]"])
+        fin = pd.Timestamp(relayout["xaxis.range[1]"])
+    elif "xaxis.range" in relayout:
+        inicio, fin = pd.Timestamp(relayout["xaxis.range"][0]), pd.Timestamp(relayout["xaxis.range"][1])
+    elif relayout.get("xaxis.autorange"): # Doble clic para volver a la vista completa
+        inicio, fin = pd.Timestamp(consulta["inicio"]), pd.Timestamp(consulta["fin"]) + timedelta(days=1)
+    else:
+        raise PreventUpdate
+
+    # Se consultan solo los días visibles, sin salir del rango de la consulta original
+    start_date = max(inicio.normalize(), pd.Timestamp(consulta["inicio"])).strftime("%Y-%m-%d")
+    end_date = min(fin.normalize(), pd.Timestamp(consulta["fin"])).strftime("%Y-%m-%d")
+    data = query_to_df(consulta["seleccion"], consulta["agregacion"], start_date, end_date)
+    if data.empty:
+        raise PreventUpdate
+
+    data = data[(data["Timestamp"] >= inicio) & (data["Timestamp"] <= fin)]
+    series = series_horarias(data)[grafica]
+
+    patched_figure = Patch() # Solo se reemplazan los datos de los trazos, el zoom del usuario se conserva
+    for i, (nombre, valores, color) in enumerate(series):
+        x, y = reducir_min_max(data["Timestamp"], valores)
+        patched_figure["data"][i]["x"] = x
+        patched_figure["data"][i]["y"] = y
+
+    salidas = {"bh": no_update, "PRB": no_update, "traffic": no_update, "user_exp": no_update}
+    salidas[grafica] = patched_figure
+    return salidas["bh"], salidas["PRB"], salidas["traffic"], salidas["user_exp"]
+
+
+def kpis_comparacion(data, name_column, time_agg):
+    # KPIs de todas las selecciones a comparar en una sola pasada: BH por selección y día con un groupby
+    # vectorizado, y luego agregación temporal por selección. Devuelve un df con una fila por selección y periodo
+    if time_agg == "hora":
+        kpi_df = data[[name_column, "Timestamp"]].copy()
+        kpi_df["Users"] = data["L.Traffic.ActiveUser.DL.Avg"]
+        fuente = data
+    else:
+        dias = data["Timestamp"].dt.normalize()
+        bh_index = hora_pico(codigos_grupo(data[name_column], dias), data["L.Traffic.ActiveUser.DL.Avg"]) # Hora pico de cada selección y día
+        fuente = data.iloc[bh_index]
+        kpi_df = fuente[[name_column]].copy()
+        kpi_df["Timestamp"] = fuente["Timestamp"].dt.normalize()
+        kpi_df["Users"] = fuente["L.Traffic.ActiveUser.DL.Avg"]
+
+    kpi_df["PRB"] = uso_prb(fuente["L.ChMeas.PRB.DL.Used.Avg"], fuente["L.ChMeas.PRB.DL.Avail"]) # % ocupación en downlink
+    kpi_df["Traffic"] = bits_a_gb(fuente["L.Thrp.bits.DL(bit)"]) # Tráfico en GB
+    kpi_df["User_Exp"] = experiencia_usuario(fuente["L.Thrp.bits.DL(bit)"], fuente["L.Thrp.bits.DL.LastTTI(bit)"], fuente["L.Thrp.Time.DL.RmvLastTTI(ms)"]) # Calculo user experience
+
+    frecuencias = {"semana": "W-MON", "mes": "MS"} # Mismos periodos que la vista de una sola selección
+    if time_agg in frecuencias:
+        kpi_df = kpi_df.groupby([name_column, pd.Grouper(key="Timestamp", freq=frecuencias[time_agg])]).mean().reset_index()
+
+    return kpi_df
+
+def figura_comparacion(kpi_df, name_column, columna, titulo, eje_y, sufijo):
+    # Una línea por selección sobre la misma gráfica
+    fig = go.Figure()
+    colores = px.colors.qualitative.Bold
+    for i, (nombre, grupo) in enumerate(kpi_df.groupby(name_column, sort=True)):
+        x, y = reducir_min_max(grupo["Timestamp"], grupo[columna])
+        fig.add_trace(go.Scattergl(x=x, y=y, mode="lines", name=str(nombre), line=dict(color=colores[i % len(colores)])))
+
+    fig.update_traces(hovertemplate="<b>%{fullData.name}</b><br><b>Date</b>: %{x}<br><b>Value</b>: %{y:.2f} " + sufijo)
+    fig.update_layout(title=titulo, xaxis_title="Date", yaxis_title=eje_y, legend=dict(orientation="h"),
+                      margin={"l": 0, "r": 10, "b": 0, "t": 40})
+    return fig
+
+# Callback para el modo comparación: varias selecciones de la misma agregación superpuestas en las cuatro gráficas
+@callback(
+        Output(component_id='test', component_property='children', allow_duplicate=True),
+        Output(component_id='traffic', component_property='figure', allow_duplicate=True),
+        Output(component_id='user_exp', component_property='figure', allow_duplicate=True),
+        Output(component_id='bh', component_property='figure', allow_duplicate=True),
+        Output(component_id='PRB', component_property='figure', allow_duplicate=True),
+        Output(component_id='consulta_horaria', component_property='data', allow_duplicate=True),
+
+        Input(component_id='comparar_boton', component_property='n_clicks'),
+
+        State(component_id="aggregation", component_property='value'),
+        State(component_id='comparar', component_property='value'),
+        State(component_id="time_agg", component_property='value'),
+        State(component_id="time", component_property='start_date'),
+        State(component_id="time", component_property='end_date'),
+
+        background=True, # Se ejecuta como trabajo en segundo plano para no ocupar un worker web
+        running=[(Output(component_id='comparar_boton', component_property='disabled'), True, False)],
+        cancel=[Input(component_id="aggregation", component_property='value')],
+        prevent_initial_call=True
+)
+@medir("callback.compare_graphs")
+@deduplicar(ignorar=(0,))
+def compare_graphs(boton, geo_agg, selecciones, time_agg, start_date, end_date):
+    if (start_date is None) and (end_date is None): # Mismo rango por defecto que la vista de una sola selección
+        today = datetime.today()
+        end_date = today - timedelta(days=1)
+        start_date = end_date - timedelta(days=30)
+        end_date = end_date.strftime("%Y-%m-%d") # Paso a string
+        start_date = start_date.strftime("%Y-%m-%d")
+
+    if geo_agg == "total":
+        container = "La comparación necesita una agregación geográfica distinta a Total"
+        return container, no_update, no_update, no_update, no_update, no_update
+    if not selecciones:
+        container = "Selecciona uno o más elementos para comparar"
+        return container, no_update, no_update, no_update, no_update, no_update
+
+    selecciones = tuple(sorted(selecciones, key=str)[:MAX_COMPARACION])
+    name_column = COLUMNAS_NOMBRE[geo_agg]
+
+    data = query_multi_df(selecciones, geo_agg, start_date, end_date) # Una sola consulta para todas las selecciones
+    if data.empty:
+        container = f"No hay datos para las selecciones en el rango de fechas {start_date} - {end_date}"
+        return container, no_update, no_update, no_update, no_update, no_update
+
+    kpi_df = kpis_comparacion(data, name_column, time_agg)
+
+    periodo = " per hour" if time_agg == "hora" else " in BH" # La vista por hora muestra todas las horas, no hay BH
+    fig_bh = figura_comparacion(kpi_df, name_column, "Users", "Avg users" + periodo, "Users", "users")
+    fig_prb = figura_comparacion(kpi_df, name_column, "PRB", "PRB occupation" + periodo, "Usage in %", "%")
+    fig_trff = figura_comparacion(kpi_df, name_column, "Traffic", "DL Data Traffic" + periodo, "Traffic (GB)", "GB")
+    fig_uexp = figura_comparacion(kpi_df, name_column, "User_Exp", "User Experience" + periodo, "User experience (Mbps)", "Mbps")
+
+    container = f"Comparación de {len(selecciones)} selecciones en el rango de fechas {start_date} -> {end_date}"
+    return container, fig_trff, fig_uexp, fig_bh, fig_prb, None # Sin consulta por hora, el zoom no vuelve a consultar
 
 
 
@@ -1033,101 +1316,178 @@ def update_graphs(boton, geo_agg, selected_cell, time_agg, start_date, end_date)
 
 
 #--------------------------------------------------------- FUNCIONES CALLBACK QUE MUESTRA KPIs EN MAPA ------------------------------------------------------#
-def map_query(start_date, end_date, kpi, geo_agg, name_column):
-    table_mapping = { # Opciones para completar la consulta segun agregación seleccionada
-        'celda': 'ran_1h_cell',
-        'sector': 'ran_1h_sector',
-        'EB': 'ran_1h_node',
-        'cluster': 'ran_1h_cluster',
-        'localidad': 'ran_1h_localidad',
-        'municipio': 'ran_1h_municipio',
-        'AM': 'ran_1h_am',
-        'departamento': 'ran_1h_departamento',
-        'regional': 'ran_1h_regional',
-        'total': 'ran_1h_total'
+# Columna con la que se colorea el mapa para cada KPI
+COLUMNAS_GRAFICA_MAPA = {"BH": "L.Traffic.ActiveUser.DL.Avg", "PRB": "DL_PRB_usage", "Traffic": "L.Thrp.bits.DL(GB)", "u_exp": "User_Exp"}
+
+def valores_mapa(agg, kpi, start_date, end_date):
+    # Valor del KPI en BH promediado por marcador o polígono. Las ventanas por defecto las precalcula el ETL, en ese
+    # caso sale de una sola consulta indexada; para rangos personalizados se calcula desde los datos por hora.
+    # Devuelve (df con columnas [nombre, KPI], columna del KPI) o (None, columna) si no hay datos
+    data_column = COLUMNAS_NOMBRE[agg]
+    graph_column = COLUMNAS_GRAFICA_MAPA[kpi]
+
+    snapshot = map_snapshot(agg, kpi, start_date, end_date)
+    if not snapshot.empty:
+        print(f"KPI {kpi} del mapa servido desde el snapshot {start_date} - {end_date}")
+        base, llave = base_mapa(agg)
+        snapshot["nombre"] = nombres_como_llave(snapshot["nombre"], base[llave].dtype) # El snapshot trae los nombres como texto
+        return snapshot.rename(columns={"nombre": data_column, "valor": graph_column}), graph_column
+
+    df = map_query(start_date, end_date, kpi, agg, data_column) # Llamado a la función que hace la consulta
+    if df.empty:
+        return None, graph_column
+
+    # Encontrar hora pico (BH)
+    bh_day = hora_pico(codigos_grupo(df[data_column], df['Timestamp'].dt.normalize()), df["L.Traffic.ActiveUser.DL.Avg"]) # Horas donde los usuarios son máximos por nombre y día
+    bh_df = df.iloc[bh_day].copy() # Creo un nuevo df con las horas pico por día
+
+    if kpi == "PRB":
+        bh_df["DL_PRB_usage"] = uso_prb(bh_df["L.ChMeas.PRB.DL.Used.Avg"], bh_df["L.ChMeas.PRB.DL.Avail"]) # Cálculo de % ocupación en downlink y guardado en nueva columna
+    elif kpi == "Traffic":
+        bh_df["L.Thrp.bits.DL(GB)"] = bits_a_gb(bh_df["L.Thrp.bits.DL(bit)"]) # Conversión de bit a GB
+    elif kpi == "u_exp":
+        bh_df["User_Exp"] = experiencia_usuario(bh_df["L.Thrp.bits.DL(bit)"], bh_df["L.Thrp.bits.DL.LastTTI(bit)"], bh_df["L.Thrp.Time.DL.RmvLastTTI(ms)"]) # Calculo user experience
+
+    bh_df = bh_df.groupby(data_column)[graph_column].mean().reset_index() # Se promedia por nombre de marcador o polígono
+    return bh_df, graph_column
+
+# Agregaciones que se dibujan como polígonos (choropleth), el resto son marcadores
+AGREGACIONES_POLIGONO = ["cluster", "localidad", "municipio", "AM", "departamento", "regional"]
+
+def base_mapa(agg):
+    # Marcadores o polígonos de la agregación y la columna con la que se unen a los valores del KPI
+    if agg == "celda":
+        return df_geo.drop_duplicates(subset=["dwh_cell_name_wom"]).copy(), "dwh_cell_name_wom" # Df con nombres únicos de celda
+    elif agg == "sector":
+        return df_geo.drop_duplicates(subset=["sector_name"]).copy(), "sector_name" # Df con nombres únicos de sector
+    elif agg == "EB":
+        return df_geo.drop_duplicates(subset=["node_name"]).copy(), "node_name" # Df con nombres únicos de nodo
+    elif agg == "cluster":
+        return clusters, "key"
+    elif agg == "localidad":
+        localidades["Localidad"] = localidades["Localidad"].astype(int) # Todas las columnas del df quedaron como string cuando se leyó el GeoJSON, por lo que toca hacer casting para el merge
+        return localidades, "Localidad"
+    elif agg == "municipio":
+        municipios["MPIO_CCNCT"] = municipios["MPIO_CCNCT"].astype(int)
+        return municipios, "MPIO_CCNCT"
+    elif agg == "AM":
+        return areas_metro, "AM"
+    elif agg == "departamento":
+        departamentos["DPTO_CCDGO"] = departamentos["DPTO_CCDGO"].astype(int)
+        return departamentos, "DPTO_CCDGO"
+    elif agg == "regional":
+        return regionales, "DPTO_REGIONAL"
+
+def estilo_kpi_mapa(kpi):
+    # Escala de color, rango y barra de colores de cada KPI. La escala va en formato [[posición, color], ...] para
+    # que sirva igual en la figura completa y en un Patch
+    if kpi in ["BH", "Traffic"]:
+        color_scale = make_colorscale([MORADO_CLARO,MAGENTA_OPACO,MAGENTA,MORADO_WOM,MORADO_OSCURO])
+        kpi_range = None
+
+    elif kpi == "PRB":
+        # Definir la escala de color personalizada
+        color_scale = [
+            [0, 'green'],    # Verde para valor inferior
+            [0.5, 'yellow'],   # Amarillo para valores medios
+            [1, 'red']       # Rojo para valores superior
+        ]
+        kpi_range = [0,100] # Rango a mostrar en la barra de escala
+
+    elif kpi == "u_exp":
+        # Definir la escala de color discreta según la definición de la empresa
+        color_scale = [
+            (0, "darkred"), (1, "darkred"),
+            (1, "red"), (2.5, "red"),
+            (2.5, "orange"), (3.3, "orange"),
+            (3.3, "yellow"), (5, "yellow"),
+            (5, "green"), (9.99999, "green"),
+            (9.99999, "lime"), (12, "lime")
+        ]
+        # Convertir la escala a un formato adecuado para plotly
+        color_scale = [[i / 12, col] for i, col in color_scale]
+        kpi_range = [0,12]
+
+    # Personalizar la barra de colores
+    colorbars = {
+        "BH": dict(title="Users BH"),
+        "PRB": dict(title="PRB usage BH", ticksuffix=" %"),
+        "Traffic": dict(title="Traffic BH", ticksuffix=" GB"),
+        "u_exp": dict(title="User Experience BH",
+                      tickvals=[0, 1, 2.5, 3.3, 5, 10, 12],
+                      ticktext=['0 Mbps', '1 Mbps', '2.5 Mbps', '3.3 Mbps', '5 Mbps', '10 Mbps', '>10 Mbps'],
+                      ticks="outside")
     }
+    return color_scale, kpi_range, colorbars[kpi]
+
+def plantilla_hover(agg, kpi):
+    # Texto al pasar el cursor, igual para la figura completa y para el Patch (no depende de los nombres de columna)
+    titulos = {"BH": ("Users BH", ""), "PRB": ("PRB usage BH", " %"), "Traffic": ("Traffic BH", " GB"), "u_exp": ("User Experience BH", " Mbps")}
+    titulo, sufijo = titulos[kpi]
+    valor = "%{z:.2f}" if agg in AGREGACIONES_POLIGONO else "%{marker.color:.2f}"
+    codigo = "%{customdata[0]}<br>" if agg in ["localidad", "municipio", "departamento"] else "" # Código DANE del polígono
+    return f"<b>%{{hovertext}}</b><br>{codigo}{titulo}: {valor}{sufijo}<extra></extra>"
+
+def valores_teselas(agg, kpi, start_date, end_date):
+    # Valores del KPI alineados con el orden del índice de teselas de la agregación, se calculan una vez por
+    # (KPI, ventana) y los comparten todas las teselas y todos los workers a través del caché compartido. Un
+    # resultado sin ningún valor (consulta fallida o sin datos) no se guarda, así se vuelve a intentar
+    clave = f"valores_teselas:{agg}:{kpi}:{start_date}:{end_date}"
+    valores = cache.get(clave, default=None)
+    if valores is None:
+        valores = calcular_valores_teselas(agg, kpi, start_date, end_date)
+        if valores.notna().any():
+            cache.set(clave, valores, expire=EXPIRACION_TESELAS)
+    return valores
+
+@consulta_compartida
+def calcular_valores_teselas(agg, kpi, start_date, end_date):
+    indice = INDICES_TESELAS[agg]
+    bh_df, graph_column = valores_mapa(agg, kpi, start_date, end_date)
+    if bh_df is None:
+        return pd.Series(np.nan, index=indice.nombres)
+    nombres = bh_df[COLUMNAS_NOMBRE[agg]]
+    if agg == "celda":
+        nombres = nombres.str.upper() # Igual que en el merge del mapa de celdas
+    valores = pd.Series(bh_df[graph_column].values, index=nombres)
+    valores = valores[~valores.index.duplicated()]
+    return valores.reindex(indice.nombres).astype(float)
 
-    table_name = table_mapping[geo_agg] # Elección para completar la consulta según agregación
 
+# Ruta que entrega los marcadores de una tesela del mapa con el valor del KPI, en JSON por columnas.
+# Se guarda en el caché compartido por (agregación, KPI, ventana, tesela) y el navegador también la conserva
+@app.server.route("/teselas_mapa/<agg>/<kpi>/<inicio>/<fin>/<int:z>/<int:x>/<int:y>.json")
+@medir("ruta.tesela_mapa")
+def tesela_mapa(agg, kpi, inicio, fin, z, x, y):
     try:
-        # Conectarse a la base de datos
-        conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+        datetime.strptime(inicio, "%Y-%m-%d") # Validar los parámetros antes de consultar
+        datetime.strptime(fin, "%Y-%m-%d")
+    except ValueError:
+        return Response("Parámetros no validos", status=400)
+    if agg not in INDICES_TESELAS or kpi not in COLUMNAS_GRAFICA_MAPA or not (0 <= z <= ZOOM_INDICE):
+        return Response("Parámetros no validos", status=400)
 
-        # Crear cursor
-        cur = conn.cursor()
-        
-        if kpi == "BH":
-            if geo_agg == 'total':
-                query = sql.SQL("""SELECT "Timestamp", "L.Traffic.ActiveUser.DL.Avg", "L.Traffic.ActiveUser.DL.Max"
-                                FROM {}
-                                WHERE DATE("Timestamp") BETWEEN %s AND %s""").format(sql.Identifier(table_name))
-                columns = ["Timestamp", "L.Traffic.ActiveUser.DL.Avg", "L.Traffic.ActiveUser.DL.Max"]
-            else:
-                query = sql.SQL("""SELECT "Timestamp", {}, "L.Traffic.ActiveUser.DL.Avg", "L.Traffic.ActiveUser.DL.Max"
-                                FROM {}
-                                WHERE DATE("Timestamp") BETWEEN %s AND %s""").format(sql.Identifier(name_column), sql.Identifier(table_name))
-                columns = ["Timestamp", name_column, "L.Traffic.ActiveUser.DL.Avg", "L.Traffic.ActiveUser.DL.Max"]
-        
-        elif kpi == "PRB":
-            if geo_agg == 'total':
-                query = sql.SQL("""SELECT "Timestamp", "L.Traffic.ActiveUser.DL.Avg", "L.ChMeas.PRB.DL.Avail", "L.ChMeas.PRB.DL.Used.Avg", "L.ChMeas.PRB.UL.Avail", "L.ChMeas.PRB.UL.Used.Avg"
-                                FROM {}
-                                WHERE DATE("Timestamp") BETWEEN %s AND %s""").format(sql.Identifier(table_name))
-                columns = ["Timestamp", "L.Traffic.ActiveUser.DL.Avg", "L.ChMeas.PRB.DL.Avail", "L.ChMeas.PRB.DL.Used.Avg", "L.ChMeas.PRB.UL.Avail", "L.ChMeas.PRB.UL.Used.Avg"]
-            else:
-                query = sql.SQL("""SELECT "Timestamp", {}, "L.Traffic.ActiveUser.DL.Avg", "L.ChMeas.PRB.DL.Avail", "L.ChMeas.PRB.DL.Used.Avg", "L.ChMeas.PRB.UL.Avail", "L.ChMeas.PRB.UL.Used.Avg"
-                                FROM {}
-                                WHERE DATE("Timestamp") BETWEEN %s AND %s""").format(sql.Identifier(name_column), sql.Identifier(table_name))
-                columns = ["Timestamp", name_column, "L.Traffic.ActiveUser.DL.Avg", "L.ChMeas.PRB.DL.Avail", "L.ChMeas.PRB.DL.Used.Avg", "L.ChMeas.PRB.UL.Avail", "L.ChMeas.PRB.UL.Used.Avg"]
-        
-        elif kpi == "Traffic":
-            if geo_agg == 'total':
-                query = sql.SQL("""SELECT "Timestamp", "L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.UL(bit)"
-                                FROM {}
-                                WHERE DATE("Timestamp") BETWEEN %s AND %s""").format(sql.Identifier(table_name))
-                columns = ["Timestamp", "L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.UL(bit)"]
-            else:
-                query = sql.SQL("""SELECT "Timestamp", {}, "L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.UL(bit)"
-                                FROM {}
-                                WHERE DATE("Timestamp") BETWEEN %s AND %s""").format(sql.Identifier(name_column), sql.Identifier(table_name))
-                columns = ["Timestamp", name_column, "L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.UL(bit)"]
-
-        elif kpi == "u_exp":
-            if geo_agg == 'total':
-                query = sql.SQL("""SELECT "Timestamp", "L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.DL.LastTTI(bit)", "L.Thrp.Time.DL.RmvLastTTI(ms)"
-                                FROM {}
-                                WHERE DATE("Timestamp") BETWEEN %s AND %s""").format(sql.Identifier(table_name))
-                columns = ["Timestamp", "L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.DL.LastTTI(bit)", "L.Thrp.Time.DL.RmvLastTTI(ms)"]
-            else:
-                query = sql.SQL("""SELECT "Timestamp", {}, "L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.DL.LastTTI(bit)", "L.Thrp.Time.DL.RmvLastTTI(ms)"
-                                FROM {}
-                                WHERE DATE("Timestamp") BETWEEN %s AND %s""").format(sql.Identifier(name_column), sql.Identifier(table_name))
-                columns = ["Timestamp", name_column, "L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.DL.LastTTI(bit)", "L.Thrp.Time.DL.RmvLastTTI(ms)"]
-
-        # print("Consulta :", query.as_string(cur))
-        
-        cur.execute(query, (start_date, end_date))
-        print("Consulta para mostrar KPI en el mapa exitosa")
-        rows = cur.fetchall()
-        
-        df = pd.DataFrame(rows, columns=columns)
-        df = df.sort_values(by="Timestamp")
-        cur.close() # Se cierra el cursor
-        print("Se ha creado el dataframe de la consulta para mostrar el KPI")
+    clave = f"tesela:{agg}:{kpi}:{inicio}:{fin}:{z}:{x}:{y}"
+    contenido = cache.get(clave, default=None)
+    if contenido is None:
+        valores = valores_teselas(agg, kpi, inicio, fin).to_numpy()
+        try:
+            datos = INDICES_TESELAS[agg].tesela(z, x, y, valores, peor_es_menor=(kpi == "u_exp"))
+        except ValueError as e:
+            return Response(str(e), status=400)
+        contenido = json.dumps(datos, separators=(",", ":"))
+        cache.set(clave, contenido, expire=EXPIRACION_TESELAS)
 
-        return df
+    return Response(contenido, mimetype="application/json",
+                    headers={"Cache-Control": f"max-age={EXPIRACION_TESELAS}"})
 
-    except Exception as e:
-        print("Error al conectar con la base de datos: ", e)
-        return pd.DataFrame()
-    
-    finally:
-        conn.close()
 
 # Callback para visualizar KPIs sobre el mapa
 @callback(
         Output(component_id='map', component_property='figure',), #  allow_duplicate=True
         Output(component_id='map_text', component_property='children'),
+        Output(component_id='mapa_teselas', component_property='data'),
+        Output(component_id='mapa_base', component_property='data'),
 
         Input(component_id='update_kpi', component_property='n_clicks'),
         Input(component_id="aggregation", component_property='value'),
@@ -1135,9 +1495,14 @@ def map_query(start_date, end_date, kpi, geo_agg, name_column):
         State(component_id='select_graph', component_property='value'),
         State(component_id="time", component_property='start_date'),
         State(component_id="time", component_property='end_date'),
+        State(component_id="modo_teselas", component_property='value'),
+        State(component_id="mapa_base", component_property='data'),
         # prevent_initial_call=True # Para que no me genere la alerta de salida duplicada
+        background=True, # Se ejecuta como trabajo en segundo plano, una nueva solicitud cancela el trabajo anterior
 )
-def map_kpi(boton, agg, kpi, start_date, end_date):
+@medir("callback.map_kpi")
+@deduplicar(ignorar=(0,)) # Solicitudes idénticas en curso comparten el cálculo (n_clicks no hace parte de la llave)
+def map_kpi(boton, agg, kpi, start_date, end_date, modo_teselas, mapa_base):
 
     # Definir las configuraciones de zoom y centro del mapa una vez
     map_layout = dict(zoom=5, center={"lat": 4.6837, "lon": -74.0566})
@@ -1152,7 +1517,7 @@ def map_kpi(boton, agg, kpi, start_date, end_date):
                     )
         
         warning = f"Los datos para la totalidad de la red se muestran en las gráficas de la derecha"
-        return fig, warning
+        return fig, warning, None, None
     
     start_date = datetime.strptime(start_date, "%Y-%m-%d") # Paso a formato datetime
     end_date = datetime.strptime(end_date, "%Y-%m-%d") # Paso a formato datetime
@@ -1172,7 +1537,7 @@ def map_kpi(boton, agg, kpi, start_date, end_date):
         if date_diff > 21: # Si el rango seleccionado es mayor a 21 días
             start_date = end_date - timedelta(days=20) # Resto dos días para así tomar el dia seleccionado y los dos anteriores
     
-    elif agg in ["AM","deparamento","regional"]: # Para AM, Departamento y regional
+    elif agg in ["AM","departamento","regional"]: # Para AM, Departamento y regional
         if date_diff > 120: # Si el rango seleccionado es mayor a 120 días
             start_date = end_date - timedelta(days=119) # Resto dos días para así tomar el dia seleccionado y los dos anteriores
 
@@ -1183,251 +1548,98 @@ def map_kpi(boton, agg, kpi, start_date, end_date):
 
     text = f"Los datos para la visualización del KPI van desde {start_date} hasta {end_date}"
 
-    name_column_mapping = { # Opciones para completar la consulta y agregar datos según agregación
-        'celda': 'Cell_name',
-        'sector': 'sector_name',
-        'EB': 'node_name',
-        'cluster': 'cluster_name',
-        'localidad': 'localidad_dane_code',
-        'municipio': 'municipio_dane_code',
-        'AM': 'am_name',
-        'departamento': 'dpto_dane_code',
-        'regional': 'regional_name',
-        'total': None  # No hay columna específica para 'total'
-    }
-    data_column = name_column_mapping[agg]
-
-    df = map_query(start_date, end_date, kpi, agg, data_column) # Llamado a la función que hace la consulta
+    data_column = COLUMNAS_NOMBRE[agg]
 
-    if df.empty: # Acción por si el dataframe está vacio
+    bh_df, graph_column = valores_mapa(agg, kpi, start_date, end_date)
+    if bh_df is None: # Acción por si el dataframe está vacio
         warning = f"No hay datos para la fecha {date}"
-        return no_update, warning
-
-    # Encontrar hora pico (BH)
-    df['date'] = df['Timestamp'].dt.date # Crear columna con días
-    bh_day = df.groupby([data_column, 'date'])["L.Traffic.ActiveUser.DL.Avg"].idxmax() # Agrupo los datos por nombre de celda y luego encuentro las horas donde los usuarios son máximos
-    bh_df = df.loc[bh_day] # Creo un nuevo df con las horas pico por día
-    
-    if kpi == "BH":
-        graph_column = "L.Traffic.ActiveUser.DL.Avg" # Guardo la columna de filtrado porque con ella es que se grafican colores en el mapa
-
-        bh_df = bh_df[[data_column,graph_column]].copy() # Copia del df solo con estas columnas
-        bh_df = bh_df.groupby(data_column)[graph_column].mean().reset_index() # Se promedia por nombre de marcador o polígono
-
-        color_scale = [MORADO_CLARO,MAGENTA_OPACO,MAGENTA,MORADO_WOM,MORADO_OSCURO]
-        kpi_range = None
-
-    elif kpi == "PRB":
-        bh_df = bh_df.copy()
-        bh_df["DL_PRB_usage"] = (bh_df["L.ChMeas.PRB.DL.Used.Avg"] / bh_df["L.ChMeas.PRB.DL.Avail"]) * 100 # Cálculo de % ocupación en downlink y guardado en nueva columna
-        bh_df["UL_PRB_usage"] = (bh_df["L.ChMeas.PRB.UL.Used.Avg"] / bh_df["L.ChMeas.PRB.UL.Avail"]) * 100 # Cálculo de % ocupación en uplink y guardado en nueva columna
-        graph_column = "DL_PRB_usage"
-        bh_df = bh_df.groupby(data_column)[graph_column].mean().reset_index()
-        # Definir la escala de color personalizada
-        color_scale = [
-            (0, 'green'),    # Verde para valor inferior
-            (0.5, 'yellow'),   # Amarillo para valores medios
-            (1, 'red')       # Rojo para valores superior
-        ]
-        kpi_range = [0,100] # Rango a mostrar en la barra de escala
-
-    elif kpi == "Traffic":
-        bh_df = bh_df.copy()
-        # print("df pre traffic\n", bh_df)
-        bh_df["L.Thrp.bits.DL(GB)"] = bh_df["L.Thrp.bits.DL(bit)"].apply(bit_to_GB) # Conversión de bit a GB
-        graph_column = "L.Thrp.bits.DL(GB)"
-        bh_df = bh_df.groupby(data_column)[graph_column].mean().reset_index()
-        # print("total avg trff:\n", bh_df)
-
-        color_scale = [MORADO_CLARO,MAGENTA_OPACO,MAGENTA,MORADO_WOM,MORADO_OSCURO]
-        kpi_range = None
-
-    elif kpi == "u_exp":
-        bh_df = bh_df.copy()
-        bh_df["User_Exp"] = ((bh_df["L.Thrp.bits.DL(bit)"]-bh_df["L.Thrp.bits.DL.LastTTI(bit)"]) / (bh_df["L.Thrp.Time.DL.RmvLastTTI(ms)"])) / 1024 # Calculo user experience
-        graph_column = "User_Exp"
-        bh_df = bh_df.groupby(data_column)[graph_column].mean().reset_index()
-
-        # Definir la escala de color discreta según la definición de la empresa
-        color_scale = [
-            (0, "darkred"), (1, "darkred"),
-            (1, "red"), (2.5, "red"),
-            (2.5, "orange"), (3.3, "orange"),
-            (3.3, "yellow"), (5, "yellow"),
-            (5, "green"), (9.99999, "green"),
-            (9.99999, "lime"), (12, "lime")
-        ]
-        # Convertir la escala a un formato adecuado para plotly
-        color_scale = [(i / 12, col) for i, col in color_scale]
-        kpi_range = [0,12]
-    
-    else:
-        print("Hubo un error en la selección del KPI")
-        raise PreventUpdate
+        return no_update, warning, None, no_update
     
-    # Condicional para gráficar la agregación geográfica seleccionada
+    color_scale, kpi_range, colorbar = estilo_kpi_mapa(kpi)
+
+    # Modo por teselas: el navegador pide solo las teselas visibles. Se fija el rango de color con todos los valores
+    # para que la escala no cambie al moverse por el mapa
+    teselas = None
+    if modo_teselas and agg in INDICES_TESELAS:
+        teselas = {"agg": agg, "kpi": kpi, "inicio": start_date, "fin": end_date,
+                   "vista": {"center": map_layout["center"], "zoom": map_layout["zoom"]}}
+        if kpi_range is None:
+            kpi_range = [bh_df[graph_column].min(), bh_df[graph_column].max()]
+
+    base, llave = base_mapa(agg)
     if agg == "celda":
-        cells = df_geo.drop_duplicates(subset=["dwh_cell_name_wom"]).copy() # Df con nombres únicos de celda
         bh_df[data_column] = bh_df[data_column].str.upper() # Valores a mayusculas
-        df_merged = cells.merge(bh_df, how="left", left_on="dwh_cell_name_wom", right_on="Cell_name") # Merge según nombre de celdas
-
-        fig = px.scatter_mapbox(df_merged, lat="dwh_latitud", lon="dwh_longitud",
-                                color=graph_column,
-                                color_continuous_scale=color_scale, range_color=kpi_range, # Definir rango escala de color
-                                # size=graph_column, # No se utiliza size porque no toma valores nulos, tendría que borrar muchas celdas
-                                zoom=map_layout["zoom"], center=map_layout["center"],
-                                hover_name="dwh_cell_name_wom",
-                                custom_data="dwh_cell_name_wom"
-                                )
-    
-    elif agg == "sector":
-        sectores = df_geo.drop_duplicates(subset=["sector_name"]).copy() # Df con nombres únicos de sector
-        df_merged = sectores.merge(bh_df, how="left", left_on="sector_name", right_on="sector_name")
-
-        fig = px.scatter_mapbox(df_merged, lat="dwh_latitud", lon="dwh_longitud",
-                                color=graph_column,
-                                color_continuous_scale=color_scale, range_color=kpi_range, # Definir rango escala de color
-                                # size=graph_column,
-                                zoom=map_layout["zoom"], center=map_layout["center"],
-                                hover_name="sector_name",
-                                custom_data="sector_name"
-                                )
-
-    elif agg == "EB":
-        nodos = df_geo.drop_duplicates(subset=["node_name"]).copy() # Df con nombres únicos de nodo
-        df_merged = nodos.merge(bh_df, how="left", left_on="node_name", right_on="node_name")
+    df_merged = base.merge(bh_df, how="left", left_on=llave, right_on=data_column) # El merge por izquierda conserva el orden de la base
+
+    coloraxis = dict(colorscale=color_scale, colorbar=colorbar,
+                     cmin=kpi_range[0] if kpi_range else None, cmax=kpi_range[1] if kpi_range else None)
+    figura = {"agg": agg, "teselas": teselas is not None} # Figura base que queda en el mapa
+
+    # Si el mapa ya tiene la figura de esta agregación (mismos marcadores o polígonos en el mismo orden) solo se
+    # envían los valores del KPI y la escala de color, la geometría y el layout se quedan en el navegador
+    if mapa_base == figura and teselas is None:
+        valores = df_merged[graph_column].astype(object).where(df_merged[graph_column].notna(), None).tolist() # NaN -> null
+        patched_figure = Patch()
+        if agg in AGREGACIONES_POLIGONO:
+            patched_figure["data"][0]["z"] = valores
+        else:
+            patched_figure["data"][0]["marker"]["color"] = valores
+        patched_figure["data"][0]["hovertemplate"] = plantilla_hover(agg, kpi)
+        patched_figure["layout"]["coloraxis"] = coloraxis
+        print(f"Mapa de {agg} actualizado con Patch para el KPI {kpi}")
+        return patched_figure, text, teselas, no_update
 
+    # Condicional para gráficar la agregación geográfica seleccionada
+    if agg in ["celda", "sector", "EB"]:
+        # No se utiliza size porque no toma valores nulos, tendría que borrar muchas celdas
         fig = px.scatter_mapbox(df_merged, lat="dwh_latitud", lon="dwh_longitud",
                                 color=graph_column,
-                                color_continuous_scale=color_scale, range_color=kpi_range, # Definir rango escala de color
                                 zoom=map_layout["zoom"], center=map_layout["center"],
-                                hover_name="node_name",
-                                custom_data="node_name"
+                                hover_name=llave,
+                                custom_data=llave
                                 )
 
-    elif agg == "cluster":
-        df_merged = clusters.merge(bh_df, how="left", left_on="key", right_on="cluster_name")
-        fig = px.choropleth_mapbox(df_merged, geojson=df_merged.geometry, locations=df_merged.index,
-                                   color=graph_column,
-                                   color_continuous_scale=color_scale, range_color=kpi_range, # Definir rango escala de color
-                                   zoom=map_layout["zoom"], center=map_layout["center"],
-                                   opacity=0.5,
-                                   hover_name="key",
-                                   custom_data="key"
-                                   )
-    
-    elif agg == "localidad":
-        localidades["Localidad"] = localidades["Localidad"].astype(int) # Todas las columnas del df quedaron como string cuando se leyó el GeoJSON, por lo que toca hacer casting para el merge
-        df_merged = localidades.merge(bh_df, how="left", left_on="Localidad", right_on="localidad_dane_code")
-        fig = px.choropleth_mapbox(df_merged, geojson=df_merged.geometry, locations=df_merged.index,
-                                   color=graph_column,
-                                   color_continuous_scale=color_scale, range_color=kpi_range, # Definir rango escala de color
-                                   zoom=map_layout["zoom"], center=map_layout["center"],
-                                   opacity=0.5,
-                                   hover_name="Nombre_localidad",
-                                   hover_data="Localidad",
-                                   custom_data="Localidad"
-                                   )
-    
-    elif agg == "municipio":
-        municipios["MPIO_CCNCT"] = municipios["MPIO_CCNCT"].astype(int) # Todas las columnas del df quedaron como string cuando se leyó el GeoJSON, por lo que toca hacer casting para el merge
-        df_merged = municipios.merge(bh_df, how="left", left_on="MPIO_CCNCT", right_on="municipio_dane_code")
-        fig = px.choropleth_mapbox(df_merged, geojson=df_merged.geometry, locations=df_merged.index,
-                                   color=graph_column,
-                                   color_continuous_scale=color_scale, range_color=kpi_range, # Definir rango escala de color
-                                   zoom=map_layout["zoom"], center=map_layout["center"],
-                                   opacity=0.5,
-                                   hover_name="MPIO_CNMBR",
-                                   hover_data="MPIO_CCNCT",
-                                   custom_data="MPIO_CCNCT"
-                                   )
-    
-    elif agg == "AM":
-        df_merged = areas_metro.merge(bh_df, how="left", left_on="AM", right_on="am_name")
-        fig = px.choropleth_mapbox(df_merged, geojson=df_merged.geometry, locations=df_merged.index,
-                                   color=graph_column,
-                                   color_continuous_scale=color_scale, range_color=kpi_range, # Definir rango escala de color
-                                   zoom=map_layout["zoom"], center=map_layout["center"],
-                                   opacity=0.5,
-                                   hover_name="AM",
-                                   custom_data="AM"
-                                   )
-        
-    elif agg == "departamento":
-        departamentos["DPTO_CCDGO"] = departamentos["DPTO_CCDGO"].astype(int) # Todas las columnas del df quedaron como string cuando se leyó el GeoJSON, por lo que toca hacer casting para el merge
-        df_merged = departamentos.merge(bh_df, how="left", left_on="DPTO_CCDGO", right_on="dpto_dane_code")
-        fig = px.choropleth_mapbox(df_merged, geojson=df_merged.geometry, locations=df_merged.index,
-                                   color=graph_column,
-                                   color_continuous_scale=color_scale, range_color=kpi_range, # Definir rango escala de color
-                                   zoom=map_layout["zoom"], center=map_layout["center"],
-                                   opacity=0.5,
-                                   hover_name="DPTO_CNMBR",
-                                   hover_data="DPTO_CCDGO",
-                                   custom_data="DPTO_CCDGO"
-                                   )
-    
-    elif agg == "regional":
-        df_merged = regionales.merge(bh_df, how="left", left_on="DPTO_REGIONAL", right_on="regional_name")
+    else:
+        nombres_poligono = {"localidad": "Nombre_localidad", "municipio": "MPIO_CNMBR", "departamento": "DPTO_CNMBR"} # Nombre para mostrar cuando la llave es un código
         fig = px.choropleth_mapbox(df_merged, geojson=df_merged.geometry, locations=df_merged.index,
                                    color=graph_column,
-                                   color_continuous_scale=color_scale, range_color=kpi_range, # Definir rango escala de color
                                    zoom=map_layout["zoom"], center=map_layout["center"],
                                    opacity=0.5,
-                                   hover_name="DPTO_REGIONAL",
-                                   custom_data="DPTO_REGIONAL"
+                                   hover_name=nombres_poligono.get(agg, llave),
+                                   custom_data=llave
                                    )
 
-    # Condicional para definir estilo del gráfico según KPI a mostrar
-    if kpi == "BH":
-        # Personalizar la barra de colores
-        fig.update_layout(
-            coloraxis_colorbar=dict(
-                title="Users BH",
-            ),
-            mapbox_style='carto-positron',
-            margin={"r":0,"t":0,"l":0,"b":0}
-        )
+    fig.update_traces(hovertemplate=plantilla_hover(agg, kpi))
+    fig.update_layout(
+        coloraxis=coloraxis,
+        mapbox_style='carto-positron',
+        margin={"r":0,"t":0,"l":0,"b":0}
+    )
 
-    elif kpi == "PRB":
-        # Personalizar la barra de colores
-        fig.update_layout(
-            coloraxis_colorbar=dict(
-                title="PRB usage BH",
-                ticksuffix=" %"
-            ),
-            mapbox_style='carto-positron',
-            margin={"r":0,"t":0,"l":0,"b":0}
-        )
+    if teselas is not None:
+        fig.update_traces(lat=[], lon=[], marker_color=[], customdata=[], hovertext=[]) # Los marcadores llegan por teselas
 
-    elif kpi == "Traffic":
-        # Personalizar la barra de colores
-        fig.update_layout(
-            coloraxis_colorbar=dict(
-                title="Traffic BH",
-                ticksuffix=" GB"
-            ),
-            mapbox_style='carto-positron',
-            margin={"r":0,"t":0,"l":0,"b":0}
-        )
+    return fig, text, teselas, figura
 
-    elif kpi == "u_exp":
-        # Personalizar la barra de colores
-        fig.update_layout(
-            coloraxis_colorbar=dict(
-                title="User Experience BH",
-                tickvals=[0, 1, 2.5, 3.3, 5, 10, 12],
-                ticktext=['0 Mbps', '1 Mbps', '2.5 Mbps', '3.3 Mbps', '5 Mbps', '10 Mbps', '>10 Mbps'],
-                ticks="outside"
-            ),
-            mapbox_style='carto-positron',
-            margin={"r":0,"t":0,"l":0,"b":0}
-        )
 
-    return fig, text
+# Callback del mapa por teselas. Se ejecuta en el navegador (assets/clientside.js): con el centro y zoom actuales
+# calcula las teselas visibles, pide al servidor las que no tiene y pone sus marcadores en el mapa
+app.clientside_callback(
+        ClientsideFunction(namespace="mapa", function_name="teselas_visibles"),
+        Output(component_id='map', component_property='figure', allow_duplicate=True),
 
+        Input(component_id='map', component_property='relayoutData'),
+        Input(component_id='mapa_teselas', component_property='data'),
 
-# Callback para mostrar la gráfica en pantalla grande
-@callback(
+        State(component_id='map', component_property='figure'),
+        prevent_initial_call=True
+        )
+
+
+# Callback para mostrar la gráfica en pantalla grande. Se ejecuta en el navegador (assets/clientside.js), las
+# figuras ya están en el cliente y no hace falta enviarlas al servidor y de vuelta
+app.clientside_callback(
+        ClientsideFunction(namespace="graficas", function_name="pantalla_completa"),
         Output(component_id='graph_test', component_property='figure', allow_duplicate=True),
 
         Input(component_id='fullscreen', component_property='n_clicks'),
@@ -1439,27 +1651,12 @@ def map_kpi(boton, agg, kpi, start_date, end_date):
         State(component_id='PRB', component_property='figure'),
         prevent_initial_call=True # Evitar el primer llamado automatico que hace dash
         )
-def full_screen(boton, seleccion, traff, uexp, bh, prb):
-    # print(f"La seleccion exacta es: ->{seleccion}<-")
-    if seleccion == "BH":
-        fig = bh
-    elif seleccion == "PRB":
-        fig = prb
-    elif seleccion == "Traffic":
-        fig = traff
-    elif seleccion == "u_exp":
-        fig = uexp
-    else:
-        raise PreventUpdate
-
-    return fig
-
 
-def extraer_claves(keys_needed, data_dict):# Función para extraer las llaves necesarias
-    return {key: data_dict[key] for key in keys_needed if key in data_dict}
 
-# Callback para descargar datos de cada gráfico
-@callback(
+# Callback para descargar datos de cada gráfico. El CSV se arma en el navegador (assets/clientside.js) a partir de
+# los trazos de la figura seleccionada
+app.clientside_callback(
+        ClientsideFunction(namespace="graficas", function_name="descargar_datos"),
         Output(component_id='download_file', component_property='data'),
 
         Input(component_id='download', component_property='n_clicks'),
@@ -1471,58 +1668,11 @@ def extraer_claves(keys_needed, data_dict):# Función para extraer las llaves ne
         State(component_id='PRB', component_property='figure'),
         prevent_initial_call=True # Evitar el primer llamado automatico que hace dash
         )
-def download_graph_data(boton, seleccion, traff, uexp, bh, prb):
-    if seleccion == "BH":
-        fig = bh # Información de la figura seleccionada
-        keys = ["name","x","y","text","type"] # Información de la gráfica que se quiere descargar
-        # Diccionario de cada trazo en la gráfica
-        dict1 = extraer_claves(keys, fig["data"][0])
-        dict2 = extraer_claves(keys, fig["data"][1])
-        # Creamos un DataFrame a partir de los datos
-        trazo1 = pd.DataFrame(dict1)
-        trazo2 = pd.DataFrame(dict2)
-        df = pd.concat([trazo1, trazo2]).reset_index(drop=True)
-        file_name = f"Graph_ActiveUsers_data.csv"
-
-    elif seleccion == "PRB":
-        fig = prb
-        keys = ["name","x","y","type"] # Información de la gráfica que se quiere descargar
-        # Diccionario de cada trazo en la gráfica
-        dict1 = extraer_claves(keys, fig["data"][0])
-        dict2 = extraer_claves(keys, fig["data"][1])
-        # Creamos un DataFrame a partir de los datos
-        trazo1 = pd.DataFrame(dict1)
-        trazo2 = pd.DataFrame(dict2)
-        df = pd.concat([trazo1, trazo2]).reset_index(drop=True)
-        file_name = f"Graph_PRBusage_data.csv"
-
-    elif seleccion == "Traffic":
-        fig = traff
-        keys = ["name","x","y","type"] # Información de la gráfica que se quiere descargar
-        # Diccionario de cada trazo en la gráfica
-        dict1 = extraer_claves(keys, fig["data"][0])
-        dict2 = extraer_claves(keys, fig["data"][1])
-        dict3 = extraer_claves(keys, fig["data"][2])
-        # Creamos un DataFrame a partir de los datos
-        trazo1 = pd.DataFrame(dict1)
-        trazo2 = pd.DataFrame(dict2)
-        trazo3 = pd.DataFrame(dict3)
-        df = pd.concat([trazo1, trazo2, trazo3]).reset_index(drop=True)
-        file_name = f"Graph_Traffic_data.csv"
-
-    elif seleccion == "u_exp":
-        fig = uexp
-        keys = ["name","x","y","type"] # Información de la gráfica que se quiere descargar
-        # Diccionario de cada trazo en la gráfica
-        dict1 = extraer_claves(keys, fig["data"][0])
-        df = pd.DataFrame(dict1)
-        file_name = f"Graph_UserExperience_data.csv"
-
-    else:
-        raise PreventUpdate
-    print("fig in callback:\n", fig["data"])
 
-    return dcc.send_data_frame(df.to_csv, file_name, index=False)
+# Métricas acumuladas de callbacks, rutas y consultas en el formato de texto de Prometheus
+@app.server.route("/metrics")
+def metricas():
+    return Response(exportar_prometheus(), mimetype="text/plain; version=0.0.4")
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8050)
@@ -0,0 +1,206 @@
+// Callbacks que se ejecutan en el navegador. Las figuras ya están en el cliente, así que mostrar la gráfica en
+// pantalla grande o descargar sus datos no requiere subir el JSON de las figuras al servidor
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    graficas: {
+        // Figura según la opción del dropdown "select_graph"
+        elegir_figura: function(seleccion, traff, uexp, bh, prb) {
+            const figuras = {"BH": bh, "PRB": prb, "Traffic": traff, "u_exp": uexp};
+            return figuras[seleccion];
+        },
+
+        pantalla_completa: function(n_clicks, seleccion, traff, uexp, bh, prb) {
+            const fig = window.dash_clientside.graficas.elegir_figura(seleccion, traff, uexp, bh, prb);
+            if (!fig) {
+                return window.dash_clientside.no_update;
+            }
+            return fig;
+        },
+
+        descargar_datos: function(n_clicks, seleccion, traff, uexp, bh, prb) {
+            const nombres = {
+                "BH": "Graph_ActiveUsers_data.csv",
+                "PRB": "Graph_PRBusage_data.csv",
+                "Traffic": "Graph_Traffic_data.csv",
+                "u_exp": "Graph_UserExperience_data.csv"
+            };
+            const fig = window.dash_clientside.graficas.elegir_figura(seleccion, traff, uexp, bh, prb);
+            if (!fig || !fig.data) {
+                return window.dash_clientside.no_update;
+            }
+
+            // Información de la gráfica que se quiere descargar, "text" solo la tiene la gráfica de usuarios
+            const claves = seleccion === "BH" ? ["name", "x", "y", "text", "type"] : ["name", "x", "y", "type"];
+            const columnas = claves.filter(clave => fig.data.some(trazo => clave in trazo));
+            const lineas = [columnas.join(",")];
+
+            // Una fila por punto de cada trazo, los valores escalares (name, type) se repiten en cada fila
+            fig.data.forEach(trazo => {
+                const valores = {};
+                let n = 0;
+                columnas.forEach(col => {
+                    valores[col] = a_arreglo(trazo[col]);
+                    if (Array.isArray(valores[col])) {
+                        n = Math.max(n, valores[col].length);
+                    }
+                });
+                for (let i = 0; i < n; i++) {
+                    lineas.push(columnas.map(col => {
+                        const valor = Array.isArray(valores[col]) ? valores[col][i] : valores[col];
+                        return campo_csv(valor);
+                    }).join(","));
+                }
+            });
+
+            return {content: lineas.join("\n") + "\n", filename: nombres[seleccion], type: "text/csv", base64: false};
+        }
+    }
+});
+
+// Plotly puede serializar los arreglos numéricos como {dtype, bdata} en base64, se convierten a un arreglo normal
+function a_arreglo(valor) {
+    if (valor === undefined || valor === null) {
+        return "";
+    }
+    if (Array.isArray(valor) || typeof valor !== "object") {
+        return valor;
+    }
+    if (valor.bdata !== undefined) {
+        const tipos = {
+            "f8": Float64Array, "f4": Float32Array,
+            "i1": Int8Array, "u1": Uint8Array, "i2": Int16Array, "u2": Uint16Array,
+            "i4": Int32Array, "u4": Uint32Array
+        };
+        const binario = atob(valor.bdata);
+        const bytes = new Uint8Array(binario.length);
+        for (let i = 0; i < binario.length; i++) {
+            bytes[i] = binario.charCodeAt(i);
+        }
+        return Array.from(new tipos[valor.dtype](bytes.buffer));
+    }
+    return Array.from(valor);
+}
+
+// Escapar un valor para CSV (comillas si contiene coma, comillas o salto de línea)
+function campo_csv(valor) {
+    if (valor === undefined || valor === null || (typeof valor === "number" && isNaN(valor))) {
+        return "";
+    }
+    const texto = String(valor);
+    if (/[",\n]/.test(texto)) {
+        return '"' + texto.replace(/"/g, '""') + '"';
+    }
+    return texto;
+}
+
+// Mapa por teselas: solo se descargan los marcadores de las teselas visibles. Las teselas ya recibidas se guardan
+// por URL mientras la página esté abierta (el servidor además las marca como cacheables)
+const TAM_TESELA = 256; // Pixeles de lado de una tesela, el zoom de mapbox usa teselas de 512
+const ZOOM_INDICE = 16; // Mismo valor que teselas.ZOOM_INDICE en el servidor
+const MAX_TESELAS_GUARDADAS = 500;
+const teselas_guardadas = new Map();
+let solicitud_teselas = 0; // Para descartar respuestas de una vista que ya cambió
+let vista_teselas = null;
+
+window.dash_clientside.mapa = {
+    teselas_visibles: async function(relayout, teselas, figura) {
+        const no_update = window.dash_clientside.no_update;
+        if (!teselas || !figura || !figura.data || !figura.data.length) {
+            vista_teselas = null;
+            return no_update;
+        }
+
+        // Vista actual: la del relayout si lo generó el usuario, si no la que envía el servidor
+        const disparos = window.dash_clientside.callback_context.triggered.map(t => t.prop_id);
+        if (disparos.includes("mapa_teselas.data") || vista_teselas === null) {
+            vista_teselas = {center: teselas.vista.center, zoom: teselas.vista.zoom};
+        }
+        if (disparos.includes("map.relayoutData") && relayout) {
+            if (relayout["mapbox.center"]) {
+                vista_teselas.center = relayout["mapbox.center"];
+            }
+            if (relayout["mapbox.zoom"] !== undefined) {
+                vista_teselas.zoom = relayout["mapbox.zoom"];
+            }
+        }
+        const vista = {center: Object.assign({}, vista_teselas.center), zoom: vista_teselas.zoom};
+
+        const solicitud = ++solicitud_teselas;
+        const urls = urls_teselas(teselas, vista);
+        let partes;
+        try {
+            partes = await Promise.all(urls.map(pedir_tesela));
+        } catch (e) {
+            console.error("Error al pedir teselas del mapa", e);
+            return no_update;
+        }
+        if (solicitud !== solicitud_teselas) {
+            return no_update; // Llegó una vista más reciente mientras se descargaba esta
+        }
+
+        const nombres = [], lat = [], lon = [], valores = [];
+        partes.forEach(parte => {
+            nombres.push(...parte.nombre);
+            lat.push(...parte.lat);
+            lon.push(...parte.lon);
+            valores.push(...parte.valor);
+        });
+
+        const trazo = Object.assign({}, figura.data[0], {
+            lat: lat,
+            lon: lon,
+            hovertext: nombres,
+            customdata: nombres.map(nombre => [nombre]), // Igual que custom_data de px, lo usa el callback de selección
+            marker: Object.assign({}, figura.data[0].marker, {color: valores})
+        });
+        // Se conserva la vista actual, de lo contrario la figura vuelve al centro con el que se generó
+        const layout = Object.assign({}, figura.layout, {
+            mapbox: Object.assign({}, figura.layout.mapbox, {center: vista.center, zoom: vista.zoom})
+        });
+        return Object.assign({}, figura, {data: [trazo].concat(figura.data.slice(1)), layout: layout});
+    }
+};
+
+// URLs de las teselas que cubren el área visible del mapa para el centro y zoom dados
+function urls_teselas(teselas, vista) {
+    const elemento = document.getElementById("map");
+    const ancho = elemento ? elemento.clientWidth : 1000;
+    const alto = elemento ? elemento.clientHeight : 800;
+
+    const mundo = 512 * Math.pow(2, vista.zoom); // Tamaño del mundo en pixeles para el zoom de mapbox
+    const lat_rad = Math.max(-85.05112878, Math.min(85.05112878, vista.center.lat)) * Math.PI / 180;
+    const cx = (vista.center.lon + 180) / 360 * mundo;
+    const cy = (1 - Math.log(Math.tan(lat_rad) + 1 / Math.cos(lat_rad)) / Math.PI) / 2 * mundo;
+
+    const z = Math.max(0, Math.min(ZOOM_INDICE, Math.floor(Math.log2(mundo / TAM_TESELA))));
+    const n = Math.pow(2, z);
+    const lado = mundo / n;
+    const limite = v => Math.max(0, Math.min(n - 1, Math.floor(v / lado)));
+
+    const config = JSON.parse(document.getElementById("_dash-config").textContent);
+    const base = `${config.requests_pathname_prefix}teselas_mapa/${teselas.agg}/${teselas.kpi}/${teselas.inicio}/${teselas.fin}`;
+    const urls = [];
+    for (let x = limite(cx - ancho / 2); x <= limite(cx + ancho / 2); x++) {
+        for (let y = limite(cy - alto / 2); y <= limite(cy + alto / 2); y++) {
+            urls.push(`${base}/${z}/${x}/${y}.json`);
+        }
+    }
+    return urls;
+}
+
+async function pedir_tesela(url) {
+    if (!teselas_guardadas.has(url)) {
+        if (teselas_guardadas.size >= MAX_TESELAS_GUARDADAS) {
+            teselas_guardadas.clear();
+        }
+        // Se guarda la promesa para que dos vistas seguidas no pidan la misma tesela dos veces
+        const promesa = fetch(url).then(respuesta => {
+            if (!respuesta.ok) {
+                throw new Error(`Tesela ${url}: ${respuesta.status}`);
+            }
+            return respuesta.json();
+        });
+        promesa.catch(() => teselas_guardadas.delete(url));
+        teselas_guardadas.set(url, promesa);
+    }
+    return teselas_guardadas.get(url);
+}
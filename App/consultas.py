@@ -0,0 +1,656 @@
+import io
+import os
+import sys
+import queue
+import threading
+import zlib
+import functools
+from concurrent.futures import Future
+import pandas as pd
+import psycopg2 # Para consulta a base de datos PostgreSQL
+from psycopg2 import sql
+from psycopg2.extensions import encodings
+
+# Scripts adicionales
+import DBcredentials
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comun"))
+import kpis_ran # Fórmulas de KPIs compartidas con el ETL
+import empaquetado # Tablas con una fila por entidad y día y arreglos de 24 horas
+import historico_local # Histórico en Parquet consultado con DuckDB para las consultas de recorrido
+import archivo_frio # Días que ya salieron de PostgreSQL por la retención, en Parquet
+import estados_kpi # Estados combinables por entidad y día (suma, máximo e histograma)
+import instrumentacion # Tiempo en base de datos, filas y bytes de cada consulta
+
+#----------- Constantes -----------#
+# Tabla de la base de datos según la agregación geográfica
+TABLAS = {
+    'celda': 'ran_1h_cell',
+    'sector': 'ran_1h_sector',
+    'EB': 'ran_1h_node',
+    'cluster': 'ran_1h_cluster',
+    'localidad': 'ran_1h_localidad',
+    'municipio': 'ran_1h_municipio',
+    'AM': 'ran_1h_am',
+    'departamento': 'ran_1h_departamento',
+    'regional': 'ran_1h_regional',
+    'total': 'ran_1h_total'
+}
+
+# Columna con el nombre del marcador o polígono según la agregación geográfica
+COLUMNAS_NOMBRE = {
+    'celda': 'Cell_name',
+    'sector': 'sector_name',
+    'EB': 'node_name',
+    'cluster': 'cluster_name',
+    'localidad': 'localidad_dane_code',
+    'municipio': 'municipio_dane_code',
+    'AM': 'am_name',
+    'departamento': 'dpto_dane_code',
+    'regional': 'regional_name',
+    'total': None  # No hay columna específica para 'total'
+}
+
+# Agregaciones que se leen de la tabla empaquetada (una fila por entidad y día con arreglos de 24 horas), que guarda
+# mucha más historia que la tabla por hora en el mismo espacio
+TABLAS_EMPAQUETADAS = {
+    'celda': 'ran_1d_cell'
+}
+
+# Agregaciones en las que el nombre se compara en mayúsculas porque así se escribe en el dropdown
+AGREGACIONES_UPPER = ["celda", "sector", "EB"]
+
+# Contadores que se consultan para las gráficas de la selección, los mismos que cubre el índice por nombre y hora
+COLUMNAS_KPI = kpis_ran.CONTADORES_GRAFICAS
+
+# Contadores que se consultan para cada KPI del mapa
+COLUMNAS_MAPA = {
+    "BH": ["L.Traffic.ActiveUser.DL.Avg", "L.Traffic.ActiveUser.DL.Max"],
+    "PRB": ["L.Traffic.ActiveUser.DL.Avg", "L.ChMeas.PRB.DL.Avail", "L.ChMeas.PRB.DL.Used.Avg", "L.ChMeas.PRB.UL.Avail", "L.ChMeas.PRB.UL.Used.Avg"],
+    "Traffic": ["L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.UL(bit)"],
+    "u_exp": ["L.Traffic.ActiveUser.DL.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.DL.LastTTI(bit)", "L.Thrp.Time.DL.RmvLastTTI(ms)"]
+}
+
+# Columnas del reporte de KPIs diarios por celda
+COLUMNAS_REPORTE = ["Date","BH","cell_name","avg_users_BH","daily_max_users","max_users_hour","PRBusage_BH_DL","PRBusage_BH_UL","traffic_bh(GB)","traffic_avg(GB)","traffic_total(GB)","uexp_BH(Mbps)"]
+
+# KPIs del ranking: columna ya calculada en la tabla diaria de celdas y expresión equivalente sobre las tablas por hora
+RANKING_KPIS = {
+    "BH": ("avg_users_BH", kpis_ran.SQL_KPIS["BH"]),
+    "PRB": ("PRBusage_BH_DL", kpis_ran.SQL_KPIS["PRB"]),
+    "Traffic": ("traffic_bh(GB)", kpis_ran.SQL_KPIS["Traffic"]),
+    "u_exp": ("uexp_BH(Mbps)", kpis_ran.SQL_KPIS["u_exp"])
+}
+MAX_RANKING = 500 # Filas máximas que devuelve un ranking
+
+FORMATO_TIMESTAMP = "%Y-%m-%d %H:%M:%S" # Formato en el que PostgreSQL escribe las columnas TIMESTAMP en texto
+
+TAM_BLOQUE_EXPORTACION = 1024 * 1024 # Bytes de CSV que se acumulan antes de comprimir y enviar un bloque
+BLOQUES_EN_COLA = 8 # Bloques comprimidos en espera como máximo, así la memoria no depende del tamaño del reporte
+FILAS_AVISO_PROGRESO = 200000 # Cada cuántas filas se informa el avance de una exportación
+
+
+
+#---------- Funciones ----------#
+_en_curso = {} # Consultas que se están ejecutando en este proceso, llave -> Future con el resultado
+_bloqueo_en_curso = threading.Lock()
+
+def consulta_compartida(funcion):
+    # Decorador "single-flight": si llega una consulta idéntica (misma función y argumentos) mientras otra se está
+    # ejecutando, en lugar de ir de nuevo a PostgreSQL espera y recibe el resultado de la que está en curso.
+    # _en_curso vive en la memoria del proceso, así que solo comparte consultas entre los hilos de un mismo worker web:
+    # se usa en las consultas que llaman las rutas de Flask y los callbacks que no corren en segundo plano (teselas
+    # del mapa, zoom de la vista por hora, ranking). Los callbacks en segundo plano (update_graphs, map_kpi,
+    # compare_graphs) corren en procesos aparte donde este diccionario no se comparte; para ellos el pico de
+    # solicitudes idénticas del inicio de turno se agrupa antes, por callback, con trabajos.deduplicar en el almacén
+    # compartido, y sus consultas no llevan este decorador
+    @functools.wraps(funcion)
+    def envoltura(*args):
+        clave = (funcion.__name__,) + args
+        with _bloqueo_en_curso:
+            futuro = _en_curso.get(clave)
+            lider = futuro is None
+            if lider: # Primera solicitud con esta llave, es la que ejecuta la consulta
+                futuro = Future()
+                _en_curso[clave] = futuro
+
+        # Todos reciben una copia, también quien ejecutó la consulta, para que cada uno pueda modificar su resultado
+        # sin afectar a los demás que todavía lo están leyendo
+        if not lider:
+            return futuro.result().copy()
+
+        try:
+            resultado = funcion(*args)
+            futuro.set_result(resultado)
+            return resultado.copy()
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        finally:
+            with _bloqueo_en_curso:
+                del _en_curso[clave]
+
+    return envoltura
+
+def consulta_columnar(cur, query, params, parse_dates=("Timestamp",)):
+    # Ejecuta la consulta como COPY (...) TO STDOUT y lee el resultado en un DataFrame con el parser en C de pandas.
+    # Con cur.fetchall() psycopg2 crea una tupla por fila y un objeto de Python por cada valor antes de que el
+    # DataFrame copie todo otra vez; aquí los datos pasan del buffer del COPY directamente a arreglos por columna
+
+    # COPY no acepta parámetros, así que se interpolan de forma segura con mogrify (mismo escape que execute)
+    consulta = cur.mogrify(query, params).decode(encodings[cur.connection.encoding])
+    copy_query = sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)").format(sql.SQL(consulta))
+
+    buffer = io.BytesIO()
+    with instrumentacion.tiempo_sql():
+        cur.copy_expert(copy_query.as_string(cur), buffer)
+    instrumentacion.anotar(bytes_leidos=buffer.tell())
+    buffer.seek(0)
+
+    # Solo los campos vacios son nulos (así escribe PostgreSQL el NULL en CSV), un nombre como "NA" se conserva
+    df = pd.read_csv(buffer, keep_default_na=False, na_values=[""])
+
+    for columna in parse_dates:
+        if columna in df.columns:
+            df[columna] = kpis_ran.timestamps_unicos(df[columna], FORMATO_TIMESTAMP) # Formato explícito y un parseo por valor distinto
+
+    instrumentacion.anotar(filas=len(df))
+    return df
+
+def consulta_empaquetada(cur, geo_agregacion, contadores, filtro, params, columna=None):
+    # Consulta sobre la tabla empaquetada de la agregación que devuelve las mismas filas por hora ("Timestamp", nombre,
+    # contadores) que la tabla por hora. filtro es la condición sobre el nombre (None para todas las entidades), params
+    # sus parámetros seguidos de las fechas de inicio y fin, y columna la expresión con la que se devuelve el nombre
+    name_column = COLUMNAS_NOMBRE[geo_agregacion]
+    condiciones = [sql.SQL('"Date" BETWEEN %s AND %s')]
+    if filtro is not None:
+        condiciones.insert(0, filtro)
+    query = sql.SQL("""SELECT "Date",{},{}
+            FROM {}
+            WHERE {}""").format(
+                columna if columna is not None else sql.Identifier(name_column), sql.SQL(',').join(map(sql.Identifier, contadores)),
+                sql.Identifier(TABLAS_EMPAQUETADAS[geo_agregacion]), sql.SQL(' AND ').join(condiciones))
+    df = consulta_columnar(cur, query, params, parse_dates=())
+    return empaquetado.desempaquetar(df, [name_column], contadores)
+
+def archivos_locales(geo_agregacion, start_date, end_date, recorrido):
+    # Selección de backend: las consultas de recorrido (todas las entidades como el mapa, o rangos largos de una
+    # selección) van al histórico local si está habilitado y tiene todos los días del rango. Devuelve los archivos a
+    # leer, o None cuando la consulta va a PostgreSQL
+    if not historico_local.lectura_habilitada():
+        return None
+    dias = (historico_local.como_fecha(end_date) - historico_local.como_fecha(start_date)).days + 1
+    if not recorrido and dias < historico_local.DIAS_RECORRIDO:
+        return None
+    return historico_local.archivos(TABLAS[geo_agregacion], start_date, end_date)
+
+def nombre_local(geo_agregacion):
+    # Expresión de DuckDB con la que se compara el nombre: en mayúsculas como en PostgreSQL, y como texto porque los
+    # códigos DANE son enteros en el Parquet pero llegan como texto desde el dropdown
+    columna = historico_local.identificador(COLUMNAS_NOMBRE[geo_agregacion])
+    if geo_agregacion in AGREGACIONES_UPPER:
+        return f"upper({columna})"
+    return f"CAST({columna} AS VARCHAR)"
+
+def consulta_local(rutas, columnas, filtro=None, params=(), expresiones=None):
+    # Consulta al histórico local con la misma instrumentación que las de la base de datos. expresiones reemplaza
+    # columnas por nombre cuando alguna necesita una expresión de DuckDB
+    expresiones = expresiones or [historico_local.identificador(columna) for columna in columnas]
+    df = historico_local.consultar(rutas, expresiones, filtro, params)
+    instrumentacion.anotar(filas=len(df), bytes_leidos=sum(os.path.getsize(ruta) for ruta in rutas))
+    print(f"Consulta resuelta con Parquet: {len(rutas)} días, {len(df)} filas")
+    return df
+
+def con_archivo(geo_agregacion, start_date, end_date, orden, consulta_archivo, consulta_base):
+    # Une el archivo frío con la consulta de siempre: los días del rango que equilibrar() ya borró de PostgreSQL se leen
+    # del archivo con consulta_archivo(rutas), filtrando por entidad y día como el histórico local, y el resto con
+    # consulta_base(inicio). Sin días archivados en el rango es solo consulta_base(start_date)
+    rutas, inicio = archivo_frio.partir(TABLAS[geo_agregacion], start_date, end_date)
+    if not rutas:
+        return consulta_base(start_date)
+
+    partes = []
+    try:
+        partes.append(consulta_archivo(rutas))
+    except Exception as e:
+        print("Error en el archivo frío, solo se consultan los días en PostgreSQL: ", e)
+    if inicio is not None:
+        partes.append(consulta_base(inicio))
+    partes = [parte for parte in partes if not parte.empty]
+    if not partes:
+        return pd.DataFrame()
+    return pd.concat(partes, ignore_index=True).sort_values(by=orden)
+
+def seleccion_parquet(rutas, seleccion, geo_agregacion):
+    # Historia de una selección leída de Parquet (histórico local o archivo frío)
+    name_column = COLUMNAS_NOMBRE[geo_agregacion]
+    if geo_agregacion == "total":
+        df = consulta_local(rutas, ["Timestamp"] + COLUMNAS_KPI)
+    else:
+        df = consulta_local(rutas, ["Timestamp", name_column] + COLUMNAS_KPI, f"{nombre_local(geo_agregacion)} = ?", [str(seleccion)])
+    return df.sort_values(by="Timestamp")
+
+def selecciones_parquet(rutas, selecciones, geo_agregacion):
+    # Historia de varias selecciones leída de Parquet, con el nombre como lo devuelve PostgreSQL
+    name_column = COLUMNAS_NOMBRE[geo_agregacion]
+    expresiones = [historico_local.identificador(columna) for columna in ["Timestamp", name_column] + COLUMNAS_KPI]
+    if geo_agregacion in AGREGACIONES_UPPER: # Nombre en mayúsculas, como lo devuelve la consulta a PostgreSQL
+        expresiones[1] = f"{nombre_local(geo_agregacion)} AS {expresiones[1]}"
+    df = consulta_local(rutas, None, f"list_contains(?, {nombre_local(geo_agregacion)})",
+                        [[str(seleccion) for seleccion in selecciones]], expresiones)
+    return df.sort_values(by=[name_column, "Timestamp"])
+
+def mapa_parquet(rutas, kpi, geo_agg, name_column):
+    # Contadores del KPI de todas las entidades leídos de Parquet
+    columns = COLUMNAS_MAPA[kpi] if geo_agg == 'total' else [name_column] + COLUMNAS_MAPA[kpi]
+    return consulta_local(rutas, ["Timestamp"] + columns).sort_values(by="Timestamp")
+
+@consulta_compartida
+def query_to_df(seleccion, geo_agregacion, start_date, end_date):
+    return con_archivo(geo_agregacion, start_date, end_date, "Timestamp",
+                       lambda rutas: seleccion_parquet(rutas, seleccion, geo_agregacion),
+                       lambda inicio: seleccion_reciente(seleccion, geo_agregacion, inicio, end_date))
+
+def seleccion_reciente(seleccion, geo_agregacion, start_date, end_date):
+    # Historia de la selección en los días que siguen en PostgreSQL (o en el histórico local)
+    table_name = TABLAS[geo_agregacion]
+    name_column = COLUMNAS_NOMBRE[geo_agregacion]
+
+    rutas = archivos_locales(geo_agregacion, start_date, end_date, recorrido=False)
+    if rutas is not None:
+        try:
+            return seleccion_parquet(rutas, seleccion, geo_agregacion)
+        except Exception as e:
+            print("Error en el histórico local, se consulta PostgreSQL: ", e)
+
+    try:
+        conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+
+        # Realizar consulta a la base de datos PostgreSQL dentro del rango de fechas seleccionado
+        cur = conn.cursor()
+        # El rango se compara directo sobre "Timestamp" (sin DATE()) para que PostgreSQL use el índice de cobertura por
+        # nombre y hora, que tiene todas las columnas de la consulta y evita leer la tabla
+
+        if geo_agregacion == "total":
+            query = sql.SQL("""SELECT "Timestamp",{}
+                    FROM {}
+                    WHERE "Timestamp" >= %s::date AND "Timestamp" < %s::date + 1""").format(
+                        sql.SQL(',').join(map(sql.Identifier, COLUMNAS_KPI)), sql.Identifier(table_name))
+            params = (start_date, end_date)
+
+        else:
+            if geo_agregacion in AGREGACIONES_UPPER:
+                filtro = sql.SQL("UPPER({}) = %s").format(sql.Identifier(name_column))
+            else:
+                filtro = sql.SQL("{} = %s").format(sql.Identifier(name_column))
+
+            query = sql.SQL("""SELECT "Timestamp",{},{}
+                    FROM {}
+                    WHERE {}
+                    AND "Timestamp" >= %s::date AND "Timestamp" < %s::date + 1""").format(
+                        sql.Identifier(name_column), sql.SQL(',').join(map(sql.Identifier, COLUMNAS_KPI)),
+                        sql.Identifier(table_name), filtro)
+            params = (seleccion, start_date, end_date)
+
+        if geo_agregacion in TABLAS_EMPAQUETADAS:
+            df = consulta_empaquetada(cur, geo_agregacion, COLUMNAS_KPI, filtro, params)
+        else:
+            df = consulta_columnar(cur, query, params)
+        df = df.sort_values(by="Timestamp")
+        cur.close()
+
+        return df
+
+    except Exception as e:
+        print("Error al obtener información de la selección: ", e)
+        return pd.DataFrame()
+
+    finally:
+        conn.close() # Siempre se va a cerrar la conexión sin importar si hubo excepción o no. Buena práctica por si hay un error
+
+def query_multi_df(selecciones, geo_agregacion, start_date, end_date):
+    # Consulta de varias selecciones de la misma agregación en una sola ida a la base de datos (= ANY(%s)).
+    # selecciones es una tupla para que la llave de consulta_compartida sea hashable
+    return con_archivo(geo_agregacion, start_date, end_date, [COLUMNAS_NOMBRE[geo_agregacion], "Timestamp"],
+                       lambda rutas: selecciones_parquet(rutas, selecciones, geo_agregacion),
+                       lambda inicio: selecciones_recientes(selecciones, geo_agregacion, inicio, end_date))
+
+def selecciones_recientes(selecciones, geo_agregacion, start_date, end_date):
+    table_name = TABLAS[geo_agregacion]
+    name_column = COLUMNAS_NOMBRE[geo_agregacion]
+
+    rutas = archivos_locales(geo_agregacion, start_date, end_date, recorrido=False)
+    if rutas is not None:
+        try:
+            return selecciones_parquet(rutas, selecciones, geo_agregacion)
+        except Exception as e:
+            print("Error en el histórico local, se consulta PostgreSQL: ", e)
+
+    try:
+        conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+        cur = conn.cursor()
+
+        if geo_agregacion in AGREGACIONES_UPPER:
+            # El nombre se devuelve en mayúsculas para que coincida con los valores del dropdown
+            columna = sql.SQL("UPPER({}) AS {}").format(sql.Identifier(name_column), sql.Identifier(name_column))
+            filtro = sql.SQL("UPPER({}) = ANY(%s)").format(sql.Identifier(name_column))
+        else:
+            columna = sql.Identifier(name_column)
+            filtro = sql.SQL("{} = ANY(%s)").format(sql.Identifier(name_column))
+
+        query = sql.SQL("""SELECT "Timestamp",{},{}
+                FROM {}
+                WHERE {}
+                AND "Timestamp" >= %s::date AND "Timestamp" < %s::date + 1""").format(
+                    columna, sql.SQL(',').join(map(sql.Identifier, COLUMNAS_KPI)), sql.Identifier(table_name), filtro)
+        params = (list(selecciones), start_date, end_date) # Lista para que psycopg2 la envíe como ARRAY
+
+        if geo_agregacion in TABLAS_EMPAQUETADAS:
+            df = consulta_empaquetada(cur, geo_agregacion, COLUMNAS_KPI, filtro, params, columna)
+        else:
+            df = consulta_columnar(cur, query, params)
+        df = df.sort_values(by=[name_column, "Timestamp"])
+        cur.close()
+
+        return df
+
+    except Exception as e:
+        print("Error al obtener información de las selecciones a comparar: ", e)
+        return pd.DataFrame()
+
+    finally:
+        conn.close()
+
+def map_query(start_date, end_date, kpi, geo_agg, name_column):
+    return con_archivo(geo_agg, start_date, end_date, "Timestamp",
+                       lambda rutas: mapa_parquet(rutas, kpi, geo_agg, name_column),
+                       lambda inicio: mapa_reciente(inicio, end_date, kpi, geo_agg, name_column))
+
+def mapa_reciente(start_date, end_date, kpi, geo_agg, name_column):
+    table_name = TABLAS[geo_agg] # Elección para completar la consulta según agregación
+
+    rutas = archivos_locales(geo_agg, start_date, end_date, recorrido=True) # El mapa lee todas las entidades del rango
+    if rutas is not None:
+        try:
+            return mapa_parquet(rutas, kpi, geo_agg, name_column)
+        except Exception as e:
+            print("Error en el histórico local, se consulta PostgreSQL: ", e)
+
+    try:
+        # Conectarse a la base de datos
+        conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+
+        # Crear cursor
+        cur = conn.cursor()
+
+        columns = COLUMNAS_MAPA[kpi] # Contadores necesarios para el KPI seleccionado
+
+        if geo_agg in TABLAS_EMPAQUETADAS:
+            # Un arreglo por contador y día de cada entidad en vez de 24 filas
+            df = consulta_empaquetada(cur, geo_agg, columns, None, (start_date, end_date))
+        else:
+            if geo_agg != 'total':
+                columns = [name_column] + columns
+
+            query = sql.SQL("""SELECT "Timestamp", {}
+                            FROM {}
+                            WHERE "Timestamp" >= %s::date AND "Timestamp" < %s::date + 1""").format(
+                                sql.SQL(', ').join(map(sql.Identifier, columns)), sql.Identifier(table_name))
+
+            # print("Consulta :", query.as_string(cur))
+
+            df = consulta_columnar(cur, query, (start_date, end_date))
+        print("Consulta para mostrar KPI en el mapa exitosa")
+
+        df = df.sort_values(by="Timestamp")
+        cur.close() # Se cierra el cursor
+        print("Se ha creado el dataframe de la consulta para mostrar el KPI")
+
+        return df
+
+    except Exception as e:
+        print("Error al conectar con la base de datos: ", e)
+        return pd.DataFrame()
+
+    finally:
+        conn.close()
+
+def map_snapshot(geo_agg, kpi, start_date, end_date):
+    # Valor del KPI en BH por marcador o polígono precalculado por el ETL para las ventanas por defecto del mapa.
+    # Si el rango no es una de esas ventanas (o la tabla no existe aún) se devuelve un df vacio y el mapa se
+    # calcula en vivo con map_query
+    conn = None
+    try:
+        conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+        cur = conn.cursor()
+
+        query = sql.SQL("""SELECT "nombre", "valor"
+                        FROM "ran_map_snapshot"
+                        WHERE "agregacion" = %s AND "kpi" = %s AND "inicio" = %s AND "fin" = %s""")
+
+        df = consulta_columnar(cur, query, (geo_agg, kpi, start_date, end_date), parse_dates=())
+        cur.close()
+
+        return df
+
+    except Exception as e:
+        print("No se pudo consultar el snapshot del mapa: ", e)
+        return pd.DataFrame()
+
+    finally:
+        if conn is not None: # Si falló la conexión no hay nada que cerrar y se devuelve el df vacio
+            conn.close()
+
+def estados_query(seleccion, geo_agregacion, start_date, end_date):
+    # Estados combinables por día de la selección (Comun/estados_kpi.py) en forma ancha, con "Timestamp" al inicio del
+    # día. Las celdas no tienen estados guardados; sin la tabla o sin días en el rango se devuelve un df vacio
+    if geo_agregacion == "total":
+        nombre = "total"
+    elif geo_agregacion in AGREGACIONES_UPPER:
+        nombre = str(seleccion).upper()
+    else:
+        nombre = str(seleccion)
+
+    conn = None
+    try:
+        conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+        cur = conn.cursor()
+
+        query = sql.SQL("""SELECT "Date",{}
+                        FROM {}
+                        WHERE "nivel" = %s AND "nombre" = %s AND "Date" BETWEEN %s AND %s""").format(
+                            sql.SQL(',').join(map(sql.Identifier, estados_kpi.COLUMNAS_TABLA[3:])), sql.Identifier(estados_kpi.TABLA))
+
+        df = consulta_columnar(cur, query, (geo_agregacion, nombre, start_date, end_date), parse_dates=())
+        cur.close()
+
+        df = estados_kpi.de_tabla(df).rename(columns={"Date": "Timestamp"})
+        df["Timestamp"] = kpis_ran.timestamps_unicos(df["Timestamp"], "%Y-%m-%d")
+        return df.sort_values(by="Timestamp")
+
+    except Exception as e:
+        print("No se pudo consultar los estados de la selección: ", e)
+        return pd.DataFrame()
+
+    finally:
+        if conn is not None: # Si falló la conexión no hay nada que cerrar y se devuelve el df vacio
+            conn.close()
+
+class ExportacionCancelada(Exception):
+    # Se levanta dentro del COPY cuando el cliente cierra la descarga, para liberar la conexión
+    pass
+
+class _EscritorGzip:
+    # Objeto tipo archivo que recibe lo que escribe copy_expert, lo comprime en formato gzip y lo pone en una
+    # cola acotada. Si la cola está llena el COPY espera, por lo que nunca hay más de unos pocos bloques en memoria
+
+    def __init__(self, cola, cancelado, nombre):
+        self.cola = cola
+        self.cancelado = cancelado
+        self.nombre = nombre
+        self.compresor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 genera encabezado y cola gzip
+        self.buffer = bytearray()
+        self.filas = -1 # La primera línea es el encabezado del CSV
+        self.bytes_leidos = 0
+        self.siguiente_aviso = FILAS_AVISO_PROGRESO
+
+    def _poner(self, bloque):
+        while True:
+            try:
+                self.cola.put(bloque, timeout=1)
+                return
+            except queue.Full:
+                if self.cancelado.is_set():
+                    raise ExportacionCancelada()
+
+    def write(self, datos):
+        self.buffer += datos
+        self.bytes_leidos += len(datos)
+        self.filas += datos.count(b"\n")
+        if len(self.buffer) >= TAM_BLOQUE_EXPORTACION:
+            self._poner(self.compresor.compress(bytes(self.buffer)))
+            self.buffer.clear()
+        if self.filas >= self.siguiente_aviso:
+            print(f"{self.nombre}: {self.filas} filas exportadas")
+            self.siguiente_aviso += FILAS_AVISO_PROGRESO
+
+    def cerrar(self):
+        self._poner(self.compresor.compress(bytes(self.buffer)) + self.compresor.flush())
+        self.buffer.clear()
+        print(f"{self.nombre}: exportación terminada con {max(self.filas, 0)} filas")
+
+def exportar_gzip(query, params, nombre):
+    # Devuelve un generador que entrega el resultado de la consulta como CSV comprimido en gzip, bloque a bloque.
+    # Un hilo ejecuta COPY (...) TO STDOUT y escribe en la cola; el generador la vacía hacia la respuesta HTTP.
+    # La memoria usada es constante (tamaño de la cola) sin importar cuántas filas tenga el resultado.
+    # La conexión se abre y la consulta se arma antes de devolver el generador: si fallan se levanta la excepción
+    # aquí y la ruta puede responder con un error en lugar de empezar una descarga vacía
+    conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+    try:
+        cur = conn.cursor()
+        consulta = cur.mogrify(query, params).decode(encodings[conn.encoding])
+        copy_query = sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)").format(sql.SQL(consulta)).as_string(cur)
+    except Exception:
+        conn.close()
+        raise
+
+    cola = queue.Queue(maxsize=BLOQUES_EN_COLA)
+    cancelado = threading.Event()
+    fin = object() # Marca de fin de la exportación
+
+    @instrumentacion.medir("exportar_gzip")
+    def productor():
+        ultimo = fin # Lo último que recibe el generador: la marca de fin o el error que cortó la exportación
+        try:
+            escritor = _EscritorGzip(cola, cancelado, nombre)
+            try:
+                with instrumentacion.tiempo_sql(): # Incluye la espera cuando el cliente descarga más lento que el COPY
+                    cur.copy_expert(copy_query, escritor)
+            finally:
+                instrumentacion.anotar(filas=max(escritor.filas, 0), bytes_leidos=escritor.bytes_leidos)
+            escritor.cerrar()
+            cur.close()
+
+        except ExportacionCancelada:
+            print(f"{nombre}: exportación cancelada por el cliente")
+
+        except Exception as e:
+            print(f"{nombre}: error durante la exportación: ", e)
+            ultimo = e
+
+        finally:
+            conn.close()
+            while not cancelado.is_set(): # Avisar al generador que terminó, salvo que ya no haya quien lea
+                try:
+                    cola.put(ultimo, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    def bloques():
+        # El hilo arranca con la primera lectura; si la respuesta nunca se lee, la conexión se cierra al liberarse
+        # el generador
+        hilo = threading.Thread(target=productor, name=nombre, daemon=True)
+        hilo.start()
+        try:
+            while True:
+                bloque = cola.get()
+                if bloque is fin:
+                    break
+                if isinstance(bloque, Exception):
+                    raise bloque # Corta la descarga: el cliente ve un error y no un gzip truncado como si fuera completo
+                yield bloque
+        finally:
+            cancelado.set() # Si el cliente cerró la descarga el productor deja de escribir y libera la conexión
+
+    return bloques()
+
+def report_export(start_date, end_date):
+    # Exportación en streaming de los KPIs diarios de todas las celdas dentro del rango de fechas
+    query = sql.SQL("""SELECT {}
+                    FROM "ran_kpi_cell"
+                    WHERE "Date" BETWEEN %s AND %s""").format(sql.SQL(',').join(map(sql.Identifier, COLUMNAS_REPORTE)))
+
+    return exportar_gzip(query, (start_date, end_date), f"Reporte KPI {start_date} - {end_date}")
+
+def ranking_sql(geo_agregacion, kpi, start_date, end_date, n, descendente):
+    # Arma la consulta del ranking de las N selecciones con mayor (o menor) promedio del KPI en hora pico.
+    # Todo el cálculo se hace en PostgreSQL y solo viajan N filas: para celdas se usa la tabla diaria de KPIs,
+    # que ya tiene el valor en BH por celda y día; para el resto de agregaciones se agrupa la tabla por hora por
+    # entidad y día y cada grupo se reduce al valor de su BH (la hora con más usuarios, la primera si empatan, como
+    # kpis_ran.hora_pico), así sobre las filas por hora no se hace ningún ordenamiento global. El filtro de tiempo
+    # es un rango sobre la columna sin funciones, para que PostgreSQL pueda usar los índices que empiezan por la fecha
+    columna_kpi, expresion = RANKING_KPIS[kpi]
+    orden = sql.SQL("DESC" if descendente else "ASC")
+    n = max(1, min(int(n), MAX_RANKING))
+
+    if geo_agregacion == "celda":
+        query = sql.SQL("""SELECT "cell_name" AS nombre, AVG({kpi}) AS valor, COUNT({kpi}) AS dias
+                FROM "ran_kpi_cell"
+                WHERE "Date" BETWEEN %s AND %s
+                AND {kpi} IS NOT NULL AND {kpi} <> 'NaN'
+                GROUP BY "cell_name"
+                ORDER BY valor {orden}
+                LIMIT %s""").format(kpi=sql.Identifier(columna_kpi), orden=orden)
+    else:
+        name_column = sql.Identifier(COLUMNAS_NOMBRE[geo_agregacion])
+        query = sql.SQL("""SELECT nombre, AVG(valor) AS valor, COUNT(valor) AS dias
+                FROM (
+                    SELECT r.{nombre} AS nombre,
+                        (ARRAY_AGG({expresion} ORDER BY r."L.Traffic.ActiveUser.DL.Avg" DESC NULLS LAST, r."Timestamp"))[1] AS valor
+                    FROM {tabla} r
+                    WHERE r."Timestamp" >= %s::date AND r."Timestamp" < %s::date + 1
+                    GROUP BY r.{nombre}, DATE(r."Timestamp")
+                ) bh
+                WHERE valor IS NOT NULL AND valor <> 'NaN'
+                GROUP BY nombre
+                ORDER BY valor {orden}
+                LIMIT %s""").format(nombre=name_column, expresion=sql.SQL(expresion),
+                                    tabla=sql.Identifier(TABLAS[geo_agregacion]), orden=orden)
+
+    return query, (start_date, end_date, n)
+
+@consulta_compartida
+def ranking_query(geo_agregacion, kpi, start_date, end_date, n, descendente):
+    # Ranking de selecciones para mostrar en la tabla del dashboard
+    query, params = ranking_sql(geo_agregacion, kpi, start_date, end_date, n, descendente)
+    conn = None
+    try:
+        conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+        cur = conn.cursor()
+        df = consulta_columnar(cur, query, params, parse_dates=())
+        cur.close()
+        print(f"Ranking de {kpi} por {geo_agregacion} consultado: {len(df)} filas")
+        return df
+
+    except Exception as e:
+        print("Error al consultar el ranking: ", e)
+        return pd.DataFrame()
+
+    finally:
+        if conn is not None: # Si falló la conexión no hay nada que cerrar y se devuelve el df vacio
+            conn.close()
+
+def ranking_export(geo_agregacion, kpi, start_date, end_date, n, descendente):
+    # Misma consulta del ranking exportada como CSV comprimido
+    query, params = ranking_sql(geo_agregacion, kpi, start_date, end_date, n, descendente)
+    return exportar_gzip(query, params, f"Ranking {kpi} {geo_agregacion} {start_date} - {end_date}")
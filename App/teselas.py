@@ -0,0 +1,85 @@
+# Índice espacial de los marcadores del mapa (celdas o sectores) para servirlos por teselas.
+# Cada marcador se ubica en su tesela web mercator (esquema z/x/y de los mapas web) al nivel de zoom ZOOM_INDICE y
+# se ordena por la clave Morton de esa tesela (bits de x e y intercalados). Con este orden todos los marcadores de
+# una tesela de cualquier zoom menor quedan contiguos, así que extraerlos es una búsqueda binaria y un corte
+import numpy as np
+
+#----------- Constantes -----------#
+ZOOM_INDICE = 16 # Zoom de las teselas más pequeñas del índice, unos 600 m de lado en el ecuador
+NIVELES_SUBTESELA = 6 # Una tesela se divide en 2^6 x 2^6 subceldas para reducir marcadores en zoom bajo
+MAX_MARCADORES_TESELA = 2000 # Por encima de esta cantidad se deja un solo marcador por subcelda
+LATITUD_MAXIMA = 85.05112878 # Límite de la proyección web mercator
+
+
+
+#---------- Funciones ----------#
+def tesela_xy(lat, lon, zoom):
+    # Coordenadas x, y de la tesela que contiene cada punto en el zoom indicado
+    n = 2 ** zoom
+    lat_rad = np.radians(np.clip(lat, -LATITUD_MAXIMA, LATITUD_MAXIMA))
+    x = np.floor((lon + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) / 2.0 * n)
+    return np.clip(x, 0, n - 1).astype(np.uint64), np.clip(y, 0, n - 1).astype(np.uint64)
+
+def intercalar_bits(v):
+    # Separa los 16 bits de v dejando un cero entre cada uno (0b1011 -> 0b1000101)
+    v = np.asarray(v, dtype=np.uint64) & np.uint64(0xFFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x33333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x55555555)
+    return v
+
+def clave_morton(x, y):
+    return intercalar_bits(x) | (intercalar_bits(y) << np.uint64(1))
+
+class IndiceTeselas:
+    # Marcadores ordenados por clave Morton junto con su nombre y coordenadas
+
+    def __init__(self, nombres, lat, lon):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        validos = ~(np.isnan(lat) | np.isnan(lon)) # Marcadores sin coordenadas no se pueden ubicar
+        x, y = tesela_xy(lat[validos], lon[validos], ZOOM_INDICE)
+        claves = clave_morton(x, y)
+        orden = np.argsort(claves, kind="stable")
+
+        self.claves = claves[orden]
+        self.nombres = np.asarray(nombres, dtype=object)[validos][orden]
+        self.lat = lat[validos][orden]
+        self.lon = lon[validos][orden]
+
+    def __len__(self):
+        return len(self.claves)
+
+    def rango(self, z, x, y):
+        # Posiciones [inicio, fin) de los marcadores dentro de la tesela z/x/y
+        desplazamiento = np.uint64(2 * (ZOOM_INDICE - z))
+        inicio = clave_morton(x, y) << desplazamiento
+        fin = inicio + (np.uint64(1) << desplazamiento)
+        return np.searchsorted(self.claves, [inicio, fin])
+
+    def tesela(self, z, x, y, valores, peor_es_menor=False):
+        # Marcadores de la tesela con su valor de KPI (valores está alineado con el orden del índice). Si hay
+        # demasiados se deja uno por subcelda, el de peor valor, para que los puntos críticos se sigan viendo
+        if not (0 <= z <= ZOOM_INDICE and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError(f"Tesela fuera de rango: {z}/{x}/{y}")
+
+        inicio, fin = self.rango(z, x, y)
+        posiciones = np.arange(inicio, fin)
+
+        if len(posiciones) > MAX_MARCADORES_TESELA:
+            nivel = min(z + NIVELES_SUBTESELA, ZOOM_INDICE)
+            grupos = self.claves[inicio:fin] >> np.uint64(2 * (ZOOM_INDICE - nivel))
+            prioridad = -valores[inicio:fin] if peor_es_menor else valores[inicio:fin].copy()
+            prioridad = np.where(np.isnan(prioridad), -np.inf, prioridad) # Sin dato tiene la menor prioridad
+            orden = np.lexsort((prioridad, grupos)) # Por subcelda y dentro de ella por prioridad ascendente
+            ultimos = np.r_[grupos[orden][1:] != grupos[orden][:-1], True] # Último de cada subcelda = peor valor
+            posiciones = posiciones[np.sort(orden[ultimos])]
+
+        return {
+            "nombre": self.nombres[posiciones].tolist(),
+            "lat": self.lat[posiciones].tolist(),
+            "lon": self.lon[posiciones].tolist(),
+            "valor": [None if np.isnan(v) else float(v) for v in valores[posiciones]], # NaN no es JSON válido
+        }
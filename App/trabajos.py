@@ -0,0 +1,99 @@
+# Ejecución en segundo plano de los callbacks largos del dashboard.
+# Localmente los trabajos corren en procesos aparte con diskcache como almacén de trabajos y resultados; si está
+# definida la variable de entorno REDIS_URL se usa Celery, cuyo pool de procesos atiende los trabajos por fuera
+# de los workers web. En ambos casos los workers web quedan libres para las interacciones rápidas
+import os
+import time
+import uuid
+import hashlib
+import pickle
+import functools
+import threading
+
+import diskcache
+from dash import DiskcacheManager, CeleryManager
+
+#----------- Constantes -----------#
+CARPETA_CACHE = os.environ.get("DASHWOM_CACHE", "./cache_trabajos") # Carpeta del almacén local de trabajos
+EXPIRACION_RESULTADOS = 10 # Segundos que se conserva el resultado de un trabajo para que lo lean los que esperaban su bloqueo
+EXPIRACION_BLOQUEO = 10 # Segundos que dura el bloqueo de un cálculo si quien lo tiene deja de renovarlo (trabajo terminado por Dash)
+INTERVALO_RENOVACION = 3 # Cada cuántos segundos renueva su bloqueo el trabajo que está calculando
+ESPERA_BLOQUEO = 0.1 # Segundos entre revisiones de quien espera el resultado de un cálculo en curso
+
+cache = diskcache.Cache(CARPETA_CACHE)
+
+if "REDIS_URL" in os.environ:
+    from celery import Celery
+    celery_app = Celery(__name__, broker=os.environ["REDIS_URL"], backend=os.environ["REDIS_URL"])
+    background_callback_manager = CeleryManager(celery_app)
+else:
+    background_callback_manager = DiskcacheManager(cache)
+
+
+
+#---------- Funciones ----------#
+def renovar_bloqueo(llave, dueno, detener):
+    # Mientras el cálculo sigue vivo extiende su bloqueo. Si Dash termina el proceso del trabajo (el mismo callback
+    # se volvió a disparar o se canceló) este hilo muere con él y el bloqueo vence solo en EXPIRACION_BLOQUEO
+    while not detener.wait(INTERVALO_RENOVACION):
+        if cache.get(llave, default=None) != dueno:
+            return
+        cache.touch(llave, expire=EXPIRACION_BLOQUEO)
+
+def proceso_vivo(dueno):
+    # El dueño de un bloqueo es "pid:id". El almacén es local, así que todos los procesos que lo comparten están en
+    # esta máquina y se puede revisar si el pid sigue vivo
+    try:
+        os.kill(int(dueno.split(":")[0]), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+def deduplicar(ignorar=()):
+    # Decorador para que solicitudes idénticas en curso compartan un solo cálculo. La llave sale del nombre de la
+    # función y sus argumentos (menos los de las posiciones en "ignorar", p. ej. n_clicks que cambia por sesión).
+    # El primer trabajo toma el bloqueo de la llave y calcula; los que llegan mientras tanto revisan el almacén, que
+    # es compartido entre procesos, hasta que aparece el resultado. No es un caché: un resultado solo se entrega a
+    # quien llegó antes de que terminara de calcularse, el resto calcula de nuevo.
+    # El bloqueo no se sostiene durante todo el cálculo: es un permiso corto que el trabajo renueva mientras está vivo.
+    # Dash termina el proceso de un trabajo sin dejarlo liberar nada; si el pid del dueño ya no existe el siguiente que
+    # espera toma su lugar de inmediato, y si no se puede saber el bloqueo igual vence en pocos segundos
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args):
+            argumentos = [arg for i, arg in enumerate(args) if i not in ignorar]
+            clave = hashlib.sha256(pickle.dumps((funcion.__name__, argumentos))).hexdigest()
+            llave_bloqueo = f"bloqueo:{clave}"
+            dueno = f"{os.getpid()}:{uuid.uuid4().hex}"
+            llegada = time.time()
+
+            while True:
+                guardado = cache.get(f"resultado:{clave}", default=None) # (fin del cálculo, resultado)
+                if guardado is not None and guardado[0] >= llegada: # Se estaba calculando cuando llegó esta solicitud
+                    return guardado[1]
+                if cache.add(llave_bloqueo, dueno, expire=EXPIRACION_BLOQUEO): # Solo uno lo obtiene, add no reemplaza
+                    break
+                actual = cache.get(llave_bloqueo, default=None)
+                if actual is not None and not proceso_vivo(actual): # El dueño murió, no hay que esperar a que venza
+                    print(f"{funcion.__name__}: el trabajo {actual} terminó sin liberar su bloqueo, se toma su lugar")
+                    cache.delete(llave_bloqueo)
+                    continue
+                time.sleep(ESPERA_BLOQUEO)
+
+            detener = threading.Event()
+            threading.Thread(target=renovar_bloqueo, args=(llave_bloqueo, dueno, detener), daemon=True).start()
+            try:
+                guardado = cache.get(f"resultado:{clave}", default=None) # El anterior dueño pudo terminar justo antes
+                if guardado is not None and guardado[0] >= llegada:
+                    return guardado[1]
+                resultado = funcion(*args)
+                cache.set(f"resultado:{clave}", (time.time(), resultado), expire=EXPIRACION_RESULTADOS)
+                return resultado
+            finally:
+                detener.set()
+                if cache.get(llave_bloqueo, default=None) == dueno:
+                    cache.delete(llave_bloqueo)
+        return envoltura
+    return decorador
@@ -0,0 +1,101 @@
+# Benchmark del archivo frío (Comun/archivo_frio.py): archiva los días más viejos de una tabla como lo hace
+# equilibrar() antes de borrar, pero sin borrarlos, y reporta el tiempo de archivo por día, los bytes por día en
+# PostgreSQL (tabla e índices) contra los del Parquet, y para la historia de una selección y el mapa el tiempo de
+# punta a punta solo con PostgreSQL contra la unión del archivo con PostgreSQL. Como las filas siguen en la base,
+# ambas rutas deben devolver lo mismo.
+#
+# Uso (sobre la base que llenó bench_etl.py, con la tabla empaquetada de celdas o una horaria):
+#   DASHWOM_ARCHIVO=/tmp/archivo python bench_archivo.py --dsn "dbname=ran_bench user=postgres" --tabla ran_1d_cell --dias-archivo 2
+import argparse
+import os
+import sys
+import time
+from datetime import timedelta
+
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+
+from bench_etl import RAIZ, importar_etl
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        df = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return df, min(tiempos)
+
+def main():
+    parser = argparse.ArgumentParser(description="Espacio y costo de consulta del archivo frío en Parquet")
+    parser.add_argument("--dsn", required=True, help="PostgreSQL local exclusivo para el benchmark")
+    parser.add_argument("--tabla", default="ran_1d_cell", help="Tabla que equilibrar() archivaría")
+    parser.add_argument("--dias-archivo", type=int, default=2, help="Días más viejos que se archivan")
+    parser.add_argument("--kpi", default="PRB")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    etl, _ = importar_etl(args.dsn)
+    sys.path.insert(0, os.path.join(RAIZ, "App"))
+    import consultas
+    archivo_frio = consultas.archivo_frio
+    tabla = etl.tabla_archivo(args.tabla)
+    if tabla is None:
+        parser.error(f"{args.tabla} no se archiva")
+    if not (archivo_frio.escritura_habilitada() and archivo_frio.lectura_habilitada()):
+        print("Falta DASHWOM_ARCHIVO o no están instalados pyarrow y duckdb")
+        return
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    columna = "Date" if args.tabla == etl.TABLA_CELDAS_DIA else "Timestamp"
+    cur.execute(sql.SQL("SELECT MIN({})::date, MAX({})::date, COUNT(DISTINCT {}::date) FROM {}").format(
+        sql.Identifier(columna), sql.Identifier(columna), sql.Identifier(columna), sql.Identifier(args.tabla)))
+    inicio, fin, dias = cur.fetchone()
+    if fin is None or dias <= args.dias_archivo:
+        print(f"La tabla {args.tabla} necesita más de {args.dias_archivo} días, correr antes bench_etl.py")
+        return
+    corte = inicio + timedelta(days=args.dias_archivo)
+
+    # Archivo de los días anteriores al corte, sin el DELETE de equilibrar
+    segundos = time.perf_counter()
+    etl.archivar(conn, args.tabla, corte)
+    segundos = time.perf_counter() - segundos
+    archivados = [inicio + timedelta(days=i) for i in range(args.dias_archivo) if archivo_frio.archivado(tabla, inicio + timedelta(days=i))]
+    bytes_parquet = sum(os.path.getsize(etl.historico_local.ruta_dia(tabla, dia, archivo_frio.RAIZ)) for dia in archivados)
+    cur.execute("SELECT pg_total_relation_size(%s::regclass)", (args.tabla,))
+    bytes_pg = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    print(f"Tabla {args.tabla}, {dias} días ({inicio} - {fin}), {len(archivados)} archivados en {segundos:.2f} s")
+    print(f"Bytes por día: PostgreSQL {bytes_pg / dias / 2**20:.1f} MiB, Parquet {bytes_parquet / max(len(archivados), 1) / 2**20:.1f} MiB\n")
+
+    geo = next(g for g, t in consultas.TABLAS.items() if t == tabla)
+    name_column = consultas.COLUMNAS_NOMBRE[geo]
+    mapa = consultas.map_query(fin, fin, args.kpi, geo, name_column)
+    seleccion = None if name_column is None else str(mapa[name_column].dropna().iloc[0])
+    if geo in consultas.AGREGACIONES_UPPER and seleccion is not None:
+        seleccion = seleccion.upper()
+
+    casos = {
+        "historia": lambda: consultas.query_to_df(seleccion, geo, inicio, fin),
+        "mapa": lambda: consultas.map_query(inicio, fin, args.kpi, geo, name_column),
+    }
+    print(f"{'consulta':<10}{'filas':>10}{'PostgreSQL s':>14}{'archivo + PG s':>16}")
+    raiz = archivo_frio.RAIZ
+    for nombre, funcion in casos.items():
+        archivo_frio.RAIZ = None # Sin archivo todo el rango se lee de PostgreSQL
+        df_pg, segundos_pg = medir(funcion, args.repeticiones)
+        archivo_frio.RAIZ = raiz
+        df_union, segundos_union = medir(funcion, args.repeticiones)
+        print(f"{nombre:<10}{len(df_union):>10}{segundos_pg:>14.3f}{segundos_union:>16.3f}")
+
+        columnas = list(df_pg.columns)
+        orden = [c for c in ("Timestamp", name_column) if c in columnas]
+        pd.testing.assert_frame_equal(df_pg.sort_values(orden).reset_index(drop=True),
+                                      df_union[columnas].sort_values(orden).reset_index(drop=True), check_dtype=False)
+    print("\nResultados iguales con y sin archivo")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Benchmark de la lectura de consultas del dashboard: ruta anterior (cur.fetchall() + pd.DataFrame) contra la ruta
+# columnar (COPY ... TO STDOUT leído con el parser en C de pandas). Se mide tiempo, pico de memoria y cantidad de
+# bloques de memoria reservados por Python durante la lectura, que es donde se ve la creación de objetos por fila.
+#
+# Uso (desde la carpeta App para que encuentre DBcredentials):
+#   python ../Benchmarks/bench_consultas.py --agregacion celda --kpi PRB --inicio 2024-07-01 --fin 2024-07-03
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "App"))
+import DBcredentials
+from consultas import TABLAS, COLUMNAS_NOMBRE, COLUMNAS_MAPA, consulta_columnar
+
+
+def consulta_mapa(kpi, agregacion):
+    # Misma consulta que arma map_query para el KPI y la agregación
+    columnas = COLUMNAS_MAPA[kpi]
+    if agregacion != "total":
+        columnas = [COLUMNAS_NOMBRE[agregacion]] + columnas
+    query = sql.SQL("""SELECT "Timestamp", {}
+                    FROM {}
+                    WHERE "Timestamp" >= %s::date AND "Timestamp" < %s::date + 1""").format(
+                        sql.SQL(', ').join(map(sql.Identifier, columnas)), sql.Identifier(TABLAS[agregacion]))
+    return query, ["Timestamp"] + columnas
+
+def ruta_fetchall(cur, query, params, columnas):
+    # Ruta anterior: una tupla por fila y un objeto por valor antes de construir el DataFrame
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    return pd.DataFrame(rows, columns=columnas)
+
+def ruta_columnar(cur, query, params, columnas):
+    return consulta_columnar(cur, query, params)
+
+def medir(nombre, funcion, conn, query, params, columnas, repeticiones):
+    tiempos = []
+    for i in range(repeticiones):
+        cur = conn.cursor()
+        tracemalloc.start()
+        inicio = time.perf_counter()
+        df = funcion(cur, query, params, columnas)
+        tiempos.append(time.perf_counter() - inicio)
+        snapshot = tracemalloc.take_snapshot()
+        actual, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        cur.close()
+    bloques = sum(stat.count for stat in snapshot.statistics("filename"))
+    print(f"{nombre:<10} filas={len(df):>9}  mejor={min(tiempos):8.3f} s  mediana={sorted(tiempos)[len(tiempos)//2]:8.3f} s  "
+          f"pico={pico/2**20:8.1f} MiB  bloques_vivos={bloques:>10}")
+    return df
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara fetchall() contra COPY columnar para las consultas del mapa")
+    parser.add_argument("--agregacion", default="celda", choices=list(TABLAS))
+    parser.add_argument("--kpi", default="PRB", choices=list(COLUMNAS_MAPA))
+    parser.add_argument("--inicio", required=True)
+    parser.add_argument("--fin", required=True)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    query, columnas = consulta_mapa(args.kpi, args.agregacion)
+    params = (args.inicio, args.fin)
+
+    conn = psycopg2.connect(**DBcredentials.BD_DATA_PARAMS)
+    try:
+        df_fetch = medir("fetchall", ruta_fetchall, conn, query, params, columnas, args.repeticiones)
+        df_copy = medir("columnar", ruta_columnar, conn, query, params, columnas, args.repeticiones)
+    finally:
+        conn.close()
+
+    # Comprobación de que ambas rutas entregan los mismos datos
+    df_fetch = df_fetch.sort_values(columnas).reset_index(drop=True)
+    df_copy = df_copy.sort_values(columnas).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df_fetch, df_copy, check_dtype=False)
+    print("Resultados iguales en ambas rutas")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Benchmark del arreglo de columnas del CSV diario (editar_archivos_csv): lectura, arreglo y escritura en un solo
+# proceso con pd.read_csv contra lectura_paralela.transformar_csv con 1, 2, 4, ... procesos hasta la cantidad de
+# núcleos. Reporta tiempo, aceleración y eficiencia por cantidad de procesos y comprueba que el resultado sea el mismo.
+# El archivo se genera con datos_sinteticos.py en el formato que queda después de borrar el preámbulo.
+#
+# Uso (correr en el worker de Airflow para ver la escalabilidad real):
+#   python bench_csv_paralelo.py --celdas 60000 --repeticiones 3
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+import datos_sinteticos
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Airflow"))
+sys.modules.setdefault("DBcredentials", types.ModuleType("DBcredentials")) # Tasks_daily lo importa, aquí no se usa la base
+import Tasks_daily
+import lectura_paralela
+
+
+def serial(origen, destino):
+    # Ruta anterior: un solo proceso lee, arregla y escribe el archivo completo
+    df = pd.read_csv(origen, usecols=Tasks_daily.COLUMNAS_GESTOR)
+    df = Tasks_daily.arreglar_bloque(df)
+    df.to_csv(destino, index=False)
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos)
+
+def main():
+    parser = argparse.ArgumentParser(description="Escalabilidad del arreglo paralelo del CSV diario")
+    parser.add_argument("--celdas", type=int, default=60000)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--max-procesos", type=int, default=os.cpu_count())
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+
+    carpeta = tempfile.mkdtemp(prefix="bench_csv_")
+    try:
+        origen = os.path.join(carpeta, "diario.csv")
+        celdas = datos_sinteticos.generar_celdas(args.celdas, args.semilla)
+        dia = date.today() - timedelta(days=1)
+        datos_sinteticos.contadores_dia(celdas, dia, np.random.default_rng(args.semilla)).to_csv(origen, index=False)
+        print(f"Archivo de {os.path.getsize(origen) / 2**20:.0f} MiB, {args.celdas * 24} filas, {os.cpu_count()} núcleos")
+
+        destino_serial = os.path.join(carpeta, "serial.csv")
+        base = medir(lambda: serial(origen, destino_serial), args.repeticiones)
+        print(f"{'serial':<12}{base:8.2f} s")
+
+        destino = os.path.join(carpeta, "paralelo.csv")
+        lectura_paralela.TAM_MINIMO_PARALELO = 0 # Que con cualquier tamaño de archivo se use el pool
+        cantidades = sorted({2**i for i in range(args.max_procesos.bit_length()) if 2**i <= args.max_procesos} | {args.max_procesos})
+        for procesos in cantidades:
+            segundos = medir(lambda: lectura_paralela.transformar_csv(origen, destino, Tasks_daily.arreglar_bloque,
+                                                                      usecols=Tasks_daily.COLUMNAS_GESTOR, procesos=procesos), args.repeticiones)
+            print(f"{f'{procesos} procesos':<12}{segundos:8.2f} s   aceleración {base / segundos:5.2f}x   eficiencia {base / segundos / procesos:5.0%}")
+
+        # Mismo contenido que la ruta serial (los números pueden cambiar de formato, no de valor)
+        pd.testing.assert_frame_equal(pd.read_csv(destino_serial), pd.read_csv(destino), check_dtype=False)
+        print("Resultados iguales en ambas rutas")
+    finally:
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
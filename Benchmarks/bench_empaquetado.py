@@ -0,0 +1,114 @@
+# Benchmark de la tabla empaquetada de celdas (ran_1d_cell, una fila por celda y día con arreglos de 24 horas) contra
+# la tabla por hora (ran_1h_cell). Reporta bytes por celda y día de cada una (tabla, TOAST e índices), los días de
+# historia que caben en el presupuesto de disco para la red completa y, para las consultas del dashboard (historia de
+# varias celdas y rango del mapa), tiempo de punta a punta y bytes leídos desde PostgreSQL. También comprueba que las
+# dos rutas devuelvan las mismas filas por hora.
+#
+# Uso (sobre la base que llenó bench_etl.py con menos de 7 días, así ambas tablas tienen los mismos días):
+#   python bench_empaquetado.py --dsn "dbname=ran_bench user=postgres" --celdas-red 60000 --presupuesto-gb 20
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+
+from bench_etl import RAIZ, importar_etl
+
+
+def tamano(cur, tabla):
+    # Bytes de la tabla (con su TOAST, donde PostgreSQL guarda comprimidos los arreglos largos) y de sus índices
+    cur.execute("SELECT pg_table_size(%s::regclass), pg_indexes_size(%s::regclass)", (tabla, tabla))
+    return cur.fetchone()
+
+def celdas_dia(cur, consulta):
+    cur.execute(consulta)
+    return cur.fetchone()[0]
+
+def medir(instrumentacion, funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        with instrumentacion.medir("bench_empaquetado") as medicion:
+            inicio = time.perf_counter()
+            df = funcion()
+            tiempos.append(time.perf_counter() - inicio)
+    return df, min(tiempos), medicion.bytes_leidos
+
+def ordenar(df, columnas):
+    return df.sort_values(["Cell_name", "Timestamp"]).reset_index(drop=True)[columnas]
+
+def main():
+    parser = argparse.ArgumentParser(description="Espacio y costo de consulta de la tabla empaquetada de celdas contra la tabla por hora")
+    parser.add_argument("--dsn", required=True, help="PostgreSQL local exclusivo para el benchmark")
+    parser.add_argument("--celdas-red", type=int, default=60000, help="Celdas de la red para proyectar la historia que cabe")
+    parser.add_argument("--presupuesto-gb", type=float, default=20)
+    parser.add_argument("--selecciones", type=int, default=5, help="Celdas en la consulta de historia")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+
+    etl, instrumentacion = importar_etl(args.dsn)
+    sys.path.insert(0, os.path.join(RAIZ, "App"))
+    import consultas
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    for tabla in ("ran_1h_cell", etl.TABLA_CELDAS_DIA):
+        cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(tabla)))
+    conn.commit()
+
+    # Espacio por celda y día
+    print(f"{'tabla':<14}{'celdas-día':>12}{'tabla MiB':>11}{'índices MiB':>13}{'bytes/celda-día':>17}{'días en presupuesto':>21}")
+    conteos = {
+        "ran_1h_cell": 'SELECT COUNT(*) FROM (SELECT DISTINCT "Cell_name", "Timestamp"::date FROM "ran_1h_cell") d',
+        etl.TABLA_CELDAS_DIA: f'SELECT COUNT(*) FROM "{etl.TABLA_CELDAS_DIA}"',
+    }
+    for tabla, consulta in conteos.items():
+        n = celdas_dia(cur, consulta)
+        tabla_bytes, indices_bytes = tamano(cur, tabla)
+        por_celda_dia = (tabla_bytes + indices_bytes) / n if n else float("nan")
+        dias = args.presupuesto_gb * 1e9 / (por_celda_dia * args.celdas_red)
+        print(f"{tabla:<14}{n:>12}{tabla_bytes / 2**20:>11.1f}{indices_bytes / 2**20:>13.1f}{por_celda_dia:>17.0f}{dias:>21.0f}")
+
+    cur.execute(f'SELECT MIN("Date"), MAX("Date") FROM "{etl.TABLA_CELDAS_DIA}"')
+    inicio, fin = cur.fetchone()
+    if fin is None:
+        print("La tabla empaquetada no tiene datos, correr antes bench_etl.py")
+        return
+    cur.execute(f'SELECT DISTINCT UPPER("Cell_name") FROM "{etl.TABLA_CELDAS_DIA}" WHERE "Date" = %s', (fin,))
+    nombres = [fila[0] for fila in cur.fetchall()]
+    selecciones = np.random.default_rng(args.semilla).choice(nombres, min(args.selecciones, len(nombres)), replace=False).tolist()
+    print(f"\nConsultas de {inicio} a {fin}, {len(selecciones)} celdas en la historia, mejor de {args.repeticiones}")
+
+    columnas_historia = ["Timestamp", "Cell_name"] + consultas.COLUMNAS_KPI
+    columnas_mapa = ["Timestamp", "Cell_name"] + consultas.COLUMNAS_MAPA["PRB"]
+    filtro = sql.SQL('UPPER("Cell_name") = ANY(%s)')
+    por_hora = {
+        "historia": (sql.SQL('SELECT "Timestamp",{} FROM "ran_1h_cell" WHERE {} AND "Timestamp" >= %s::date AND "Timestamp" < %s::date + 1').format(
+                        sql.SQL(",").join(map(sql.Identifier, columnas_historia[1:])), filtro), (selecciones, inicio, fin), columnas_historia),
+        "mapa": (sql.SQL('SELECT "Timestamp",{} FROM "ran_1h_cell" WHERE "Timestamp" >= %s::date AND "Timestamp" < %s::date + 1').format(
+                    sql.SQL(",").join(map(sql.Identifier, columnas_mapa[1:]))), (inicio, fin), columnas_mapa),
+    }
+    empaquetadas = {
+        "historia": lambda c: consultas.consulta_empaquetada(c, "celda", consultas.COLUMNAS_KPI, filtro, (selecciones, inicio, fin)),
+        "mapa": lambda c: consultas.consulta_empaquetada(c, "celda", consultas.COLUMNAS_MAPA["PRB"], None, (inicio, fin)),
+    }
+
+    print(f"{'consulta':<10}{'ruta':<14}{'filas':>10}{'segundos':>10}{'MB leídos':>11}")
+    try:
+        for nombre, (query, params, columnas) in por_hora.items():
+            df_hora, segundos, leidos = medir(instrumentacion, lambda: consultas.consulta_columnar(cur, query, params), args.repeticiones)
+            print(f"{nombre:<10}{'por hora':<14}{len(df_hora):>10}{segundos:>10.3f}{leidos / 1e6:>11.2f}")
+            df_dia, segundos, leidos = medir(instrumentacion, lambda: empaquetadas[nombre](cur), args.repeticiones)
+            print(f"{nombre:<10}{'empaquetada':<14}{len(df_dia):>10}{segundos:>10.3f}{leidos / 1e6:>11.2f}")
+            pd.testing.assert_frame_equal(ordenar(df_hora, columnas), ordenar(df_dia, columnas), check_dtype=False)
+        print("Resultados iguales en ambas rutas")
+    finally:
+        cur.close()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# Benchmark del ETL diario completo (las mismas tareas del DAG ran_etl_pipeline) contra un PostgreSQL local con
+# datos sintéticos de datos_sinteticos.py. Por cada día se genera el ZIP del gestor y se corren descompresión,
+# limpieza, carga de todas las agregaciones y snapshots del mapa. Al final se reporta por etapa el tiempo total,
+# el tiempo en base de datos y en Python, filas por segundo, MB leídos/escritos y pico de memoria, medidos con la
+# instrumentación del ETL (Comun/instrumentacion.py).
+#
+# Con --salida se guarda el resultado en JSON y con --comparar se contrasta con una corrida anterior: si alguna
+# etapa tarda más que la tolerancia el script termina con código 1, así se puede usar para detectar regresiones.
+#
+# Uso (la base debe ser exclusiva del benchmark, --reiniciar borra las tablas del ETL):
+#   python bench_etl.py --dsn "dbname=ran_bench user=postgres" --celdas 2000 --dias 3 --reiniciar --salida base.json
+#   python bench_etl.py --dsn "dbname=ran_bench user=postgres" --celdas 2000 --dias 3 --reiniciar --comparar base.json
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import parse_dsn
+
+import datos_sinteticos
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TABLAS_ETL = ["ran_1h_cell", "ran_1d_cell", "ran_kpi_cell", "ran_1h_sector", "ran_1h_node", "ran_1h_cluster", "ran_1h_localidad",
+              "ran_1h_municipio", "ran_1h_am", "ran_1h_departamento", "ran_1h_regional", "ran_1h_total", "ran_map_snapshot", "etl_etapas", "ran_1d_estados"]
+
+
+def importar_etl(dsn):
+    # El ETL lee las credenciales del módulo DBcredentials; para el benchmark ambas bases son la local
+    credenciales = types.ModuleType("DBcredentials")
+    credenciales.BD_DATA_PARAMS = parse_dsn(dsn)
+    credenciales.BD_GEO_PARAMS = parse_dsn(dsn)
+    sys.modules["DBcredentials"] = credenciales
+    sys.path.insert(0, os.path.join(RAIZ, "Airflow"))
+    import Tasks_daily
+    import instrumentacion
+    return Tasks_daily, instrumentacion
+
+def reiniciar_base(dsn):
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    for tabla in TABLAS_ETL:
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(tabla)))
+    conn.commit()
+    conn.close()
+
+def correr_dia(etl, carpeta_zip, carpeta_trabajo):
+    # Mismo orden que las tareas del DAG
+    etl.descomprimir_archivos(carpeta_zip, carpeta_trabajo)
+    etl.borrar_encabezado(carpeta_trabajo)
+    etl.editar_archivos_csv(carpeta_trabajo)
+    etl.tablas_agregaciones(carpeta_trabajo)
+    etl.snapshots_mapa()
+
+def resumen(acumulados, segundos_total):
+    print(f"\n{'etapa':<30}{'llamadas':>9}{'total s':>10}{'sql s':>9}{'python s':>10}{'filas':>12}{'filas/s':>11}"
+          f"{'MB leídos':>11}{'MB escritos':>12}{'pico MiB':>10}")
+    for etapa, valores in sorted(acumulados.items(), key=lambda item: -item[1]["segundos"]):
+        filas_s = valores["filas"] / valores["segundos"] if valores["segundos"] else 0
+        print(f"{etapa:<30}{valores['llamadas']:>9}{valores['segundos']:>10.2f}{valores['segundos_sql']:>9.2f}"
+              f"{valores['segundos'] - valores['segundos_sql']:>10.2f}{valores['filas']:>12}{filas_s:>11.0f}"
+              f"{valores['bytes_leidos'] / 1e6:>11.1f}{valores['bytes_escritos'] / 1e6:>12.1f}{valores['memoria_pico_bytes'] / 2**20:>10.1f}")
+    print(f"\nTotal del ETL: {segundos_total:.2f} s")
+
+def comparar(acumulados, anterior, tolerancia):
+    # Etapas cuyo tiempo medio por llamada empeoró más que la tolerancia respecto a la corrida anterior
+    regresiones = []
+    for etapa, valores in acumulados.items():
+        previo = anterior.get(etapa)
+        if not previo or not previo["segundos"]:
+            continue
+        razon = (valores["segundos"] / valores["llamadas"]) / (previo["segundos"] / previo["llamadas"])
+        marca = "  <-- regresión" if razon > 1 + tolerancia else ""
+        print(f"{etapa:<30} {razon:6.2f}x{marca}")
+        if marca:
+            regresiones.append(etapa)
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description="Corre el ETL diario completo sobre datos sintéticos y reporta tiempos por etapa")
+    parser.add_argument("--dsn", required=True, help="PostgreSQL local exclusivo para el benchmark")
+    parser.add_argument("--celdas", type=int, default=2000)
+    parser.add_argument("--dias", type=int, default=1)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--prob-nil", type=float, default=0.001)
+    parser.add_argument("--reiniciar", action="store_true", help="Borra las tablas del ETL antes de empezar, para corridas comparables")
+    parser.add_argument("--perfil-memoria", action="store_true", help="Pico de memoria por etapa con tracemalloc (más lento)")
+    parser.add_argument("--salida", help="Archivo JSON donde guardar el resultado")
+    parser.add_argument("--comparar", help="JSON de una corrida anterior contra el cual detectar regresiones")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="Aumento de tiempo por etapa permitido al comparar")
+    args = parser.parse_args()
+
+    if args.perfil_memoria:
+        os.environ["DASHWOM_PERFIL_MEMORIA"] = "1" # Se lee al importar la instrumentación
+    etl, instrumentacion = importar_etl(args.dsn)
+
+    if args.reiniciar:
+        reiniciar_base(args.dsn)
+
+    celdas = datos_sinteticos.generar_celdas(args.celdas, args.semilla)
+    conn = psycopg2.connect(args.dsn)
+    try:
+        datos_sinteticos.cargar_celdas(conn, celdas)
+    finally:
+        conn.close()
+
+    carpeta = tempfile.mkdtemp(prefix="bench_etl_")
+    carpeta_zip = os.path.join(carpeta, "ftp")
+    carpeta_trabajo = os.path.join(carpeta, "tmp")
+    segundos_total = 0.0
+    filas_total = 0
+    try:
+        for dia in datos_sinteticos.dias_sinteticos(args.dias):
+            ruta_zip, filas = datos_sinteticos.exportar_dia(celdas, dia, carpeta_zip, args.semilla, args.prob_nil) # Fuera de la medición
+            inicio = time.perf_counter()
+            correr_dia(etl, carpeta_zip, carpeta_trabajo)
+            segundos_total += time.perf_counter() - inicio
+            filas_total += filas
+            os.remove(ruta_zip)
+    finally:
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+    acumulados = instrumentacion.acumulados()
+    resumen(acumulados, segundos_total)
+    print(f"Filas horarias de celda procesadas: {filas_total} ({filas_total / segundos_total:.0f} filas/s de punta a punta)")
+
+    resultado = {"parametros": vars(args), "segundos_total": segundos_total, "filas_total": filas_total, "etapas": acumulados}
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(resultado, f, indent=2)
+        print(f"Resultado guardado en {args.salida}")
+
+    if args.comparar:
+        with open(args.comparar) as f:
+            anterior = json.load(f)
+        print(f"\nComparación contra {args.comparar} (tiempo medio por llamada, actual / anterior)")
+        regresiones = comparar(acumulados, anterior["etapas"], args.tolerancia)
+        if regresiones:
+            print(f"Regresiones en: {', '.join(regresiones)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
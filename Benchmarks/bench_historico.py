@@ -0,0 +1,73 @@
+# Benchmark del histórico local (Parquet + DuckDB, Comun/historico_local.py) contra PostgreSQL para las consultas de
+# recorrido del dashboard: tendencia de una regional en todo el rango, mapa nacional de celdas y comparación de
+# varias regionales. Se llaman las funciones de App/consultas.py forzando uno u otro backend, se reporta el mejor
+# tiempo de punta a punta y se comprueba que ambos devuelvan las mismas filas.
+#
+# Uso (el ETL tiene que haber escrito el histórico local, es decir correr bench_etl.py con DASHWOM_HISTORICO):
+#   DASHWOM_HISTORICO=/tmp/historico python bench_etl.py --dsn "dbname=ran_bench user=postgres" --dias 30 --reiniciar
+#   DASHWOM_HISTORICO=/tmp/historico python bench_historico.py --dsn "dbname=ran_bench user=postgres"
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+from bench_etl import RAIZ, importar_etl
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        df = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return df, min(tiempos)
+
+def main():
+    parser = argparse.ArgumentParser(description="PostgreSQL contra el histórico local en Parquet para las consultas de recorrido")
+    parser.add_argument("--dsn", required=True, help="PostgreSQL local exclusivo para el benchmark")
+    parser.add_argument("--kpi", default="PRB")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    importar_etl(args.dsn) # Deja las credenciales del benchmark en DBcredentials para consultas.py
+    sys.path.insert(0, os.path.join(RAIZ, "App"))
+    import consultas
+    historico_local = consultas.historico_local
+    if not historico_local.lectura_habilitada():
+        print("Falta DASHWOM_HISTORICO o duckdb no está instalado")
+        return
+
+    # Rango: los días que el histórico local tiene de celdas y regionales
+    dias = set.intersection(*[{archivo[:10] for archivo in os.listdir(os.path.join(historico_local.RAIZ, tabla))}
+                              for tabla in ("ran_1h_cell", "ran_1h_regional")])
+    if not dias:
+        print("El histórico local no tiene datos, correr antes bench_etl.py con DASHWOM_HISTORICO")
+        return
+    inicio, fin = min(dias), max(dias)
+    regionales = tuple(sorted(consultas.map_query(fin, fin, "BH", "regional", "regional_name")["regional_name"].dropna().unique()))
+    print(f"Rango {inicio} - {fin} ({len(dias)} días), {len(regionales)} regionales, mejor de {args.repeticiones}\n")
+
+    casos = {
+        "tendencia regional": lambda: consultas.query_to_df(regionales[0], "regional", inicio, fin),
+        "mapa de celdas": lambda: consultas.map_query(inicio, fin, args.kpi, "celda", "Cell_name"),
+        "comparar regionales": lambda: consultas.query_multi_df(regionales, "regional", inicio, fin),
+    }
+    print(f"{'consulta':<22}{'filas':>10}{'PostgreSQL s':>14}{'local s':>10}{'aceleración':>13}")
+    raiz = historico_local.RAIZ
+    for nombre, funcion in casos.items():
+        historico_local.RAIZ = None # Sin histórico todas las consultas van a PostgreSQL
+        df_pg, segundos_pg = medir(funcion, args.repeticiones)
+        historico_local.RAIZ = raiz
+        df_local, segundos_local = medir(funcion, args.repeticiones)
+        print(f"{nombre:<22}{len(df_local):>10}{segundos_pg:>14.3f}{segundos_local:>10.3f}{segundos_pg / segundos_local:>12.1f}x")
+
+        columnas = list(df_pg.columns)
+        orden = [c for c in ("Timestamp", "Cell_name", "regional_name") if c in columnas]
+        pd.testing.assert_frame_equal(df_pg.sort_values(orden).reset_index(drop=True),
+                                      df_local[columnas].sort_values(orden).reset_index(drop=True), check_dtype=False)
+    print("\nResultados iguales en ambos backends")
+
+if __name__ == "__main__":
+    main()
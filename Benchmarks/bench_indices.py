@@ -0,0 +1,189 @@
+# Benchmark de los índices de una tabla horaria: B-tree ("Timestamp", nombre) que creaba antes el ETL contra BRIN por
+# "Timestamp" más índice de cobertura (nombre, "Timestamp") INCLUDE (...) de Tasks_daily.indices_tabla_horaria.
+# En ran_1h_cell la estrategia nueva es solo el BRIN (Tasks_daily.TABLAS_SIN_COBERTURA), así se mide lo que ahorra el COPY.
+# Por cada estrategia se reporta el tamaño de la tabla y de cada índice, el tiempo de COPY de un día nuevo de celdas
+# (en una transacción que se deshace) y la latencia en la base de datos, con EXPLAIN ANALYZE, de las dos consultas
+# del dashboard: la historia de una selección (query_to_df) y el rango de fechas de todas las entidades (map_query).
+# También se muestra el plan usado y las lecturas de la tabla (Heap Fetches), que deben ser 0 en la lectura solo del índice.
+#
+# Uso (sobre la base que llenó bench_etl.py; al terminar la tabla queda con los índices nuevos):
+#   python bench_indices.py --dsn "dbname=ran_bench user=postgres" --tabla ran_1h_cell --dias 3 --repeticiones 5
+import argparse
+import io
+import json
+import statistics
+import time
+from datetime import timedelta
+
+import numpy as np
+import psycopg2
+from psycopg2 import sql
+
+import datos_sinteticos
+from bench_etl import importar_etl
+
+ESTRATEGIAS = ["anterior", "nueva"]
+
+
+def quitar_indices(conn, tabla):
+    cur = conn.cursor()
+    cur.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass", (tabla,))
+    for (indice,) in cur.fetchall():
+        cur.execute(sql.SQL("DROP INDEX {}").format(sql.SQL(indice))) # regclass ya viene citado si hace falta
+    conn.commit()
+    cur.close()
+
+def aplicar_estrategia(conn, etl, tabla, estrategia):
+    quitar_indices(conn, tabla)
+    if estrategia == "anterior":
+        name_column = etl.TABLAS_HORARIAS[tabla][0]
+        llave = [sql.Identifier("Timestamp")] + ([sql.Identifier(name_column)] if name_column else [])
+        cur = conn.cursor()
+        cur.execute(sql.SQL("CREATE INDEX {} ON {} ({})").format(
+            sql.Identifier(f"idx_{tabla}_time_name"), sql.Identifier(tabla), sql.SQL(", ").join(llave)))
+        conn.commit()
+        cur.close()
+    else:
+        etl.indices_tabla_horaria(conn, tabla)
+    # Mismo estado que deja el ETL después de cargar: estadísticas y mapa de visibilidad al día
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(sql.SQL("VACUUM ANALYZE {}").format(sql.Identifier(tabla)))
+    cur.close()
+    conn.autocommit = False
+
+def tamanos(conn, tabla):
+    cur = conn.cursor()
+    cur.execute("SELECT pg_relation_size(%s::regclass)", (tabla,))
+    tabla_bytes = cur.fetchone()[0]
+    cur.execute("""SELECT indexrelid::regclass::text, pg_relation_size(indexrelid)
+                   FROM pg_index WHERE indrelid = %s::regclass ORDER BY 1""", (tabla,))
+    indices = cur.fetchall()
+    cur.close()
+    return tabla_bytes, indices
+
+def consultas_dashboard(etl, tabla):
+    # Las mismas consultas que arman query_to_df y map_query en App/consultas.py
+    name_column, mayusculas = etl.TABLAS_HORARIAS[tabla]
+    columnas = sql.SQL(",").join(map(sql.Identifier, etl.kpis_ran.CONTADORES_GRAFICAS))
+    rango = sql.SQL('"Timestamp" >= %s::date AND "Timestamp" < %s::date + 1')
+    if name_column is None:
+        historia = sql.SQL('SELECT "Timestamp",{} FROM {} WHERE {}').format(columnas, sql.Identifier(tabla), rango)
+        return historia, historia
+    if mayusculas:
+        filtro = sql.SQL("UPPER({}) = %s").format(sql.Identifier(name_column))
+    else:
+        filtro = sql.SQL("{} = %s").format(sql.Identifier(name_column))
+    historia = sql.SQL('SELECT "Timestamp",{},{} FROM {} WHERE {} AND {}').format(
+        sql.Identifier(name_column), columnas, sql.Identifier(tabla), filtro, rango)
+    mapa = sql.SQL('SELECT "Timestamp",{},{} FROM {} WHERE {}').format(sql.Identifier(name_column), columnas, sql.Identifier(tabla), rango)
+    return historia, mapa
+
+def nodos_plan(plan):
+    yield plan
+    for hijo in plan.get("Plans", []):
+        yield from nodos_plan(hijo)
+
+def explicar(cur, query, params):
+    cur.execute(sql.SQL("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ") + query, params)
+    resultado = cur.fetchone()[0]
+    resultado = json.loads(resultado) if isinstance(resultado, str) else resultado
+    plan = resultado[0]["Plan"]
+    nodos = list(nodos_plan(plan))
+    return {
+        "ms": resultado[0]["Execution Time"],
+        "plan": " + ".join(n["Node Type"] + (f" ({n['Index Name']})" if "Index Name" in n else "") for n in nodos if "Scan" in n["Node Type"]),
+        "heap_fetches": sum(n.get("Heap Fetches", 0) for n in nodos),
+        "bloques": plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0),
+    }
+
+def latencia(conn, query, lista_params, repeticiones):
+    # Mediana del tiempo de ejecución de todas las corridas; la primera de cada parámetro calienta la caché
+    cur = conn.cursor()
+    tiempos, ultimo = [], None
+    for params in lista_params:
+        for _ in range(repeticiones):
+            ultimo = explicar(cur, query, params)
+            tiempos.append(ultimo["ms"])
+    cur.close()
+    return statistics.median(tiempos), ultimo
+
+def datos_copy(etl, celdas, dia, semilla):
+    # Día de celdas en el formato que deja editar_archivos_csv, listo para el COPY de celdas()
+    df = datos_sinteticos.contadores_dia(celdas, dia, np.random.default_rng(semilla))
+    df = etl.arreglar_bloque(df[etl.COLUMNAS_GESTOR])
+    texto = io.StringIO()
+    df.to_csv(texto, index=False)
+    return list(df.columns), texto.getvalue()
+
+def tiempo_copy(conn, tabla, columnas, texto):
+    cur = conn.cursor()
+    copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH CSV HEADER").format(sql.Identifier(tabla), sql.SQL(", ").join(map(sql.Identifier, columnas)))
+    inicio = time.perf_counter()
+    cur.copy_expert(copy_query, io.StringIO(texto))
+    segundos = time.perf_counter() - inicio
+    conn.rollback() # La tabla queda igual para la siguiente estrategia
+    cur.close()
+    return segundos
+
+def main():
+    parser = argparse.ArgumentParser(description="Tamaño, costo de carga y latencia de consultas según la estrategia de índices")
+    parser.add_argument("--dsn", required=True, help="PostgreSQL local exclusivo para el benchmark")
+    parser.add_argument("--tabla", default="ran_1h_cell")
+    parser.add_argument("--dias", type=int, default=3, help="Días del rango consultado, terminando en el último día cargado")
+    parser.add_argument("--selecciones", type=int, default=5, help="Selecciones distintas para la consulta de historia")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--celdas-copy", type=int, default=2000, help="Celdas del día que se carga para medir el COPY (solo ran_1h_cell)")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+
+    etl, _ = importar_etl(args.dsn)
+    if args.tabla not in etl.TABLAS_HORARIAS:
+        parser.error(f"--tabla debe ser una de {', '.join(etl.TABLAS_HORARIAS)}")
+    name_column, mayusculas = etl.TABLAS_HORARIAS[args.tabla]
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    cur.execute(sql.SQL('SELECT MAX("Timestamp")::date FROM {}').format(sql.Identifier(args.tabla)))
+    fin = cur.fetchone()[0]
+    if fin is None:
+        print(f"La tabla {args.tabla} no tiene datos, correr antes bench_etl.py")
+        return
+    inicio = fin - timedelta(days=args.dias - 1)
+
+    historia, mapa = consultas_dashboard(etl, args.tabla)
+    if name_column is None:
+        params_historia = [(inicio, fin)]
+    else:
+        nombre = sql.SQL("UPPER({})" if mayusculas else "{}").format(sql.Identifier(name_column))
+        cur.execute(sql.SQL('SELECT DISTINCT {} FROM {} WHERE "Timestamp" >= %s::date').format(nombre, sql.Identifier(args.tabla)), (fin,))
+        nombres = [fila[0] for fila in cur.fetchall()]
+        rng = np.random.default_rng(args.semilla)
+        params_historia = [(n, inicio, fin) for n in rng.choice(nombres, min(args.selecciones, len(nombres)), replace=False).tolist()]
+    cur.close()
+
+    copy = None
+    if args.tabla == "ran_1h_cell":
+        celdas = datos_sinteticos.generar_celdas(args.celdas_copy, args.semilla)
+        copy = datos_copy(etl, celdas, fin + timedelta(days=1), args.semilla) # Día siguiente al último, como la carga diaria
+
+    print(f"Tabla {args.tabla}, rango {inicio} - {fin}, {len(params_historia)} selecciones, {args.repeticiones} repeticiones\n")
+    try:
+        for estrategia in ESTRATEGIAS: # "nueva" va al final para que la tabla quede como la deja el ETL
+            aplicar_estrategia(conn, etl, args.tabla, estrategia)
+            tabla_bytes, indices = tamanos(conn, args.tabla)
+            print(f"[{estrategia}] tabla {tabla_bytes / 2**20:.1f} MiB, índices {sum(b for _, b in indices) / 2**20:.1f} MiB")
+            for indice, tam in indices:
+                print(f"    {indice:<40}{tam / 2**20:10.2f} MiB")
+            if copy is not None:
+                print(f"    COPY de un día ({args.celdas_copy * 24} filas): {tiempo_copy(conn, args.tabla, *copy):.2f} s")
+            for nombre, query, lista in (("historia", historia, params_historia), ("rango", mapa, [(inicio, fin)])):
+                mediana, ultimo = latencia(conn, query, lista, args.repeticiones)
+                print(f"    {nombre:<9} mediana {mediana:9.2f} ms   bloques {ultimo['bloques']:>8}   heap fetches {ultimo['heap_fetches']:>8}   {ultimo['plan']}")
+            print()
+    finally:
+        conn.rollback()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
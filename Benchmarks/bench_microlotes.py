@@ -0,0 +1,76 @@
+# Benchmark de la carga por microlotes (Tasks_daily.microlotes, DAG ran_etl_microlotes): se entregan en la carpeta
+# del FTP exportes de una hora del día de hoy, uno a la vez, y se mide cuánto tarda cada uno en quedar en todas las
+# tablas (celdas, empaquetada y agregaciones), que es la frescura que ve el dashboard. Al final se vuelve a entregar
+# la primera hora con otros valores para medir el reemplazo y comprobar que no quedan filas duplicadas.
+# También se muestra el resumen por etapa de la instrumentación del ETL.
+#
+# Uso (la base debe ser exclusiva del benchmark):
+#   python bench_microlotes.py --dsn "dbname=ran_bench user=postgres" --celdas 2000 --horas 3
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import psycopg2
+
+import datos_sinteticos
+from bench_etl import importar_etl, resumen
+
+
+def entregar(celdas, dia, hora, carpeta_zip, semilla, segundos_estable):
+    # Exporte de una hora con fecha de modificación ya estable para zips_pendientes
+    ruta_zip, filas = datos_sinteticos.exportar_dia(celdas, dia, carpeta_zip, semilla, horas=[hora])
+    modificacion = time.time() - segundos_estable - 1
+    os.utime(ruta_zip, (modificacion, modificacion))
+    return filas
+
+def filas_hora(cur, tabla, hora):
+    cur.execute(f'SELECT COUNT(*) FROM "{tabla}" WHERE "Timestamp" = %s', (hora,))
+    return cur.fetchone()[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="Latencia de la carga por microlotes de una hora")
+    parser.add_argument("--dsn", required=True, help="PostgreSQL local exclusivo para el benchmark")
+    parser.add_argument("--celdas", type=int, default=2000)
+    parser.add_argument("--horas", type=int, default=3, help="Exportes de una hora que se entregan")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+
+    etl, instrumentacion = importar_etl(args.dsn)
+    celdas = datos_sinteticos.generar_celdas(args.celdas, args.semilla)
+    conn = psycopg2.connect(args.dsn)
+    datos_sinteticos.cargar_celdas(conn, celdas)
+    cur = conn.cursor()
+
+    hoy = date.today()
+    carpeta = tempfile.mkdtemp(prefix="bench_microlotes_")
+    carpeta_zip = os.path.join(carpeta, "ftp")
+    carpeta_trabajo = os.path.join(carpeta, "microlotes")
+    # La última entrega repite la primera hora con otra semilla: se reemplaza en lugar de sumarse
+    entregas = [(hora, args.semilla) for hora in range(args.horas)] + [(0, args.semilla + 1)]
+    segundos_total = 0.0
+    print(f"{'hora':<8}{'filas':>8}{'segundos':>10}{'celdas en BD':>14}{'regionales en BD':>18}")
+    try:
+        for hora, semilla in entregas:
+            filas = entregar(celdas, hoy, hora, carpeta_zip, semilla, etl.SEGUNDOS_ARCHIVO_ESTABLE)
+            inicio = time.perf_counter()
+            etl.microlotes(carpeta_zip, carpeta_trabajo)
+            segundos = time.perf_counter() - inicio
+            segundos_total += segundos
+            timestamp = datetime.combine(hoy, datetime.min.time()) + timedelta(hours=hora)
+            conn.rollback() # Lectura con una instantánea nueva
+            en_celdas, en_regional = filas_hora(cur, "ran_1h_cell", timestamp), filas_hora(cur, "ran_1h_regional", timestamp)
+            print(f"{hora:02d}:00   {filas:>8}{segundos:>10.2f}{en_celdas:>14}{en_regional:>18}")
+            if en_celdas != filas:
+                print(f"    La hora {hora:02d}:00 tiene {en_celdas} filas de celdas, se esperaban {filas}")
+    finally:
+        cur.close()
+        conn.close()
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+    resumen(instrumentacion.acumulados(), segundos_total)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+# Prueba de carga del dashboard: usuarios virtuales que repiten sesiones de navegación contra los endpoints de los
+# callbacks de Dash (/_dash-update-component), igual a como lo hace el navegador. Cada sesión es una lista de
+# pasos (callback a disparar y valores de los componentes); pueden ser sesiones sintéticas con agregaciones, KPIs y
+# rangos de fechas al azar o sesiones guardadas en JSON. Los callbacks en segundo plano (update_graphs, map_kpi) se
+# sondean hasta que el trabajo entrega el resultado, así la latencia medida es la que percibe el usuario.
+#
+# Reporta por callback latencia p50/p95/p99, throughput, tamaño de solicitudes y respuestas y, a partir de /metrics
+# del dashboard, consultas a la base de datos por llamada. Con --salida y --comparar detecta regresiones de p95.
+#
+# Uso (el dashboard debe estar corriendo contra un PostgreSQL con datos sintéticos, p. ej. cargados con bench_etl.py):
+#   python carga_dashboard.py --url http://localhost:8050 --usuarios 20 --duracion 300 --inicio 2024-07-01 --fin 2024-07-30
+#   python carga_dashboard.py --url http://localhost:8050 --sesiones sesiones.json --usuarios 50 --salida carga.json
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+from datetime import date, timedelta
+
+import numpy as np
+import requests
+
+#----------- Constantes -----------#
+# Cómo reconocer cada callback en /_dash-dependencies, que no trae el nombre de la función
+CALLBACKS = {
+    "update_dropdown": lambda dep: "select.options" in dep["output"],
+    "download_report": lambda dep: "reporte.href" in dep["output"],
+    "map_kpi": lambda dep: "map_text.children" in dep["output"],
+    "make_zoom": lambda dep: "map.figure" in dep["output"] and [f"{i['id']}.{i['property']}" for i in dep["inputs"]] == ["select.value"],
+    "update_graphs": lambda dep: "graph_test.figure" in dep["output"],
+}
+AGREGACIONES = ["celda", "sector", "EB", "cluster", "localidad", "municipio", "AM", "departamento", "regional", "total"]
+KPIS = ["BH", "PRB", "Traffic", "u_exp"]
+VENTANAS_DIAS = [1, 7, 30] # Largo del rango de fechas de las sesiones sintéticas
+PERCENTILES = (50, 95, 99)
+
+
+
+#---------- Funciones ----------#
+def valores_layout(nodo, valores):
+    # Recorre el layout serializado y guarda el valor inicial de cada propiedad de los componentes con id
+    if isinstance(nodo, list):
+        for hijo in nodo:
+            valores_layout(hijo, valores)
+    elif isinstance(nodo, dict) and "props" in nodo:
+        props = nodo["props"]
+        if isinstance(props.get("id"), str):
+            for prop, valor in props.items():
+                if prop not in ("id", "children"):
+                    valores[f"{props['id']}.{prop}"] = valor
+        valores_layout(props.get("children"), valores)
+    return valores
+
+def separar_salidas(salida):
+    # "..a.b...c.d.." -> [{"id": "a", "property": "b"}, ...]; en allow_duplicate la propiedad trae "@hash"
+    salidas = []
+    for parte in salida.strip(".").split("..."):
+        componente, propiedad = parte.rsplit(".", 1)
+        salidas.append({"id": componente, "property": propiedad.split("@")[0]})
+    return salidas
+
+def sesion_sintetica(rng, inicio, fin):
+    # Recorrido típico: elegir agregación, revisar el mapa de un KPI, seleccionar un punto y pedir sus gráficas
+    agregacion = str(rng.choice(AGREGACIONES))
+    ventana = int(rng.choice(VENTANAS_DIAS))
+    dia_fin = inicio + timedelta(days=int(rng.integers(0, (fin - inicio).days + 1)))
+    dia_inicio = max(dia_fin - timedelta(days=ventana - 1), inicio)
+    fechas = {"time.start_date": dia_inicio.isoformat(), "time.end_date": dia_fin.isoformat()}
+    return [
+        {"callback": "update_dropdown", "valores": {"aggregation.value": agregacion}},
+        {"callback": "download_report", "valores": fechas},
+        {"callback": "map_kpi", "valores": {"select_graph.value": str(rng.choice(KPIS))}, "clic": "update_kpi.n_clicks"},
+        {"callback": "make_zoom", "valores": {"select.value": "$opcion"}}, # Una opción al azar del dropdown ya cargado
+        {"callback": "update_graphs", "valores": {"time_agg.value": str(rng.choice(["hora", "dia", "semana"], p=[0.2, 0.6, 0.2]))}, "clic": "solicitar.n_clicks"},
+    ]
+
+class UsuarioVirtual:
+    # Una sesión de navegador: estado propio de los componentes y conexión HTTP reutilizada
+
+    def __init__(self, url, dependencias, estado_inicial, sondeo, rng):
+        self.url = url
+        self.dependencias = dependencias
+        self.estado = dict(estado_inicial)
+        self.sondeo = sondeo
+        self.rng = rng
+        self.http = requests.Session()
+
+    def cuerpo(self, dep, cambiado):
+        entradas = [{"id": i["id"], "property": i["property"], "value": self.estado.get(f"{i['id']}.{i['property']}")} for i in dep["inputs"]]
+        estados = [{"id": s["id"], "property": s["property"], "value": self.estado.get(f"{s['id']}.{s['property']}")} for s in dep["state"]]
+        salidas = separar_salidas(dep["output"])
+        return {
+            "output": dep["output"],
+            "outputs": salidas if len(salidas) > 1 or dep["output"].startswith("..") else salidas[0],
+            "inputs": entradas,
+            "changedPropIds": [cambiado or f"{dep['inputs'][0]['id']}.{dep['inputs'][0]['property']}"],
+            "state": estados,
+        }
+
+    def paso(self, paso):
+        # Aplica los valores del paso, dispara el callback y devuelve (segundos, bytes enviados, bytes recibidos)
+        for clave, valor in paso.get("valores", {}).items():
+            if valor == "$opcion":
+                opciones = self.estado.get("select.options") or [{"value": None}]
+                valor = opciones[int(self.rng.integers(len(opciones)))]["value"]
+            self.estado[clave] = valor
+        if paso.get("clic"):
+            self.estado[paso["clic"]] = (self.estado.get(paso["clic"]) or 0) + 1
+
+        dep = self.dependencias[paso["callback"]]
+        cambiado = paso.get("clic") or next(iter(paso.get("valores", {})), None)
+        datos = json.dumps(self.cuerpo(dep, cambiado)).encode()
+        enviados = recibidos = 0
+        parametros = {}
+
+        inicio = time.perf_counter()
+        while True:
+            respuesta = self.http.post(f"{self.url}/_dash-update-component", params=parametros, data=datos,
+                                       headers={"Content-Type": "application/json"}, timeout=600)
+            enviados += len(datos)
+            recibidos += len(respuesta.content)
+            if respuesta.status_code == 204: # PreventUpdate o no_update en todas las salidas
+                break
+            respuesta.raise_for_status()
+            contenido = respuesta.json()
+            if "cacheKey" in contenido and "job" in contenido: # Callback en segundo plano: se sondea el trabajo
+                parametros = {"cacheKey": contenido["cacheKey"], "job": contenido["job"]}
+            elif "response" in contenido:
+                self.actualizar(contenido["response"])
+                break
+            time.sleep(self.sondeo)
+        return time.perf_counter() - inicio, enviados, recibidos
+
+    def actualizar(self, respuesta):
+        # Las salidas que son entradas o estados de otros callbacks quedan en el estado; las figuras no se guardan
+        for componente, props in respuesta.items():
+            for prop, valor in props.items():
+                if prop != "figure":
+                    self.estado[f"{componente}.{prop}"] = valor
+
+def metricas_servidor(url):
+    # Llamadas y consultas a la base de datos por etapa según /metrics del dashboard
+    try:
+        texto = requests.get(f"{url}/metrics", timeout=30).text
+    except requests.RequestException as e:
+        print("No se pudo leer /metrics del dashboard: ", e)
+        return {}
+    valores = {}
+    for metrica, etapa, valor in re.findall(r'^dashwom_etapa_(segundos_count|consultas_total)\{etapa="([^"]+)"\} (\S+)$', texto, re.M):
+        valores.setdefault(etapa, {})[metrica] = float(valor)
+    return valores
+
+def correr(args, dependencias, estado_inicial, sesiones):
+    resultados = {nombre: [] for nombre in CALLBACKS} # (segundos, enviados, recibidos, error) por llamada
+    bloqueo = threading.Lock()
+    fin = time.monotonic() + args.rampa + args.duracion
+
+    def usuario(i):
+        rng = np.random.default_rng([args.semilla, i])
+        time.sleep(args.rampa * i / max(args.usuarios, 1)) # Los usuarios entran de forma escalonada
+        cliente = UsuarioVirtual(args.url, dependencias, estado_inicial, args.sondeo, rng)
+        while time.monotonic() < fin:
+            sesion = sesiones[int(rng.integers(len(sesiones)))] if sesiones else sesion_sintetica(rng, args.inicio, args.fin)
+            for paso in sesion:
+                if time.monotonic() >= fin:
+                    return
+                try:
+                    medida = cliente.paso(paso) + (False,)
+                except (requests.RequestException, ValueError) as e:
+                    print(f"Usuario {i}, {paso['callback']}: {e}")
+                    medida = (0.0, 0, 0, True)
+                with bloqueo:
+                    resultados[paso["callback"]].append(medida)
+                time.sleep(rng.exponential(args.pausa)) # Tiempo que el usuario mira la pantalla
+
+    hilos = [threading.Thread(target=usuario, args=(i,), daemon=True) for i in range(args.usuarios)]
+    inicio = time.monotonic()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    return resultados, time.monotonic() - inicio
+
+def resumen(resultados, segundos, antes, despues):
+    print(f"\n{'callback':<18}{'llamadas':>9}{'errores':>8}{'req/s':>8}" + "".join(f"{f'p{p} ms':>10}" for p in PERCENTILES) +
+          f"{'KB enviados':>13}{'KB recibidos':>14}{'consultas':>11}")
+    reporte = {}
+    for nombre, medidas in resultados.items():
+        exitosas = np.array([m[0] for m in medidas if not m[3]])
+        if not len(medidas):
+            continue
+        percentiles = np.percentile(exitosas, PERCENTILES) * 1000 if len(exitosas) else [float("nan")] * len(PERCENTILES)
+        etapa = f"callback.{nombre}"
+        llamadas_servidor = despues.get(etapa, {}).get("segundos_count", 0) - antes.get(etapa, {}).get("segundos_count", 0)
+        consultas = despues.get(etapa, {}).get("consultas_total", 0) - antes.get(etapa, {}).get("consultas_total", 0)
+        reporte[nombre] = {
+            "llamadas": len(medidas),
+            "errores": sum(m[3] for m in medidas),
+            "req_s": len(medidas) / segundos,
+            **{f"p{p}_ms": float(v) for p, v in zip(PERCENTILES, percentiles)},
+            "bytes_enviados": float(np.mean([m[1] for m in medidas])),
+            "bytes_recibidos": float(np.mean([m[2] for m in medidas])),
+            "consultas_por_llamada": consultas / llamadas_servidor if llamadas_servidor else None,
+        }
+        r = reporte[nombre]
+        consultas_txt = f"{r['consultas_por_llamada']:.2f}" if r["consultas_por_llamada"] is not None else "-"
+        print(f"{nombre:<18}{r['llamadas']:>9}{r['errores']:>8}{r['req_s']:>8.2f}" + "".join(f"{v:>10.0f}" for v in percentiles) +
+              f"{r['bytes_enviados'] / 1024:>13.1f}{r['bytes_recibidos'] / 1024:>14.1f}{consultas_txt:>11}")
+    total = sum(r["llamadas"] for r in reporte.values())
+    print(f"\n{total} llamadas en {segundos:.1f} s: {total / segundos:.2f} llamadas/s")
+    return reporte
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de los callbacks del dashboard")
+    parser.add_argument("--url", default="http://localhost:8050", help="URL del dashboard, con el prefijo de rutas si lo tiene")
+    parser.add_argument("--usuarios", type=int, default=10)
+    parser.add_argument("--duracion", type=float, default=120, help="Segundos de carga después de la rampa")
+    parser.add_argument("--rampa", type=float, default=10, help="Segundos en los que entran todos los usuarios")
+    parser.add_argument("--pausa", type=float, default=2.0, help="Tiempo medio entre pasos de una sesión")
+    parser.add_argument("--sondeo", type=float, default=0.25, help="Intervalo de sondeo de los callbacks en segundo plano")
+    parser.add_argument("--inicio", type=date.fromisoformat, default=date.today() - timedelta(days=30), help="Primer día con datos")
+    parser.add_argument("--fin", type=date.fromisoformat, default=date.today() - timedelta(days=1), help="Último día con datos")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--sesiones", help="JSON con una lista de sesiones (listas de pasos) para repetir en lugar de las sintéticas")
+    parser.add_argument("--guardar-sesiones", type=int, metavar="N", help="Escribe N sesiones sintéticas en --sesiones y termina")
+    parser.add_argument("--salida", help="Archivo JSON donde guardar el resultado")
+    parser.add_argument("--comparar", help="JSON de una corrida anterior contra el cual detectar regresiones de p95")
+    parser.add_argument("--tolerancia", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.guardar_sesiones:
+        rng = np.random.default_rng(args.semilla)
+        with open(args.sesiones, "w") as f:
+            json.dump([sesion_sintetica(rng, args.inicio, args.fin) for _ in range(args.guardar_sesiones)], f, indent=2)
+        print(f"{args.guardar_sesiones} sesiones guardadas en {args.sesiones}")
+        return
+
+    sesiones = None
+    if args.sesiones:
+        with open(args.sesiones) as f:
+            sesiones = json.load(f)
+
+    # Callbacks y estado inicial de los componentes tal como los recibe el navegador
+    dependencias = {}
+    for dep in requests.get(f"{args.url}/_dash-dependencies", timeout=30).json():
+        for nombre, coincide in CALLBACKS.items():
+            if coincide(dep):
+                dependencias[nombre] = dep
+    faltantes = set(CALLBACKS) - set(dependencias)
+    if faltantes:
+        sys.exit(f"No se encontraron los callbacks: {', '.join(sorted(faltantes))}")
+    estado_inicial = valores_layout(requests.get(f"{args.url}/_dash-layout", timeout=30).json(), {})
+    estado_inicial.update({"time.start_date": args.inicio.isoformat(), "time.end_date": args.fin.isoformat()})
+
+    antes = metricas_servidor(args.url)
+    resultados, segundos = correr(args, dependencias, estado_inicial, sesiones)
+    despues = metricas_servidor(args.url)
+    reporte = resumen(resultados, segundos, antes, despues)
+
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump({"parametros": {k: str(v) for k, v in vars(args).items()}, "segundos": segundos, "callbacks": reporte}, f, indent=2)
+        print(f"Resultado guardado en {args.salida}")
+
+    if args.comparar:
+        with open(args.comparar) as f:
+            anterior = json.load(f)["callbacks"]
+        print(f"\nComparación de p95 contra {args.comparar} (actual / anterior)")
+        regresiones = []
+        for nombre, r in reporte.items():
+            previo = anterior.get(nombre)
+            if not previo or not previo.get("p95_ms"):
+                continue
+            razon = r["p95_ms"] / previo["p95_ms"]
+            marca = "  <-- regresión" if razon > 1 + args.tolerancia else ""
+            print(f"{nombre:<18} {razon:6.2f}x{marca}")
+            if marca:
+                regresiones.append(nombre)
+        if regresiones:
+            print(f"Regresiones en: {', '.join(regresiones)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
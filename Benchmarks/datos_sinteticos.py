@@ -0,0 +1,206 @@
+# Generador de datos RAN sintéticos con el mismo formato que el ETL recibe en producción: un ZIP por día con el CSV
+# horario por celda del gestor (6 líneas de preámbulo, encabezado, filas y una línea de cierre, con valores "NIL"
+# en algunos contadores) y la tabla bodega_analitica.roaming_cell_dim con la ubicación de cada celda.
+# Con la misma semilla, cantidad de celdas y días los archivos generados son idénticos, así los benchmarks son
+# comparables entre corridas.
+#
+# Uso:
+#   python datos_sinteticos.py --celdas 2000 --dias 3 --carpeta ./ftp_sintetico --dsn "dbname=ran_bench user=postgres"
+import argparse
+import io
+import os
+import zipfile
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+#----------- Constantes -----------#
+# Municipios de la red sintética: nombre, código DANE, departamento, regional, prefijo de los sitios, lat, lon
+MUNICIPIOS = [
+    ("BOGOTA", 11001, 11, "BOGOTA D.C.", "CENTRO", "BTA", 4.65, -74.08),
+    ("MEDELLIN", 5001, 5, "ANTIOQUIA", "NOROCCIDENTE", "MED", 6.25, -75.57),
+    ("CALI", 76001, 76, "VALLE DEL CAUCA", "SUROCCIDENTE", "CLI", 3.44, -76.52),
+    ("BARRANQUILLA", 8001, 8, "ATLANTICO", "NORTE", "BQL", 10.96, -74.80),
+    ("BUCARAMANGA", 68001, 68, "SANTANDER", "ORIENTE", "BUC", 7.12, -73.12),
+    ("PEREIRA", 66001, 66, "RISARALDA", "NOROCCIDENTE", "PER", 4.81, -75.69),
+    ("TUNJA", 15001, 15, "BOYACA", "CENTRO", "TUN", 5.53, -73.36), # Sin área metropolitana
+]
+PESOS_MUNICIPIOS = [0.40, 0.18, 0.14, 0.10, 0.07, 0.06, 0.05] # Fracción de sitios de cada municipio
+LOCALIDADES_BOGOTA = 19 # Bogotá es el único municipio con localidades, el resto queda con código -1
+SITIOS_POR_CLUSTER = 20
+
+# Bandas: PRBs disponibles (ancho de banda) y sectores que usa cada una. B4 se nombra AWS en el nombre de celda
+BANDAS = {"B4": (100, [1, 2, 3]), "B28": (50, [4, 5, 6])}
+
+# Columnas del CSV del gestor. Las que no usa el ETL están para que el archivo tenga el ancho real
+COLUMNAS_CSV = ["Date", "Time", "Granularity", "eNodeB Name", "Cell Name", "LocalCell Id", "Integrity",
+                "L.Traffic.ActiveUser.DL.Avg", "L.Traffic.ActiveUser.DL.Max", "L.Traffic.ActiveUser.UL.Avg", "L.Traffic.ActiveUser.UL.Max",
+                "L.Traffic.User.Avg", "L.Traffic.User.Max", "L.ChMeas.PRB.DL.Avail", "L.ChMeas.PRB.DL.Used.Avg", "L.ChMeas.PRB.UL.Avail",
+                "L.ChMeas.PRB.UL.Used.Avg", "L.Thrp.bits.DL(bit)", "L.Thrp.bits.UL(bit)", "L.Thrp.bits.DL.LastTTI(bit)", "L.Thrp.Time.DL.RmvLastTTI(ms)"]
+CONTADORES = COLUMNAS_CSV[7:]
+
+COLUMNAS_DIM = [("dwh_cell_name_wom", "VARCHAR"), ("dwh_banda", "VARCHAR"), ("dwh_sector", "INTEGER"), ("dwh_latitud", "DOUBLE PRECISION"),
+                ("dwh_longitud", "DOUBLE PRECISION"), ("cluster_key", "VARCHAR"), ("cluster_nombre", "VARCHAR"), ("dwh_localidad", "VARCHAR"),
+                ("dwh_dane_cod_localidad", "BIGINT"), ("dane_nombre_mpio", "VARCHAR"), ("dane_code", "INTEGER"), ("dane_code_dpto", "INTEGER"),
+                ("dane_nombre_dpt", "VARCHAR"), ("wom_regional", "VARCHAR"), ("dwh_operador_rat", "VARCHAR")]
+
+
+
+#---------- Funciones ----------#
+def generar_celdas(n_celdas, semilla=0):
+    # Inventario de celdas con el esquema de roaming_cell_dim. Cada sitio tiene 3 sectores en B4 y, la mitad de
+    # ellos, otros 3 en B28. El nombre de la celda en los reportes es sitio_banda_sector (B4 aparece como AWS)
+    rng = np.random.default_rng(semilla)
+    filas = []
+    sitio = 0
+    while len(filas) < n_celdas:
+        i_mpio = rng.choice(len(MUNICIPIOS), p=PESOS_MUNICIPIOS)
+        mpio, dane_code, dpto, nombre_dpto, regional, prefijo, lat, lon = MUNICIPIOS[i_mpio]
+        sitio += 1
+        nombre_sitio = f"{prefijo} SITIO{sitio:05d}"
+        lat_sitio = lat + rng.normal(0, 0.05)
+        lon_sitio = lon + rng.normal(0, 0.05)
+        if dane_code == 11001:
+            n_localidad = int(rng.integers(1, LOCALIDADES_BOGOTA + 1))
+            localidad, cod_localidad = f"LOCALIDAD {n_localidad:02d}", dane_code * 100 + n_localidad
+        else:
+            localidad, cod_localidad = None, -1
+        cluster = f"{prefijo}_CL{sitio // SITIOS_POR_CLUSTER:03d}"
+        bandas = ["B4", "B28"] if rng.random() < 0.5 else ["B4"]
+        for banda in bandas:
+            for sector in BANDAS[banda][1]:
+                filas.append((nombre_sitio, banda, sector, lat_sitio, lon_sitio, cluster, cluster, localidad, cod_localidad,
+                              mpio, dane_code, dpto, nombre_dpto, regional, "WOM 4G"))
+    return pd.DataFrame(filas[:n_celdas], columns=[nombre for nombre, _ in COLUMNAS_DIM])
+
+def nombres_reporte(celdas):
+    # Nombre de nodo y de celda tal como aparecen en el CSV del gestor
+    banda = np.where(celdas["dwh_banda"] == "B4", "AWS", celdas["dwh_banda"])
+    return celdas["dwh_cell_name_wom"].to_numpy(), celdas["dwh_cell_name_wom"] + "_" + banda + "_" + celdas["dwh_sector"].astype(str)
+
+def contadores_dia(celdas, dia, rng, prob_nil=0.001):
+    # DataFrame con las 24 horas de cada celda. Los usuarios siguen un perfil diario con pico en la noche y el
+    # resto de contadores se deriva de ellos para que PRB, tráfico y experiencia de usuario sean coherentes
+    n = len(celdas)
+    horas = np.arange(24)
+    perfil = 0.15 + 0.85 * np.exp(-((horas - 20) ** 2) / 18) + 0.45 * np.exp(-((horas - 12) ** 2) / 10)
+    carga = rng.lognormal(mean=1.3, sigma=0.6, size=n) # Usuarios activos promedio de cada celda en su hora pico
+
+    usuarios = np.outer(carga, perfil).ravel() * rng.uniform(0.85, 1.15, n * 24)
+    prb_disponibles = np.repeat(celdas["dwh_banda"].map(lambda b: BANDAS[b][0]).to_numpy(), 24)
+    prb_usados = prb_disponibles * usuarios / (usuarios + 6) * rng.uniform(0.8, 1.1, n * 24)
+    prb_usados = np.minimum(prb_usados, prb_disponibles)
+    throughput = rng.uniform(4, 25, n * 24) # Mbps por usuario
+    bits_dl = np.round(usuarios * throughput * 1e6 * 3600 * 0.3) # Cada usuario activo descarga ~30% de la hora
+    bits_ultimo_tti = np.round(bits_dl * rng.uniform(0.02, 0.08, n * 24))
+    tiempo_ms = np.round((bits_dl - bits_ultimo_tti) / (throughput * 1024)) + 1
+
+    nodos, nombres = nombres_reporte(celdas)
+    df = pd.DataFrame({
+        "Date": dia.strftime("%Y-%m-%d"),
+        "Time": np.tile([f"{h:02d}:00" for h in horas], n),
+        "Granularity": 60,
+        "eNodeB Name": np.repeat(nodos, 24),
+        "Cell Name": np.repeat(nombres.to_numpy(), 24),
+        "LocalCell Id": np.repeat(celdas["dwh_sector"].to_numpy() - 1, 24),
+        "Integrity": "100%",
+        "L.Traffic.ActiveUser.DL.Avg": np.round(usuarios, 2),
+        "L.Traffic.ActiveUser.DL.Max": np.ceil(usuarios * rng.uniform(1.5, 3, n * 24)).astype(np.int64),
+        "L.Traffic.ActiveUser.UL.Avg": np.round(usuarios * 0.6, 2),
+        "L.Traffic.ActiveUser.UL.Max": np.ceil(usuarios * rng.uniform(1, 2, n * 24)).astype(np.int64),
+        "L.Traffic.User.Avg": np.round(usuarios * 4, 2),
+        "L.Traffic.User.Max": np.ceil(usuarios * rng.uniform(6, 8, n * 24)).astype(np.int64),
+        "L.ChMeas.PRB.DL.Avail": prb_disponibles,
+        "L.ChMeas.PRB.DL.Used.Avg": np.round(prb_usados, 2),
+        "L.ChMeas.PRB.UL.Avail": prb_disponibles,
+        "L.ChMeas.PRB.UL.Used.Avg": np.round(prb_usados * 0.4, 2),
+        "L.Thrp.bits.DL(bit)": bits_dl.astype(np.int64),
+        "L.Thrp.bits.UL(bit)": np.round(bits_dl * 0.12).astype(np.int64),
+        "L.Thrp.bits.DL.LastTTI(bit)": bits_ultimo_tti.astype(np.int64),
+        "L.Thrp.Time.DL.RmvLastTTI(ms)": tiempo_ms.astype(np.int64),
+    }, columns=COLUMNAS_CSV)
+
+    # El gestor reporta "NIL" cuando un contador no se pudo medir
+    for contador in CONTADORES:
+        nil = rng.random(len(df)) < prob_nil
+        if nil.any():
+            df[contador] = df[contador].astype(object)
+            df.loc[nil, contador] = "NIL"
+    return df
+
+def exportar_dia(celdas, dia, carpeta, semilla=0, prob_nil=0.001, horas=None):
+    # Escribe el ZIP del día con el CSV en formato del gestor. La fecha de modificación del ZIP es la mañana
+    # siguiente al día, como la entrega del FTP, porque el ETL descomprime el ZIP más reciente. Con horas se exporta
+    # solo esa parte del día, como las entregas parciales que carga el DAG de microlotes
+    rng = np.random.default_rng([semilla, dia.toordinal()]) # Cada día tiene su propia secuencia reproducible
+    df = contadores_dia(celdas, dia, rng, prob_nil)
+    horas = list(range(24)) if horas is None else sorted(horas)
+    if len(horas) < 24:
+        df = df[df["Time"].isin([f"{h:02d}:00" for h in horas])]
+
+    texto = io.StringIO()
+    texto.write("Report Name: LTE Cell Hourly\n")
+    texto.write("Granularity Period: 60 Minutes\n")
+    texto.write(f"Start Time: {dia:%Y-%m-%d} {horas[0]:02d}:00\n")
+    texto.write(f"End Time: {dia:%Y-%m-%d} {horas[-1]:02d}:00\n")
+    texto.write("Object Type: Cell\n")
+    texto.write("\n")
+    df.to_csv(texto, index=False)
+    texto.write(f"Total records: {len(df)}\n")
+
+    os.makedirs(carpeta, exist_ok=True)
+    nombre = f"LTE_Cell_Hourly_{dia:%Y%m%d}" + (f"_{horas[0]:02d}{horas[-1]:02d}" if len(horas) < 24 else "")
+    ruta_zip = os.path.join(carpeta, f"{nombre}.zip")
+    with zipfile.ZipFile(ruta_zip, "w", compression=zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr(f"{nombre}.csv", texto.getvalue())
+    entrega = datetime.combine(dia + timedelta(days=1), datetime.min.time()).replace(hour=6).timestamp()
+    os.utime(ruta_zip, (entrega, entrega))
+    return ruta_zip, len(df)
+
+def cargar_celdas(conn, celdas):
+    # Crea (o reemplaza) bodega_analitica.roaming_cell_dim con el inventario sintético
+    cur = conn.cursor()
+    cur.execute("CREATE SCHEMA IF NOT EXISTS bodega_analitica")
+    cur.execute("DROP TABLE IF EXISTS bodega_analitica.roaming_cell_dim")
+    cur.execute("CREATE TABLE bodega_analitica.roaming_cell_dim ({})".format(
+        ", ".join(f"{nombre} {tipo}" for nombre, tipo in COLUMNAS_DIM)))
+    buffer = io.StringIO()
+    celdas.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert("COPY bodega_analitica.roaming_cell_dim FROM STDIN WITH CSV", buffer)
+    conn.commit()
+    cur.close()
+
+def dias_sinteticos(n_dias, ultimo=None):
+    # Los días terminan ayer por defecto, así equilibrar() del ETL no borra los datos recién cargados
+    ultimo = ultimo or date.today() - timedelta(days=1)
+    return [ultimo - timedelta(days=i) for i in range(n_dias - 1, -1, -1)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera exportes RAN sintéticos y la tabla de ubicación de celdas")
+    parser.add_argument("--celdas", type=int, default=2000)
+    parser.add_argument("--dias", type=int, default=1)
+    parser.add_argument("--ultimo-dia", type=date.fromisoformat, default=None)
+    parser.add_argument("--carpeta", required=True, help="Carpeta donde se escriben los ZIP (la del FTP para el ETL)")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--prob-nil", type=float, default=0.001)
+    parser.add_argument("--dsn", help="Base de datos donde crear bodega_analitica.roaming_cell_dim")
+    args = parser.parse_args()
+
+    celdas = generar_celdas(args.celdas, args.semilla)
+    for dia in dias_sinteticos(args.dias, args.ultimo_dia):
+        ruta_zip, filas = exportar_dia(celdas, dia, args.carpeta, args.semilla, args.prob_nil)
+        print(f"{ruta_zip}: {filas} filas")
+
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn)
+        try:
+            cargar_celdas(conn, celdas)
+        finally:
+            conn.close()
+        print(f"roaming_cell_dim cargada con {len(celdas)} celdas")
+
+if __name__ == "__main__":
+    main()
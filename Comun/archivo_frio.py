@@ -0,0 +1,44 @@
+# Archivo frío en Parquet de los datos que equilibrar() borra de PostgreSQL al pasar la retención de cada tabla.
+# Antes de borrar, el ETL exporta las filas por hora de cada día a {DASHWOM_ARCHIVO}/{tabla}/{AAAA-MM-DD}.parquet
+# (zstd, ordenadas por entidad), con la misma organización que el histórico local; las celdas se archivan por hora
+# aunque en la base estén empaquetadas. El dashboard une el archivo con PostgreSQL cuando el rango pedido empieza
+# antes de la retención: DuckDB lee solo los días del rango y, por el orden por entidad, solo los grupos de filas de
+# la selección. Opcional como el histórico local: sin la variable, o sin pyarrow/duckdb, equilibrar borra como antes
+import os
+from datetime import timedelta
+
+import historico_local # Escritura y lectura de Parquet por tabla y día
+
+#----------- Constantes -----------#
+RAIZ = os.environ.get("DASHWOM_ARCHIVO") # Carpeta del archivo; a diferencia del histórico local no se recorta nunca
+
+
+
+#---------- Funciones ----------#
+def escritura_habilitada():
+    return RAIZ is not None and historico_local.pyarrow is not None
+
+def lectura_habilitada():
+    return RAIZ is not None and historico_local.duckdb is not None
+
+def archivado(tabla, dia):
+    return os.path.exists(historico_local.ruta_dia(tabla, dia, RAIZ))
+
+def archivar(tabla, df, orden=None):
+    # Filas por hora de uno o varios días, con "Timestamp" datetime64
+    return historico_local.escribir(tabla, df, orden, RAIZ)
+
+def partir(tabla, inicio, fin):
+    # Divide el rango en la parte archivada y la que sigue en PostgreSQL. Como un día se archiva justo antes de borrarlo,
+    # todo lo anterior al último día archivado del rango se lee del archivo y lo posterior de la base. Devuelve los
+    # archivos y la fecha desde la que se consulta PostgreSQL (None si el rango completo está archivado)
+    inicio, fin = historico_local.como_fecha(inicio), historico_local.como_fecha(fin)
+    if not lectura_habilitada():
+        return [], inicio
+    dias = [inicio + timedelta(days=i) for i in range((fin - inicio).days + 1)]
+    archivados = [dia for dia in dias if archivado(tabla, dia)]
+    if not archivados:
+        return [], inicio
+    corte = archivados[-1]
+    rutas = [historico_local.ruta_dia(tabla, dia, RAIZ) for dia in archivados]
+    return rutas, (corte + timedelta(days=1) if corte < fin else None)
@@ -0,0 +1,73 @@
+# Formato empaquetado de los contadores horarios, compartido por el ETL (Airflow/Tasks_daily.py) y el dashboard
+# (App/consultas.py). En lugar de una fila por entidad y hora, cada (entidad, día) es una fila con un arreglo de 24
+# posiciones por contador: la posición 1 es la hora 00 y una hora sin datos queda en NULL. Así el encabezado de fila de
+# PostgreSQL, el nombre, la fecha y las entradas de índice se guardan una vez por día y no 24 veces.
+# empaquetar() arma las filas para el COPY y desempaquetar() devuelve las filas por hora con las mismas columnas que
+# leen las gráficas, así el resto del dashboard no cambia
+import io
+
+import numpy as np
+import pandas as pd
+
+import kpis_ran
+
+#----------- Constantes -----------#
+HORAS_DIA = 24
+NULO_SQL = "NULL" # Elemento nulo dentro de un literal de arreglo de PostgreSQL
+
+
+
+#---------- Funciones ----------#
+def _literales(matriz):
+    # Una fila de la matriz de texto (entidad x hora) por literal de arreglo de PostgreSQL: "{1,2,NULL,...}"
+    return ["{" + ",".join(fila) + "}" for fila in matriz.tolist()]
+
+def empaquetar(df, claves, contadores):
+    # df por hora con "Timestamp" (datetime64) -> una fila por claves[0] y día con "Date", claves y un literal de arreglo
+    # por contador. Los contadores se leen como texto (dtype=str), tal como vienen del CSV o del COPY: así no se vuelven
+    # a formatear números, que es lo más lento, y los enteros no ganan un ".0" que SMALLINT[]/BIGINT[] no aceptan.
+    # Las demás claves (p. ej. el nodo de la celda) se toman de la primera hora del día; una hora repetida deja el último valor
+    timestamps = df["Timestamp"].to_numpy(dtype="datetime64[ns]")
+    fechas = timestamps.astype("datetime64[D]")
+    horas = ((timestamps - fechas) // np.timedelta64(1, "h")).astype(np.int64)
+
+    codigos = kpis_ran.codigos_grupo(fechas, df[claves[0]])
+    validas = np.flatnonzero(codigos >= 0)
+    grupos, primeras, filas = np.unique(codigos[validas], return_index=True, return_inverse=True)
+    primeras = validas[primeras]
+
+    resultado = {"Date": pd.Series(fechas[primeras]).dt.strftime("%Y-%m-%d").to_numpy()}
+    for clave in claves:
+        resultado[clave] = df[clave].to_numpy()[primeras]
+    vacia = np.full((len(grupos), HORAS_DIA), NULO_SQL, dtype=object)
+    for contador in contadores:
+        matriz = vacia.copy()
+        matriz[filas, horas[validas]] = df[contador].fillna(NULO_SQL).to_numpy(dtype=object)[validas]
+        resultado[contador] = _literales(matriz)
+    return pd.DataFrame(resultado, columns=["Date"] + list(claves) + list(contadores))
+
+def _matriz(literales):
+    # Literales de arreglo (texto "{...}" como los escribe PostgreSQL) -> matriz float64 entidad x hora, leída con el
+    # parser en C de pandas. Un arreglo NULL se toma como el día completo sin datos
+    vacio = "{" + ",".join([NULO_SQL] * HORAS_DIA) + "}"
+    texto = "\n".join(literales.fillna(vacio).str.slice(1, -1))
+    return pd.read_csv(io.StringIO(texto), header=None, names=range(HORAS_DIA), na_values=[NULO_SQL],
+                       keep_default_na=False, dtype=np.float64).to_numpy()
+
+def desempaquetar(df, claves, contadores):
+    # Filas de la tabla empaquetada ("Date", claves, un arreglo por contador) -> una fila por entidad y hora con
+    # "Timestamp", claves y contadores. Las horas en que todos los contadores son nulos no existían en el reporte y se quitan
+    columnas = ["Timestamp"] + list(claves) + list(contadores)
+    if df.empty:
+        return pd.DataFrame(columns=columnas)
+
+    fechas = kpis_ran.timestamps_unicos(df["Date"], "%Y-%m-%d")
+    resultado = {"Timestamp": np.repeat(fechas, HORAS_DIA) + np.tile(np.arange(HORAS_DIA).astype("timedelta64[h]"), len(df))}
+    for clave in claves:
+        resultado[clave] = np.repeat(df[clave].to_numpy(), HORAS_DIA)
+    for contador in contadores:
+        resultado[contador] = _matriz(df[contador]).ravel()
+
+    df_horas = pd.DataFrame(resultado, columns=columnas)
+    existentes = df_horas[list(contadores)].notna().any(axis=1).to_numpy()
+    return df_horas[existentes].reset_index(drop=True)
@@ -0,0 +1,138 @@
+# Estados combinables de los KPIs de las celdas, compartidos por el ETL (Airflow/Tasks_daily.py) y el dashboard
+# (App/Dashboard_BD.py). Las tablas por hora de cada agregación suman los contadores de sus celdas, lo que da el KPI de
+# la entidad pero no cómo se reparte entre sus celdas. Aquí cada entidad y día guarda, para la ocupación de PRBs y la
+# experiencia de usuario de sus celdas-hora, la suma, el máximo y un histograma de conteos con límites fijos. Los tres
+# se combinan sin perder información (suma con suma, máximo con máximo, histograma posición a posición), así un nivel
+# se arma desde los estados de sus nodos y una semana o un mes desde los de sus días, sin volver a leer las celdas por
+# hora. La cantidad de celdas-hora es el total del histograma y el percentil sale de su acumulado, con un error
+# acotado por el ancho del intervalo
+import io
+
+import numpy as np
+import pandas as pd
+
+import kpis_ran
+
+#----------- Constantes -----------#
+TABLA = "ran_1d_estados" # Una fila por nivel, entidad y día
+# Límites de los intervalos de cada histograma; los valores por fuera cuentan en el primer o el último intervalo.
+# La experiencia de usuario no tiene techo, por eso su último intervalo es abierto (de 1000 Mbps a infinito) y los
+# valores altos no se recortan al último intervalo con límite
+LIMITES = {
+    "prb": np.linspace(0, 100, 101), # % de ocupación de PRBs en downlink, intervalos de 1 punto
+    "uexp": np.append(np.geomspace(0.1, 1000, 97), np.inf) # Experiencia de usuario en Mbps, 24 intervalos por década (~10 % de ancho)
+}
+PERCENTIL = 0.95
+# Columnas de la tabla, en el orden del COPY. Los histogramas se guardan como INTEGER[]
+COLUMNAS_TABLA = ["Date", "nivel", "nombre"] + [columna for kpi in LIMITES for columna in (f"{kpi}_suma", f"{kpi}_max", f"hist_{kpi}")]
+
+
+
+#---------- Funciones ----------#
+def columnas_histograma(kpi):
+    # En forma ancha cada intervalo del histograma es una columna, así pandas los combina con groupby().sum()
+    return [f"{kpi}_{i}" for i in range(len(LIMITES[kpi]) - 1)]
+
+def valores_celda(df):
+    # KPIs de cada fila de celdas por hora, con las mismas fórmulas que las gráficas
+    return {
+        "prb": kpis_ran.uso_prb(df["L.ChMeas.PRB.DL.Used.Avg"], df["L.ChMeas.PRB.DL.Avail"]),
+        "uexp": kpis_ran.experiencia_usuario(df["L.Thrp.bits.DL(bit)"], df["L.Thrp.bits.DL.LastTTI(bit)"], df["L.Thrp.Time.DL.RmvLastTTI(ms)"])
+    }
+
+def estados(df, claves):
+    # Filas de celdas por hora (contadores y claves, p. ej. "Date" y el nombre de la entidad) -> un estado por
+    # combinación de claves en forma ancha. Solo cuentan los valores finitos: sin PRBs disponibles o sin tiempo de
+    # transmisión la celda-hora no tiene KPI. Las filas con alguna clave nula no pertenecen a ninguna entidad, como en groupby
+    codigos = kpis_ran.codigos_grupo(*[df[clave] for clave in claves])
+    validas = np.flatnonzero(codigos >= 0)
+    grupos, primeras, filas = np.unique(codigos[validas], return_index=True, return_inverse=True)
+    n = len(grupos)
+
+    partes = [pd.DataFrame({clave: df[clave].to_numpy()[validas[primeras]] for clave in claves})]
+    for kpi, valores in valores_celda(df).items():
+        valores = valores[validas]
+        finitos = np.isfinite(valores)
+        fila, valor = filas[finitos], valores[finitos]
+        maximo = np.full(n, np.nan)
+        np.fmax.at(maximo, fila, valor)
+
+        limites = LIMITES[kpi]
+        intervalos = len(limites) - 1
+        intervalo = np.clip(np.searchsorted(limites, valor, side="right") - 1, 0, intervalos - 1)
+        conteos = np.bincount(fila * intervalos + intervalo, minlength=n * intervalos).reshape(n, intervalos)
+        partes.append(pd.DataFrame({f"{kpi}_suma": np.bincount(fila, weights=valor, minlength=n), f"{kpi}_max": maximo}))
+        partes.append(pd.DataFrame(conteos, columns=columnas_histograma(kpi)))
+    return pd.concat(partes, axis=1)
+
+def agregaciones(columnas):
+    # Cómo se combina cada columna de estado: los máximos con máximo y el resto (sumas e histogramas) con suma
+    prefijos = tuple(f"{kpi}_" for kpi in LIMITES)
+    return {columna: ("max" if columna.endswith("_max") else "sum") for columna in columnas if columna.startswith(prefijos)}
+
+def combinar(df, claves):
+    # Estados en forma ancha -> un estado por combinación de claves (un nivel superior o un periodo más largo). Sumas
+    # y máximos se calculan en dos llamados en lugar de un agg por columna, que con cientos de columnas es lento
+    funciones = agregaciones(df.columns)
+    grupos = df.groupby(claves, sort=True)
+    sumas = grupos[[columna for columna, funcion in funciones.items() if funcion == "sum"]].sum()
+    maximos = grupos[[columna for columna, funcion in funciones.items() if funcion == "max"]].max()
+    return pd.concat([sumas, maximos], axis=1)[list(funciones)].reset_index()
+
+def a_tabla(df, nivel, clave):
+    # Estados en forma ancha con "Date" -> filas de la tabla para el COPY, con cada histograma como literal de arreglo
+    # "{...}". clave es la columna con el nombre de la entidad (None para el total de la red)
+    resultado = {
+        "Date": pd.Series(df["Date"]).dt.strftime("%Y-%m-%d").to_numpy(),
+        "nivel": nivel,
+        "nombre": "total" if clave is None else df[clave].astype(str).to_numpy()
+    }
+    for kpi in LIMITES:
+        resultado[f"{kpi}_suma"] = df[f"{kpi}_suma"].to_numpy()
+        resultado[f"{kpi}_max"] = df[f"{kpi}_max"].to_numpy()
+        texto = df[columnas_histograma(kpi)].to_numpy(dtype=np.int64).astype(str)
+        resultado[f"hist_{kpi}"] = ["{" + ",".join(fila) + "}" for fila in texto.tolist()]
+    return pd.DataFrame(resultado, columns=COLUMNAS_TABLA)
+
+def de_tabla(df):
+    # Filas leídas de la tabla (histogramas como texto "{...}", así los escribe el COPY) -> forma ancha
+    df = df.reset_index(drop=True)
+    partes = [df.drop(columns=[f"hist_{kpi}" for kpi in LIMITES])]
+    for kpi in LIMITES:
+        if df.empty:
+            partes.append(pd.DataFrame(columns=columnas_histograma(kpi), dtype=np.int64))
+            continue
+        # Las filas guardadas antes de agregar un intervalo al final traen menos posiciones: las que faltan son 0
+        texto = "\n".join(df[f"hist_{kpi}"].str.slice(1, -1))
+        conteos = pd.read_csv(io.StringIO(texto), header=None, names=columnas_histograma(kpi), dtype=np.float64)
+        partes.append(conteos.fillna(0).astype(np.int64))
+    return pd.concat(partes, axis=1)
+
+def cuenta(df, kpi):
+    # Celdas-hora con valor
+    return df[columnas_histograma(kpi)].to_numpy(dtype=np.float64).sum(axis=1)
+
+def promedio(df, kpi):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return df[f"{kpi}_suma"].to_numpy(dtype=np.float64) / cuenta(df, kpi)
+
+def percentil(df, kpi, q=PERCENTIL):
+    # Percentil aproximado de cada estado: se busca el intervalo donde el acumulado llega a q del total y se interpola
+    # linealmente dentro de él. Nunca pasa del máximo, que es exacto. En el intervalo abierto del final se interpola
+    # entre su límite inferior y el máximo. Un estado sin celdas-hora queda en NaN
+    conteos = df[columnas_histograma(kpi)].to_numpy(dtype=np.float64)
+    limites = LIMITES[kpi]
+    maximo = df[f"{kpi}_max"].to_numpy(dtype=np.float64)
+    acumulado = np.cumsum(conteos, axis=1)
+    objetivo = q * acumulado[:, -1]
+    filas = np.arange(len(conteos))
+    intervalo = np.argmax(acumulado >= objetivo[:, None], axis=1) # Primer intervalo que alcanza el objetivo
+    anterior = acumulado[filas, intervalo] - conteos[filas, intervalo]
+    inferior = limites[intervalo]
+    superior = np.where(np.isinf(limites[intervalo + 1]), np.fmax(maximo, inferior), limites[intervalo + 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraccion = (objetivo - anterior) / conteos[filas, intervalo]
+    valor = inferior + fraccion * (superior - inferior)
+    valor = np.fmin(valor, maximo)
+    valor[acumulado[:, -1] == 0] = np.nan
+    return valor
@@ -0,0 +1,116 @@
+# Histórico local en Parquet para las consultas de recorrido del dashboard (tendencias de varios meses, mapa nacional
+# de celdas). El ETL escribe, junto con la carga a PostgreSQL, un archivo por tabla horaria y día en
+# {DASHWOM_HISTORICO}/{tabla}/{AAAA-MM-DD}.parquet, y el dashboard lo consulta con DuckDB embebido, que lee solo las
+# columnas y los días pedidos y ejecuta vectorizado en varios hilos, sin idas a la base de datos.
+# Es opcional: sin la variable DASHWOM_HISTORICO, o sin duckdb (lectura) o pyarrow (escritura) instalados, todo sigue
+# yendo a PostgreSQL. La carpeta tiene que ser visible para el worker de Airflow y para el dashboard (mismo servidor o volumen compartido)
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    import pyarrow # Motor de pandas para escribir Parquet
+except ImportError:
+    pyarrow = None
+
+#----------- Constantes -----------#
+RAIZ = os.environ.get("DASHWOM_HISTORICO") # Carpeta del histórico; sin ella no se usa
+HILOS = int(os.environ.get("DASHWOM_HILOS_HISTORICO", os.cpu_count() or 1)) # Hilos de DuckDB por consulta
+DIAS_RECORRIDO = int(os.environ.get("DASHWOM_DIAS_RECORRIDO", 14)) # Desde cuántos días una consulta de una selección se considera de recorrido
+RETENCION_DIAS = int(os.environ.get("DASHWOM_RETENCION_HISTORICO", 730)) # El disco local no tiene el límite de 20 GB por tabla de la base
+
+_local = threading.local() # Una conexión de DuckDB por hilo, las conexiones no se comparten entre hilos
+
+
+
+#---------- Funciones ----------#
+def escritura_habilitada():
+    return RAIZ is not None and pyarrow is not None
+
+def lectura_habilitada():
+    return RAIZ is not None and duckdb is not None
+
+def identificador(nombre):
+    # Nombre de columna citado para DuckDB ("L.Thrp.bits.DL(bit)" tiene puntos y paréntesis)
+    return '"' + nombre.replace('"', '""') + '"'
+
+def como_fecha(valor):
+    # Las fechas llegan como date, datetime o texto "AAAA-MM-DD" (DatePickerRange del dashboard)
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    return date.fromisoformat(str(valor)[:10])
+
+def ruta_dia(tabla, dia, raiz=None):
+    # raiz permite usar la misma organización en otra carpeta (el archivo frío de Comun/archivo_frio.py)
+    return os.path.join(raiz or RAIZ, tabla, f"{dia:%Y-%m-%d}.parquet")
+
+def escribir(tabla, df, orden=None, raiz=None):
+    # Guarda las filas por hora de la tabla ("Timestamp" datetime64) con un archivo por día. Si el día ya existe se
+    # reemplazan las filas con la misma hora y nombre (orden) y se conservan las demás: los microlotes del ETL escriben
+    # unas horas a la vez y volver a correr la carga diaria no duplica filas. Ordenar por nombre hace que el mínimo y
+    # máximo de cada grupo de filas del Parquet descarten la mayoría al filtrar una selección. Devuelve los días escritos
+    os.makedirs(os.path.join(raiz or RAIZ, tabla), exist_ok=True)
+    llaves = ["Timestamp"] + ([orden] if orden is not None else [])
+    dias = []
+    for dia, bloque in df.groupby(df["Timestamp"].dt.normalize(), sort=True):
+        ruta = ruta_dia(tabla, dia, raiz)
+        if os.path.exists(ruta):
+            anterior = pd.read_parquet(ruta)
+            anterior["Timestamp"] = anterior["Timestamp"].astype("datetime64[ns]")
+            nuevas = pd.MultiIndex.from_frame(bloque[llaves])
+            anterior = anterior[~pd.MultiIndex.from_frame(anterior[llaves]).isin(nuevas)]
+            if not anterior.empty:
+                bloque = pd.concat([anterior, bloque], ignore_index=True)
+        if orden is not None:
+            bloque = bloque.sort_values([orden, "Timestamp"], kind="stable")
+        temporal = ruta + ".parcial" # No coincide con *.parquet, el dashboard nunca ve un archivo a medio escribir
+        bloque.to_parquet(temporal, index=False, compression="zstd")
+        os.replace(temporal, ruta)
+        dias.append(dia.date())
+    return dias
+
+def recortar(tabla, dias):
+    # Borra los días anteriores a la retención, como equilibrar() en la base de datos
+    carpeta = os.path.join(RAIZ, tabla)
+    if not os.path.isdir(carpeta):
+        return 0
+    corte = f"{datetime.now().date() - timedelta(days=dias):%Y-%m-%d}.parquet"
+    viejos = [archivo for archivo in os.listdir(carpeta) if archivo.endswith(".parquet") and archivo < corte]
+    for archivo in viejos:
+        os.remove(os.path.join(carpeta, archivo))
+    return len(viejos)
+
+def archivos(tabla, inicio, fin):
+    # Archivos de los días del rango, o None si falta alguno (la consulta tiene que ir a PostgreSQL)
+    inicio, fin = como_fecha(inicio), como_fecha(fin)
+    rutas = [ruta_dia(tabla, inicio + timedelta(days=i)) for i in range((fin - inicio).days + 1)]
+    if not rutas or not all(os.path.exists(ruta) for ruta in rutas):
+        return None
+    return rutas
+
+def _conexion():
+    if getattr(_local, "conexion", None) is None:
+        _local.conexion = duckdb.connect() # Base en memoria, los datos se leen directo de los Parquet
+        _local.conexion.execute(f"SET threads = {HILOS}")
+    return _local.conexion
+
+def consultar(rutas, expresiones, filtro=None, params=()):
+    # SELECT de las expresiones sobre los archivos indicados, con un filtro opcional (SQL de DuckDB con ? para params).
+    # union_by_name porque un día con nulos puede haber guardado un contador entero como float
+    lista = ", ".join("'" + ruta.replace("'", "''") + "'" for ruta in rutas)
+    consulta = f"SELECT {', '.join(expresiones)} FROM read_parquet([{lista}], union_by_name = true)"
+    if filtro is not None:
+        consulta += f" WHERE {filtro}"
+    df = _conexion().execute(consulta, list(params)).df()
+    if "Timestamp" in df.columns:
+        df["Timestamp"] = df["Timestamp"].astype("datetime64[ns]") # Misma resolución que devuelve consulta_columnar
+    return df
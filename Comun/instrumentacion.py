@@ -0,0 +1,200 @@
+# Instrumentación de las etapas del ETL (Airflow/Tasks_daily.py) y de los callbacks del dashboard (App/Dashboard_BD.py).
+# Cada etapa se envuelve con medir(), como decorador o con "with", y al terminar deja una línea JSON en el log con el
+# tiempo total, el tiempo dentro de la base de datos (bloques tiempo_sql()), el resto que es tiempo de pandas/Python,
+# las filas y bytes anotados con anotar() y el pico de memoria. Los acumulados por etapa se pueden exportar en el
+# formato de texto de Prometheus con exportar_prometheus()
+import os
+import json
+import time
+import threading
+import functools
+import tracemalloc
+
+try:
+    import resource # Solo existe en Unix, en Windows no se reporta RSS
+except ImportError:
+    resource = None
+
+#----------- Constantes -----------#
+PERFIL_MEMORIA = os.environ.get("DASHWOM_PERFIL_MEMORIA") == "1" # tracemalloc da el pico por etapa pero hace más lento el código
+BUCKETS_SEGUNDOS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900) # Límites del histograma de duración
+PREFIJO_ALMACEN = "metricas:"
+
+_local = threading.local() # Pila de etapas en curso de cada hilo
+_bloqueo = threading.Lock()
+_acumulados = {} # Acumulados por etapa cuando no hay almacén compartido
+_almacen = None
+
+
+
+#---------- Funciones ----------#
+def configurar_almacen(almacen):
+    # Guarda los acumulados en un almacén compartido entre procesos (un diskcache.Cache), así los callbacks que corren
+    # en procesos de trabajos en segundo plano también aparecen en /metrics del dashboard
+    global _almacen
+    _almacen = almacen
+
+def _pila():
+    if not hasattr(_local, "pila"):
+        _local.pila = []
+    return _local.pila
+
+def anotar(filas=0, bytes_leidos=0, bytes_escritos=0):
+    # Suma filas y bytes a las etapas en curso; una etapa incluye lo que procesan las etapas que llama
+    for medicion in _pila():
+        medicion.filas += filas
+        medicion.bytes_leidos += bytes_leidos
+        medicion.bytes_escritos += bytes_escritos
+
+class tiempo_sql:
+    # Bloque que se cuenta como tiempo en la base de datos para las etapas en curso. Anidado cuenta una sola vez
+    def __enter__(self):
+        self.externo = not getattr(_local, "en_sql", False)
+        _local.en_sql = True
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.externo:
+            duracion = time.perf_counter() - self.inicio
+            _local.en_sql = False
+            for medicion in _pila():
+                medicion.segundos_sql += duracion
+                medicion.consultas += 1
+        return False
+
+class medir:
+    # Mide una etapa. Como decorador cada llamada crea su propia medición, así es seguro entre hilos
+    def __init__(self, etapa):
+        self.etapa = etapa
+
+    def __call__(self, funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with medir(self.etapa):
+                return funcion(*args, **kwargs)
+        return envoltura
+
+    def __enter__(self):
+        pila = _pila()
+        self.filas = 0
+        self.bytes_leidos = 0
+        self.bytes_escritos = 0
+        self.segundos_sql = 0.0
+        self.consultas = 0
+        self.inicio_tracemalloc = False
+        if PERFIL_MEMORIA and not pila: # El pico se reinicia solo en la etapa externa, las internas reportan el pico hasta ese momento
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.inicio_tracemalloc = True
+            tracemalloc.reset_peak()
+        pila.append(self)
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        segundos = time.perf_counter() - self.inicio
+        _pila().remove(self)
+
+        if PERFIL_MEMORIA and tracemalloc.is_tracing():
+            memoria_pico = tracemalloc.get_traced_memory()[1]
+            if self.inicio_tracemalloc:
+                tracemalloc.stop()
+        elif resource is not None:
+            memoria_pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Pico de RSS del proceso, en Linux viene en KB
+        else:
+            memoria_pico = None
+
+        registro = {
+            "etapa": self.etapa,
+            "estado": "error" if tipo is not None else "ok",
+            "segundos": round(segundos, 6),
+            "segundos_sql": round(self.segundos_sql, 6),
+            "segundos_python": round(max(segundos - self.segundos_sql, 0.0), 6),
+            "consultas": self.consultas,
+            "filas": self.filas,
+            "bytes_leidos": self.bytes_leidos,
+            "bytes_escritos": self.bytes_escritos,
+            "memoria_pico_bytes": memoria_pico,
+            "pid": os.getpid(),
+        }
+        print(json.dumps({"metrica": "etapa", **registro}), flush=True)
+
+        try:
+            _registrar(registro)
+        except Exception as e: # La instrumentación nunca debe tumbar la etapa que mide
+            print(f"Error registrando métricas de {self.etapa}: {e}")
+        return False
+
+def _acumular(acumulado, registro):
+    if acumulado is None:
+        acumulado = {"llamadas": 0, "errores": 0, "segundos": 0.0, "segundos_sql": 0.0, "consultas": 0, "filas": 0, "bytes_leidos": 0,
+                     "bytes_escritos": 0, "memoria_pico_bytes": 0, "buckets": [0] * len(BUCKETS_SEGUNDOS)}
+    acumulado["llamadas"] += 1
+    acumulado["errores"] += registro["estado"] == "error"
+    for campo in ("segundos", "segundos_sql", "consultas", "filas", "bytes_leidos", "bytes_escritos"):
+        acumulado[campo] = acumulado.get(campo, 0) + registro[campo] # get: acumulados guardados antes de agregar un campo
+    acumulado["memoria_pico_bytes"] = max(acumulado["memoria_pico_bytes"], registro["memoria_pico_bytes"] or 0)
+    for i, limite in enumerate(BUCKETS_SEGUNDOS):
+        if registro["segundos"] <= limite:
+            acumulado["buckets"][i] += 1
+    return acumulado
+
+def _registrar(registro):
+    etapa = registro["etapa"]
+    if _almacen is None:
+        with _bloqueo:
+            _acumulados[etapa] = _acumular(_acumulados.get(etapa), registro)
+        return
+
+    with _almacen.transact(): # Transacción del almacén, otros procesos pueden estar registrando a la vez
+        etapas = _almacen.get(PREFIJO_ALMACEN + "etapas", default=set())
+        if etapa not in etapas:
+            _almacen.set(PREFIJO_ALMACEN + "etapas", etapas | {etapa})
+        _almacen.set(PREFIJO_ALMACEN + etapa, _acumular(_almacen.get(PREFIJO_ALMACEN + etapa, default=None), registro))
+
+def acumulados():
+    # Copia de los acumulados por etapa
+    if _almacen is None:
+        with _bloqueo:
+            return {etapa: dict(valores) for etapa, valores in _acumulados.items()}
+    etapas = _almacen.get(PREFIJO_ALMACEN + "etapas", default=set())
+    resultado = {etapa: _almacen.get(PREFIJO_ALMACEN + etapa, default=None) for etapa in etapas}
+    return {etapa: valores for etapa, valores in resultado.items() if valores is not None}
+
+def _etiqueta(etapa, **extra):
+    etapa = etapa.replace("\\", "\\\\").replace('"', '\\"')
+    etiquetas = [f'etapa="{etapa}"'] + [f'{nombre}="{valor}"' for nombre, valor in extra.items()]
+    return "{" + ",".join(etiquetas) + "}"
+
+def exportar_prometheus():
+    # Acumulados en el formato de texto de Prometheus (version 0.0.4)
+    datos = sorted(acumulados().items())
+    lineas = []
+
+    lineas += ["# HELP dashwom_etapa_segundos Duración de cada etapa o callback",
+               "# TYPE dashwom_etapa_segundos histogram"]
+    for etapa, valores in datos:
+        for limite, cantidad in zip(BUCKETS_SEGUNDOS, valores["buckets"]):
+            lineas.append(f"dashwom_etapa_segundos_bucket{_etiqueta(etapa, le=limite)} {cantidad}")
+        lineas.append(f"dashwom_etapa_segundos_bucket{_etiqueta(etapa, le='+Inf')} {valores['llamadas']}")
+        lineas.append(f"dashwom_etapa_segundos_sum{_etiqueta(etapa)} {valores['segundos']}")
+        lineas.append(f"dashwom_etapa_segundos_count{_etiqueta(etapa)} {valores['llamadas']}")
+
+    contadores = [
+        ("errores", "errores_total", "Llamadas que terminaron con excepción"),
+        ("segundos_sql", "sql_segundos_total", "Tiempo dentro de la base de datos"),
+        ("consultas", "consultas_total", "Bloques ejecutados en la base de datos"),
+        ("filas", "filas_total", "Filas procesadas"),
+        ("bytes_leidos", "bytes_leidos_total", "Bytes leídos de archivos o de la base de datos"),
+        ("bytes_escritos", "bytes_escritos_total", "Bytes escritos a archivos o a la base de datos"),
+    ]
+    for campo, nombre, ayuda in contadores:
+        lineas += [f"# HELP dashwom_etapa_{nombre} {ayuda}", f"# TYPE dashwom_etapa_{nombre} counter"]
+        lineas += [f"dashwom_etapa_{nombre}{_etiqueta(etapa)} {valores.get(campo, 0)}" for etapa, valores in datos]
+
+    lineas += ["# HELP dashwom_etapa_memoria_pico_bytes Mayor pico de memoria observado en la etapa",
+               "# TYPE dashwom_etapa_memoria_pico_bytes gauge"]
+    lineas += [f"dashwom_etapa_memoria_pico_bytes{_etiqueta(etapa)} {valores['memoria_pico_bytes']}" for etapa, valores in datos]
+
+    return "\n".join(lineas) + "\n"
@@ -0,0 +1,116 @@
+# Núcleo de cálculo de KPIs RAN compartido por el ETL (Airflow/Tasks_daily.py) y el dashboard (App/Dashboard_BD.py).
+# Todas las funciones reciben arreglos de NumPy (o Series de pandas, que se convierten con np.asarray) y devuelven
+# arreglos float64 del mismo largo, o posiciones enteras en el caso de la hora pico (datetime64 en el de los
+# timestamps). No copian DataFrames ni usan .apply, así cualquier mejora o corrección de una fórmula aplica a los dos lados
+import numpy as np
+import pandas as pd
+
+#----------- Constantes -----------#
+BITS_POR_GB = 8 * 10**9 # Conversión de bits a gigabytes (decimal)
+KBITS_POR_MBIT = 1024 # La experiencia de usuario se reporta en Mbps a partir de kbit/ms
+FORMATO_TIMESTAMP = "%Y-%m-%d %H:%M:%S" # Formato con el que el ETL escribe los CSV y PostgreSQL devuelve los TIMESTAMP
+# Contadores horarios que leen las gráficas del dashboard; el ETL los incluye en el índice de cobertura de cada tabla horaria
+CONTADORES_GRAFICAS = ["L.Traffic.ActiveUser.DL.Avg","L.Traffic.ActiveUser.DL.Max","L.ChMeas.PRB.DL.Avail","L.ChMeas.PRB.DL.Used.Avg","L.ChMeas.PRB.UL.Avail","L.ChMeas.PRB.UL.Used.Avg","L.Thrp.bits.DL(bit)","L.Thrp.bits.DL.LastTTI(bit)","L.Thrp.Time.DL.RmvLastTTI(ms)"]
+
+
+
+#---------- Funciones ----------#
+def _dividir(numerador, denominador):
+    # División elemento a elemento con la semántica de pandas: x/0 = inf, 0/0 = NaN, sin advertencias
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.asarray(numerador, dtype=np.float64) / np.asarray(denominador, dtype=np.float64)
+
+def uso_prb(prb_usados, prb_disponibles):
+    # Porcentaje de ocupación de PRBs
+    return _dividir(prb_usados, prb_disponibles) * 100
+
+def bits_a_gb(bits):
+    # Tráfico de bits a GB
+    return np.asarray(bits, dtype=np.float64) / BITS_POR_GB
+
+def experiencia_usuario(bits_dl, bits_ultimo_tti, tiempo_sin_ultimo_tti_ms):
+    # Throughput percibido por el usuario en Mbps, sin el último TTI de cada ráfaga
+    bits = np.asarray(bits_dl, dtype=np.float64) - np.asarray(bits_ultimo_tti, dtype=np.float64)
+    return _dividir(bits, tiempo_sin_ultimo_tti_ms) / KBITS_POR_MBIT
+
+def codigos_grupo(*claves):
+    # Código entero por combinación de claves (p. ej. nombre y día), para agrupar sin pasar por groupby. Como en
+    # groupby, las filas con alguna clave nula no pertenecen a ningún grupo y quedan con código -1
+    codigos = np.zeros(len(claves[0]), dtype=np.int64)
+    nulos = np.zeros(len(claves[0]), dtype=bool)
+    for clave in claves:
+        inverso, unicos = pd.factorize(np.asarray(clave), sort=True) # Códigos en el orden de las claves, como groupby
+        nulos |= inverso < 0
+        codigos = codigos * max(len(unicos), 1) + inverso
+    codigos[nulos] = -1
+    return codigos
+
+def hora_pico(grupos, usuarios):
+    # Posición de la hora pico (BH) de cada grupo: la fila con más usuarios activos. Igual que groupby().idxmax():
+    # los NaN no cuentan y en un empate se toma la primera fila. grupos es un arreglo de enteros (codigos_grupo)
+    # y el resultado viene en el orden de los grupos (el de las claves). Las filas con grupo -1 (clave nula) no se tienen en cuenta
+    grupos = np.asarray(grupos)
+    usuarios = np.asarray(usuarios, dtype=np.float64)
+    posiciones = np.flatnonzero(grupos >= 0)
+    if len(posiciones) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    grupos = grupos[posiciones]
+    valor = np.where(np.isnan(usuarios[posiciones]), -np.inf, usuarios[posiciones])
+    orden = np.lexsort((-posiciones, valor, grupos)) # Por grupo, luego valor y en empate la primera fila de último
+    ultimos = np.r_[grupos[orden][1:] != grupos[orden][:-1], True]
+    return posiciones[orden[ultimos]]
+
+def suma_y_promedio(grupos, valores, n_grupos):
+    # Suma y promedio de los valores de cada grupo (0..n_grupos-1) con una pasada de bincount. Igual que
+    # groupby().sum() y .mean(): los NaN y las filas con grupo -1 no cuentan, un grupo sin valores suma 0 y su promedio es NaN
+    grupos = np.asarray(grupos)
+    valores = np.asarray(valores, dtype=np.float64)
+    validos = ~np.isnan(valores) & (grupos >= 0)
+    suma = np.bincount(grupos[validos], weights=valores[validos], minlength=n_grupos)
+    cuenta = np.bincount(grupos[validos], minlength=n_grupos)
+    return suma, _dividir(suma, cuenta)
+
+def timestamps_unicos(valores, formato=FORMATO_TIMESTAMP):
+    # Texto a datetime64 parseando una sola vez cada valor distinto. Un archivo diario tiene millones de filas pero
+    # solo 24 horas distintas, así que el costo pasa a ser el de factorizar. Nulos y vacíos quedan como NaT
+    codigos, unicos = pd.factorize(np.asarray(valores, dtype=object))
+    fechas = pd.to_datetime(unicos, format=formato).to_numpy(dtype="datetime64[ns]")
+    return np.append(fechas, np.datetime64("NaT", "ns"))[codigos] # Código -1 (nulo) cae en el NaT del final
+
+def fecha_hora(fechas, horas, formato=None):
+    # Timestamp a partir de las columnas de fecha y hora del gestor sin concatenar texto por fila: se combinan los
+    # códigos de cada par (fecha, hora) y solo se arma y parsea el texto de los pares distintos. Sin formato se
+    # infiere del primer valor distinto, como hacía pd.to_datetime sobre la columna completa
+    codigos_fecha, unicos_fecha = pd.factorize(np.asarray(fechas, dtype=object))
+    codigos_hora, unicos_hora = pd.factorize(np.asarray(horas, dtype=object))
+    pares = np.where((codigos_fecha < 0) | (codigos_hora < 0), -1, codigos_fecha * max(len(unicos_hora), 1) + codigos_hora)
+    codigos, unicos = pd.factorize(pares)
+    validos = unicos >= 0
+    texto = np.full(len(unicos), None, dtype=object)
+    texto[validos] = [f"{unicos_fecha[par // len(unicos_hora)]} {unicos_hora[par % len(unicos_hora)]}" for par in unicos[validos]]
+    fechas_unicas = pd.to_datetime(texto, format=formato).to_numpy(dtype="datetime64[ns]")
+    return np.append(fechas_unicas, np.datetime64("NaT", "ns"))[codigos]
+
+def texto_unicos(fechas, formato=FORMATO_TIMESTAMP):
+    # datetime64 a texto formateando una sola vez cada valor distinto (para escribir CSV). NaT queda como None
+    codigos, unicos = pd.factorize(np.asarray(fechas, dtype="datetime64[ns]"))
+    texto = pd.DatetimeIndex(unicos).strftime(formato).to_numpy(dtype=object)
+    return np.append(texto, None)[codigos]
+
+def nombres_como_llave(nombres, dtype):
+    # El snapshot del mapa guarda todos los nombres como texto, pero la base del mapa tiene los códigos DANE de localidad,
+    # municipio y departamento como enteros. Se llevan al tipo de la llave de la base para que el merge funcione; un
+    # texto que no es un código (p. ej. "NaN") queda nulo y no se une con ningún polígono
+    if pd.api.types.is_integer_dtype(dtype):
+        return pd.to_numeric(nombres, errors="coerce").astype("Int64")
+    return nombres
+
+# Mismas fórmulas para las consultas que calculan los KPIs dentro de PostgreSQL (ranking y snapshots del mapa).
+# Las columnas se leen de la tabla con alias "r"; NULLIF evita el error de división por cero (queda NULL)
+SQL_KPIS = {
+    "BH": 'r."L.Traffic.ActiveUser.DL.Avg"',
+    "PRB": 'r."L.ChMeas.PRB.DL.Used.Avg" / NULLIF(r."L.ChMeas.PRB.DL.Avail", 0) * 100',
+    "Traffic": f'r."L.Thrp.bits.DL(bit)" / {BITS_POR_GB}::double precision',
+    "u_exp": f'(r."L.Thrp.bits.DL(bit)" - r."L.Thrp.bits.DL.LastTTI(bit)")::double precision / NULLIF(r."L.Thrp.Time.DL.RmvLastTTI(ms)", 0) / {KBITS_POR_MBIT}'
+}
@@ -0,0 +1,55 @@
+# Pruebas de los estados combinables (Comun/estados_kpi.py): percentil desde el histograma, combinación de días y
+# lectura de filas guardadas. Correr con: python -m pytest tests
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comun"))
+import estados_kpi
+
+#----------- Constantes -----------#
+# Experiencia de usuario en Mbps de cada celda-hora: el 10 % más alto pasa de 1000 Mbps, el límite del último
+# intervalo cerrado del histograma
+RNG = np.random.default_rng(1)
+UEXP = np.concatenate([RNG.uniform(10, 900, 900), RNG.uniform(1000, 1100, 100)])
+
+
+
+#---------- Funciones ----------#
+def filas_celda(uexp, dias):
+    # Filas de celdas por hora con contadores que dan la experiencia de usuario pedida y 50 % de PRBs
+    return pd.DataFrame({
+        "Date": pd.to_datetime(dias),
+        "L.ChMeas.PRB.DL.Used.Avg": 50.0,
+        "L.ChMeas.PRB.DL.Avail": 100.0,
+        "L.Thrp.bits.DL(bit)": uexp * 1000 * 1024,
+        "L.Thrp.bits.DL.LastTTI(bit)": 0.0,
+        "L.Thrp.Time.DL.RmvLastTTI(ms)": 1000.0
+    })
+
+def test_percentil_sobre_el_ultimo_limite():
+    # Un P95 por encima de 1000 Mbps no se recorta al último intervalo cerrado
+    estados = estados_kpi.estados(filas_celda(UEXP, ["2024-03-01"] * len(UEXP)), ["Date"])
+    p95 = estados_kpi.percentil(estados, "uexp")[0]
+    assert p95 > 1000
+    assert abs(p95 - np.percentile(UEXP, 95)) < 0.01 * np.percentile(UEXP, 95)
+    assert p95 <= UEXP.max()
+    assert estados_kpi.percentil(estados, "prb")[0] == 50
+
+def test_combinar_dias_igual_a_un_solo_estado():
+    dias = np.where(np.arange(len(UEXP)) % 2 == 0, "2024-03-01", "2024-03-02")
+    por_dia = estados_kpi.estados(filas_celda(UEXP, dias), ["Date"])
+    por_dia["Semana"] = 0
+    semana = estados_kpi.combinar(por_dia, ["Semana"])
+    completo = estados_kpi.estados(filas_celda(UEXP, ["2024-03-01"] * len(UEXP)), ["Date"])
+    columnas = list(estados_kpi.agregaciones(completo.columns))
+    np.testing.assert_allclose(semana[columnas].to_numpy(dtype=np.float64), completo[columnas].to_numpy(dtype=np.float64))
+
+def test_de_tabla_con_filas_anteriores_al_intervalo_abierto():
+    # Las filas guardadas sin el intervalo abierto se leen con 0 en esa posición
+    tabla = estados_kpi.a_tabla(estados_kpi.estados(filas_celda(UEXP[:900], ["2024-03-01"] * 900), ["Date"]), "total", None)
+    anterior = tabla.assign(hist_uexp=tabla["hist_uexp"].str.replace(r",\d+\}$", "}", regex=True))
+    leido = estados_kpi.de_tabla(anterior)
+    np.testing.assert_array_equal(leido[estados_kpi.columnas_histograma("uexp")].to_numpy(), estados_kpi.de_tabla(tabla)[estados_kpi.columnas_histograma("uexp")].to_numpy())
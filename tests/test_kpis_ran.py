@@ -0,0 +1,106 @@
+# Pruebas con salidas fijas del núcleo de KPIs (Comun/kpis_ran.py): hora pico por lexsort, códigos de grupo, suma y
+# promedio por bincount y fórmulas de KPI, comparadas con los valores esperados y con la versión groupby/idxmax que
+# reemplazaron. Correr con: python -m pytest tests
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comun"))
+import kpis_ran
+
+#----------- Constantes -----------#
+NAN = np.nan
+# Filas por hora de tres celdas en dos días. A/d1 tiene un NaN, A/d2 un empate en el pico, B/d1 solo NaN, la fila 7
+# no tiene celda y los días de C llegan en desorden
+DATOS = pd.DataFrame({
+    "Cell_name": ["A", "A", "A", "A", "A", "B", "B", None, "C", "C"],
+    "Timestamp": pd.to_datetime(["2024-03-01 08:00", "2024-03-01 09:00", "2024-03-01 10:00", "2024-03-02 08:00", "2024-03-02 09:00",
+                                 "2024-03-01 08:00", "2024-03-01 09:00", "2024-03-01 10:00", "2024-03-02 08:00", "2024-03-01 08:00"]),
+    "L.Traffic.ActiveUser.DL.Avg": [5.0, NAN, 7.0, 3.0, 3.0, NAN, NAN, 100.0, 1.0, 2.0],
+    "L.ChMeas.PRB.DL.Used.Avg": [10.0, 20.0, 50.0, 0.0, 25.0, 5.0, 5.0, 1.0, 30.0, 0.0],
+    "L.ChMeas.PRB.DL.Avail": [100.0, 100.0, 100.0, 0.0, 50.0, 100.0, 100.0, 100.0, 0.0, 100.0],
+    "L.Thrp.bits.DL(bit)": [8e9, 1.6e10, 2.4e10, 0.0, 4e9, NAN, 8e9, 8e9, 1.6e10, 8e9],
+    "L.Thrp.bits.DL.LastTTI(bit)": [1024.0, 0.0, 2048.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1024.0, 0.0],
+    "L.Thrp.Time.DL.RmvLastTTI(ms)": [1000.0, 1000.0, 2000.0, 0.0, 500.0, 1000.0, 1000.0, 1000.0, 1000.0, 0.0]
+})
+# Grupos (celda, día) en orden de las claves y posición de su hora pico
+CODIGOS = [0, 0, 0, 1, 1, 2, 2, -1, 5, 4]
+HORA_PICO = [2, 3, 5, 9, 8] # A/d1, A/d2 (empate: primera fila), B/d1 (todo NaN: primera fila), C/d1, C/d2
+
+
+
+#---------- Funciones ----------#
+def grupos():
+    return kpis_ran.codigos_grupo(DATOS["Cell_name"], DATOS["Timestamp"].dt.normalize())
+
+def test_codigos_grupo():
+    np.testing.assert_array_equal(grupos(), CODIGOS)
+
+def test_codigos_grupo_orden_groupby():
+    # El orden de los códigos es el de las llaves de groupby
+    codigos = grupos()
+    llaves = DATOS.groupby(["Cell_name", DATOS["Timestamp"].dt.normalize()]).size().index
+    primeras = [int(np.flatnonzero(codigos == codigo)[0]) for codigo in np.unique(codigos[codigos >= 0])]
+    assert [(DATOS["Cell_name"][i], DATOS["Timestamp"].dt.normalize()[i]) for i in primeras] == list(llaves)
+
+def test_hora_pico():
+    np.testing.assert_array_equal(kpis_ran.hora_pico(grupos(), DATOS["L.Traffic.ActiveUser.DL.Avg"]), HORA_PICO)
+
+def test_hora_pico_igual_a_idxmax():
+    # Sin el grupo con solo NaN (idxmax de pandas falla ahí) el resultado es el de groupby().idxmax()
+    datos = DATOS[DATOS["Cell_name"] != "B"].reset_index(drop=True)
+    codigos = kpis_ran.codigos_grupo(datos["Cell_name"], datos["Timestamp"].dt.normalize())
+    referencia = datos.groupby(["Cell_name", datos["Timestamp"].dt.normalize()])["L.Traffic.ActiveUser.DL.Avg"].idxmax()
+    np.testing.assert_array_equal(kpis_ran.hora_pico(codigos, datos["L.Traffic.ActiveUser.DL.Avg"]), referencia.to_numpy())
+
+def test_hora_pico_aleatorio_igual_a_idxmax():
+    rng = np.random.default_rng(7)
+    n = 5000
+    datos = pd.DataFrame({
+        "celda": rng.choice(["x", "y", "z", None], n),
+        "dia": rng.integers(0, 5, n),
+        "usuarios": rng.integers(0, 4, n).astype(float) # Muchos empates
+    })
+    datos.loc[rng.random(n) < 0.2, "usuarios"] = NAN
+    codigos = kpis_ran.codigos_grupo(datos["celda"], datos["dia"])
+    referencia = datos.groupby(["celda", "dia"])["usuarios"].idxmax()
+    np.testing.assert_array_equal(kpis_ran.hora_pico(codigos, datos["usuarios"]), referencia.to_numpy())
+
+def test_hora_pico_sin_grupos():
+    assert len(kpis_ran.hora_pico(np.full(3, -1), [1.0, 2.0, 3.0])) == 0
+
+def test_kpis_en_hora_pico():
+    bh = DATOS.iloc[HORA_PICO]
+    prb = kpis_ran.uso_prb(bh["L.ChMeas.PRB.DL.Used.Avg"], bh["L.ChMeas.PRB.DL.Avail"])
+    trafico = kpis_ran.bits_a_gb(bh["L.Thrp.bits.DL(bit)"])
+    experiencia = kpis_ran.experiencia_usuario(bh["L.Thrp.bits.DL(bit)"], bh["L.Thrp.bits.DL.LastTTI(bit)"], bh["L.Thrp.Time.DL.RmvLastTTI(ms)"])
+    np.testing.assert_array_equal(prb, [50.0, NAN, 5.0, 0.0, np.inf]) # 0/0 = NaN, x/0 = inf como en pandas
+    np.testing.assert_allclose(trafico, [3.0, 0.0, NAN, 1.0, 2.0])
+    np.testing.assert_allclose(experiencia, [(2.4e10 - 2048) / 2000 / 1024, NAN, NAN, np.inf, (1.6e10 - 1024) / 1000 / 1024])
+
+def test_kpis_igual_a_pandas():
+    serie = lambda columna: DATOS[columna]
+    np.testing.assert_array_equal(kpis_ran.uso_prb(serie("L.ChMeas.PRB.DL.Used.Avg"), serie("L.ChMeas.PRB.DL.Avail")),
+                                  (serie("L.ChMeas.PRB.DL.Used.Avg") / serie("L.ChMeas.PRB.DL.Avail") * 100).to_numpy())
+    np.testing.assert_array_equal(kpis_ran.experiencia_usuario(serie("L.Thrp.bits.DL(bit)"), serie("L.Thrp.bits.DL.LastTTI(bit)"), serie("L.Thrp.Time.DL.RmvLastTTI(ms)")),
+                                  ((serie("L.Thrp.bits.DL(bit)") - serie("L.Thrp.bits.DL.LastTTI(bit)")) / serie("L.Thrp.Time.DL.RmvLastTTI(ms)") / 1024).to_numpy())
+
+def test_suma_y_promedio():
+    suma, promedio = kpis_ran.suma_y_promedio(CODIGOS, DATOS["L.Thrp.bits.DL(bit)"], 6)
+    np.testing.assert_allclose(suma, [4.8e10, 4e9, 8e9, 0.0, 8e9, 1.6e10]) # El código 3 no existe: suma 0
+    np.testing.assert_allclose(promedio, [1.6e10, 2e9, 8e9, NAN, 8e9, 1.6e10]) # y promedio NaN
+
+def test_suma_y_promedio_igual_a_groupby():
+    referencia = DATOS.groupby(["Cell_name", DATOS["Timestamp"].dt.normalize()])["L.Thrp.bits.DL(bit)"]
+    existentes = np.unique(np.asarray(CODIGOS)[np.asarray(CODIGOS) >= 0])
+    suma, promedio = kpis_ran.suma_y_promedio(CODIGOS, DATOS["L.Thrp.bits.DL(bit)"], 6)
+    np.testing.assert_allclose(suma[existentes], referencia.sum().to_numpy())
+    np.testing.assert_allclose(promedio[existentes], referencia.mean().to_numpy())
+
+def test_fecha_hora_y_timestamps_unicos():
+    # Un par (fecha, hora) o un texto nulo queda en NaT
+    esperado = np.array(["2024-03-01T08:00", "2024-03-01T09:00", "NaT", "2024-03-02T08:00"], dtype="datetime64[ns]")
+    np.testing.assert_array_equal(kpis_ran.fecha_hora(["2024-03-01", "2024-03-01", None, "2024-03-02"], ["08:00", "09:00", "10:00", "08:00"]), esperado)
+    np.testing.assert_array_equal(kpis_ran.timestamps_unicos(["2024-03-01 08:00:00", "2024-03-01 09:00:00", None, "2024-03-02 08:00:00"]), esperado)
@@ -0,0 +1,63 @@
+# Pruebas del merge entre el snapshot del mapa (nombres guardados como texto por el ETL) y las bases de polígonos del
+# dashboard, que tienen los códigos DANE como enteros. Correr con: python -m pytest tests
+import os
+import sys
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Comun"))
+import kpis_ran
+
+#----------- Constantes -----------#
+CARPETA_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "App")
+# Agregación -> (GeoJSON, llave de la base y si base_mapa la convierte a entero). Localidades viene en un .TAB que
+# solo se lee con geopandas, sus códigos se arman a mano
+BASES = {
+    "localidad": (None, "Localidad", True),
+    "municipio": ("co_2018_MGN_MPIO_POLITICO.geojson", "MPIO_CCNCT", True),
+    "departamento": ("co_2018_MGN_DPTO_POLITICO.geojson", "DPTO_CCDGO", True),
+    "AM": ("AreasMetro.geojson", "AM", False),
+    "regional": ("Regional_test.geojson", "DPTO_REGIONAL", False)
+}
+
+
+
+#---------- Funciones ----------#
+def base_poligonos(agg):
+    # Misma base que base_mapa: las columnas del GeoJSON llegan como texto y los códigos DANE se pasan a entero
+    archivo, llave, entero = BASES[agg]
+    if archivo is None:
+        base = pd.DataFrame({llave: ["11001", "5001", "76001"]})
+    else:
+        with open(os.path.join(CARPETA_APP, archivo), encoding="utf-8") as f:
+            base = pd.DataFrame([feature["properties"] for feature in json.load(f)["features"]])
+        base[llave] = base[llave].astype(str)
+    if entero:
+        base[llave] = base[llave].astype(int)
+    return base, llave
+
+def snapshot(base, llave):
+    # Filas del snapshot para los dos primeros polígonos, como las devuelve la consulta: nombre en texto, más un
+    # nombre que no es un código
+    nombres = base[llave].astype(str).iloc[:2].tolist() + ["NaN"]
+    return pd.DataFrame({"nombre": nombres, "valor": [1.0, 2.0, 3.0]})
+
+@pytest.mark.parametrize("agg", list(BASES))
+def test_merge_snapshot_con_base(agg):
+    base, llave = base_poligonos(agg)
+    df = snapshot(base, llave)
+    df["nombre"] = kpis_ran.nombres_como_llave(df["nombre"], base[llave].dtype)
+    unido = base.merge(df, how="left", left_on=llave, right_on="nombre")
+    assert len(unido) == len(base) # Cada polígono conserva una fila y su orden
+    np.testing.assert_array_equal(unido[llave].to_numpy(), base[llave].to_numpy())
+    np.testing.assert_array_equal(unido["valor"].to_numpy()[:2], [1.0, 2.0])
+    assert unido["valor"].notna().sum() == 2
+
+def test_merge_snapshot_sin_convertir_falla():
+    # El error que se corrige: merge de una llave entera con los nombres en texto
+    base, llave = base_poligonos("municipio")
+    with pytest.raises(ValueError):
+        base.merge(snapshot(base, llave), how="left", left_on=llave, right_on="nombre")